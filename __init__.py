@@ -5,7 +5,8 @@ from loguru import logger
 
 from .client_manager import client_manager
 from .crud import db
-from .tasks import wait_for_paid_invoices
+from .relay.signature_verifier import signature_verifier
+from .tasks import compact_events, wait_for_paid_invoices
 from .views import nostrrelay_generic_router
 from .views_api import nostrrelay_api_router
 
@@ -42,6 +43,7 @@ async def nostrrelay_stop():
         await client_manager.stop()
     except Exception as ex:
         logger.warning(ex)
+    signature_verifier.shutdown()
 
 
 def nostrrelay_start():
@@ -49,6 +51,8 @@ def nostrrelay_start():
 
     task = create_permanent_unique_task("ext_nostrrelay", wait_for_paid_invoices)
     scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_nostrrelay_compaction", compact_events)
+    scheduled_tasks.append(task)
 
 
 __all__ = [
@@ -0,0 +1,49 @@
+"""
+Shared setup of the benchmark scripts. Importing this module makes the
+extension importable as the `nostrrelay` package.
+"""
+
+import hashlib
+import importlib.util
+import sqlite3
+import sys
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+# the extension modules use relative imports: load them as the `nostrrelay`
+# package, without running its `__init__` (it needs a running LNbits)
+package = types.ModuleType("nostrrelay")
+package.__path__ = [str(ROOT)]
+sys.modules["nostrrelay"] = package
+
+
+class SqliteMigrationDb:
+    """Minimal stand-in for the `lnbits.db.Connection` used by the migrations."""
+
+    type = "SQLITE"
+    big_int = "INT"
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    async def execute(self, query: str, values: dict | None = None):
+        self.conn.execute(query, values or {})
+
+    async def fetchall(self, query: str, values: dict | None = None) -> list:
+        cursor = self.conn.execute(query, values or {})
+        cursor.row_factory = sqlite3.Row
+        return cursor.fetchall()
+
+
+def load_migrations():
+    spec = importlib.util.spec_from_file_location("migrations", ROOT / "migrations.py")
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def hex_id(*parts) -> str:
+    """Deterministic 32 bytes hex id (event ids, pubkeys)."""
+    return hashlib.sha256(":".join(str(p) for p in parts).encode()).hexdigest()
@@ -0,0 +1,178 @@
+"""
+Query plans and timings of the event queries before and after the
+`m002_add_event_indexes` and `m006_add_event_tag_index` migrations (SQLite).
+
+    uv run python benchmarks/bench_event_indexes.py --events 2000000
+
+The tables and indexes are created by the extension migrations, the queries
+are built by `NostrFilter.to_sql_components()` the same way `crud.get_events`
+does it.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from _common import SqliteMigrationDb, hex_id, load_migrations
+from nostrrelay.relay.filter import NostrFilter
+
+RELAY_ID = "bench"
+
+
+def populate(conn: sqlite3.Connection, event_count: int, pubkey_count: int):
+    rnd = random.Random(42)
+    pubkeys = [hex_id("pubkey", i) for i in range(pubkey_count)]
+    kinds = [0, 1, 1, 1, 1, 3, 4, 6, 7, 7, 7, 30023]
+    now = int(time.time())
+    batch_size = 50_000
+
+    for start in range(0, event_count, batch_size):
+        events = []
+        tags = []
+        for i in range(start, min(start + batch_size, event_count)):
+            event_id = hex_id("event", i)
+            pubkey = rnd.choice(pubkeys)
+            events.append(
+                (
+                    RELAY_ID,
+                    pubkey,
+                    event_id,
+                    pubkey,
+                    now - rnd.randint(0, 365 * 86400),
+                    rnd.choice(kinds),
+                    "x" * rnd.randint(10, 200),
+                    "0" * 128,
+                    300,
+                )
+            )
+            for _ in range(rnd.randint(0, 4)):
+                name = rnd.choice("eeptt")
+                value = hex_id("event", rnd.randrange(event_count))
+                if name == "p":
+                    value = rnd.choice(pubkeys)
+                elif name == "t":
+                    value = f"topic{int(rnd.paretovariate(1)) % 1000}"
+                tags.append((RELAY_ID, event_id, name, value))
+        conn.executemany(
+            """
+            INSERT INTO nostrrelay.events
+            (relay_id, publisher, id, pubkey, created_at, kind, content, sig, size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            events,
+        )
+        conn.executemany(
+            """
+            INSERT INTO nostrrelay.event_tags (relay_id, event_id, name, value)
+            VALUES (?, ?, ?, ?)
+            """,
+            tags,
+        )
+        conn.commit()
+        print(f"  inserted {start + len(events)} events", end="\r", flush=True)
+    print()
+    return pubkeys
+
+
+def build_queries(pubkeys: list[str]) -> dict[str, tuple[str, dict]]:
+    some_pubkeys = pubkeys[:5]
+    filters = {
+        "authors + kinds": NostrFilter(authors=some_pubkeys, kinds=[1], limit=100),
+        "kinds": NostrFilter(kinds=[30023], limit=100),
+        "#p (mentions)": NostrFilter.parse_obj({"#p": [pubkeys[7]], "limit": 100}),
+        "#t + #p": NostrFilter.parse_obj(
+            {"#t": ["topic1", "topic2"], "#p": pubkeys[:20], "limit": 100}
+        ),
+        "recent (since)": NostrFilter(since=int(time.time()) - 3600, limit=100),
+    }
+    queries = {}
+    for name, nostr_filter in filters.items():
+        inner_joins, where, values = nostr_filter.to_sql_components(RELAY_ID)
+        query = f"""
+            SELECT * FROM nostrrelay.events
+            {" ".join(inner_joins)}
+            WHERE {" AND ".join(where)}
+            ORDER BY created_at DESC, nostrrelay.events.id DESC
+            LIMIT {nostr_filter.limit}
+            """
+        queries[name] = (query, values)
+
+    queries["tags of one event"] = (
+        """
+        SELECT * FROM nostrrelay.event_tags
+        WHERE relay_id = :relay_id AND event_id = :event_id
+        """,
+        {"relay_id": RELAY_ID, "event_id": hex_id("event", 1)},
+    )
+    queries["storage of publisher"] = (
+        """
+        SELECT SUM(size) as sum FROM nostrrelay.events
+        WHERE relay_id = :relay_id AND publisher = :publisher GROUP BY publisher
+        """,
+        {"relay_id": RELAY_ID, "publisher": pubkeys[3]},
+    )
+    return queries
+
+
+def run_queries(conn: sqlite3.Connection, queries: dict, repeat: int) -> dict:
+    results = {}
+    for name, (query, values) in queries.items():
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {query}", values).fetchall()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(query, values).fetchall()
+        elapsed_ms = (time.perf_counter() - start) * 1000 / repeat
+        results[name] = ([row[-1] for row in plan], elapsed_ms)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--events", type=int, default=2_000_000)
+    parser.add_argument("--pubkeys", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    migrations = load_migrations()
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "main.sqlite3"))
+        schema_path = os.path.join(tmp, "nostrrelay.sqlite3")
+        conn.execute(f"ATTACH '{schema_path}' AS nostrrelay")
+        db = SqliteMigrationDb(conn)
+
+        asyncio.run(migrations.m001_initial(db))
+        print(f"Populating {args.events} events...")
+        pubkeys = populate(conn, args.events, args.pubkeys)
+        queries = build_queries(pubkeys)
+
+        # the tag filters query `event_tag_index`: same rows, without a key
+        conn.execute(
+            """
+            CREATE TABLE nostrrelay.event_tag_index AS
+            SELECT DISTINCT relay_id, name, value, event_id FROM nostrrelay.event_tags
+            """
+        )
+        before = run_queries(conn, queries, args.repeat)
+        conn.execute("DROP TABLE nostrrelay.event_tag_index")
+        print("Creating indexes (m002_add_event_indexes, m006_add_event_tag_index)...")
+        start = time.perf_counter()
+        asyncio.run(migrations.m002_add_event_indexes(db))
+        asyncio.run(migrations.m006_add_event_tag_index(db))
+        conn.execute("ANALYZE nostrrelay")
+        print(f"  done in {time.perf_counter() - start:.1f}s")
+        after = run_queries(conn, queries, args.repeat)
+
+        for name in queries:
+            (plan_before, ms_before), (plan_after, ms_after) = before[name], after[name]
+            print(f"\n== {name}: {ms_before:.2f} ms -> {ms_after:.2f} ms")
+            print("   before: " + " | ".join(plan_before))
+            print("   after:  " + " | ".join(plan_after))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
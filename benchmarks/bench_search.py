@@ -0,0 +1,157 @@
+"""
+Timings of the NIP-50 search queries on a large content corpus: full scan
+(`LIKE`) against the FTS5 index of the `m005_add_event_search` migration
+(SQLite).
+
+    uv run python benchmarks/bench_search.py --events 1000000
+
+The content is generated from a Zipf-like vocabulary, so there are very
+common words, words of medium frequency and rare words. The search queries
+are built by `NostrFilter.to_sql_components()` and ordered by relevance, the
+same way `crud.get_events` does it.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from _common import SqliteMigrationDb, hex_id, load_migrations
+from nostrrelay.relay.filter import NostrFilter
+
+RELAY_ID = "bench"
+LIMIT = 100
+
+
+def vocabulary(size: int) -> tuple[list[str], list[float]]:
+    words = [f"w{i}" for i in range(size)]
+    weights = [1 / (rank + 1) for rank in range(size)]
+    return words, weights
+
+
+def populate(conn: sqlite3.Connection, event_count: int, words: list, weights: list):
+    rnd = random.Random(42)
+    now = int(time.time())
+    batch_size = 50_000
+
+    for start in range(0, event_count, batch_size):
+        events = []
+        for i in range(start, min(start + batch_size, event_count)):
+            content = " ".join(rnd.choices(words, weights, k=rnd.randint(3, 60)))
+            pubkey = hex_id("pubkey", rnd.randrange(10_000))
+            events.append(
+                (
+                    RELAY_ID,
+                    pubkey,
+                    hex_id("event", i),
+                    pubkey,
+                    now - rnd.randint(0, 365 * 86400),
+                    rnd.choice([1, 1, 1, 30023]),
+                    content,
+                    "0" * 128,
+                    len(content) + 300,
+                )
+            )
+        conn.executemany(
+            """
+            INSERT INTO nostrrelay.events
+            (relay_id, publisher, id, pubkey, created_at, kind, content, sig, size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            events,
+        )
+        conn.commit()
+        print(f"  inserted {start + len(events)} events", end="\r", flush=True)
+    print()
+
+
+def search_query(nostr_filter: NostrFilter) -> tuple[str, dict]:
+    inner_joins, where, values = nostr_filter.to_sql_components(RELAY_ID)
+    query = f"""
+        SELECT * FROM nostrrelay.events
+        {" ".join(inner_joins)}
+        WHERE {" AND ".join(where)}
+        ORDER BY {nostr_filter.to_sql_order_by()}
+        LIMIT {LIMIT}
+        """
+    return query, values
+
+
+def scan_query(terms: list[str]) -> tuple[str, dict]:
+    """What a client (or a relay without an index) has to do: a full scan."""
+    where = ["deleted=false", "relay_id = :relay_id"]
+    values = {"relay_id": RELAY_ID}
+    for i, term in enumerate(terms):
+        where.append(f"(' ' || content || ' ') LIKE :term_{i}")
+        values[f"term_{i}"] = f"% {term} %"
+    query = f"""
+        SELECT * FROM nostrrelay.events WHERE {" AND ".join(where)}
+        ORDER BY created_at DESC, id DESC LIMIT {LIMIT}
+        """
+    return query, values
+
+
+def timed(conn: sqlite3.Connection, query: str, values: dict, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rows = conn.execute(query, values).fetchall()
+    return len(rows), (time.perf_counter() - start) * 1000 / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--events", type=int, default=1_000_000)
+    parser.add_argument("--words", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    migrations = load_migrations()
+    words, weights = vocabulary(args.words)
+    searches = {
+        "common word": [words[0]],
+        "medium word": [words[500]],
+        "rare word": [words[-1]],
+        "two words": [words[3], words[200]],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "main.sqlite3"))
+        schema_path = os.path.join(tmp, "nostrrelay.sqlite3")
+        conn.execute(f"ATTACH '{schema_path}' AS nostrrelay")
+        db = SqliteMigrationDb(conn)
+
+        asyncio.run(migrations.m001_initial(db))
+        asyncio.run(migrations.m002_add_event_indexes(db))
+        asyncio.run(migrations.m004_add_event_deleted_at(db))
+        print(f"Populating {args.events} events...")
+        populate(conn, args.events, words, weights)
+        size_before = os.path.getsize(schema_path)
+
+        print("Building the search index (m005_add_event_search)...")
+        start = time.perf_counter()
+        asyncio.run(migrations.m005_add_event_search(db))
+        conn.commit()
+        conn.execute("ANALYZE nostrrelay")
+        print(f"  done in {time.perf_counter() - start:.1f}s")
+        size_after = os.path.getsize(schema_path)
+        print(
+            f"  database size {size_before / 2**20:.0f} MB -> "
+            f"{size_after / 2**20:.0f} MB"
+        )
+
+        for name, terms in searches.items():
+            nostr_filter = NostrFilter(search=" ".join(terms), limit=LIMIT)
+            query, values = search_query(nostr_filter)
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {query}", values).fetchall()
+            found, ms_index = timed(conn, query, values, args.repeat)
+            scan, ms_scan = timed(conn, *scan_query(terms), args.repeat)
+            print(f"\n== {name} ({' '.join(terms)}): {found} (scan: {scan}) events")
+            print(f"   scan {ms_scan:.2f} ms -> index {ms_index:.2f} ms")
+            print("   plan: " + " | ".join(row[-1] for row in plan))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Bytes on the wire and CPU per event of the websocket `permessage-deflate`
+extension (RFC 7692) for a stream of relay `EVENT` frames.
+
+    uv run python benchmarks/bench_ws_compression.py --events 20000
+
+The stream starts with the test fixture events, followed by generated events
+with a realistic mix: a limited set of active pubkeys, replies and mentions
+(`e` and `p` tags), text notes, reactions, contact lists and encrypted
+direct messages (not compressible). The frames are built the same way the
+relay sends them (`serialize_response_json`).
+Each frame is compressed as the websocket server does it: raw deflate, sync
+flush, without the trailing `00 00 ff ff`. With context takeover the
+compressor is kept for the whole connection, so the work is done again for
+every subscriber of an event.
+"""
+
+import argparse
+import base64
+import json
+import random
+import time
+import zlib
+
+from _common import ROOT, hex_id
+from nostrrelay.relay.event import NostrEventStruct
+
+WORDS = (
+    "the relay bitcoin lightning nostr zap note follow just gm today price "
+    "node channel wallet sats build open source client people world good new "
+    "time day think know really about would there their what when"
+).split()
+
+
+def fixture_events() -> list[NostrEventStruct]:
+    events = []
+    data = json.loads((ROOT / "tests" / "fixture" / "events.json").read_text())
+    for fixture in data["valid"]:
+        events.append(NostrEventStruct.parse(fixture["data"]))
+    clients = json.loads((ROOT / "tests" / "fixture" / "clients.json").read_text())
+    for messages in clients.values():
+        for message in messages.values():
+            if isinstance(message, list) and message[:1] == ["EVENT"]:
+                events.append(NostrEventStruct.parse(message[1]))
+    return events
+
+
+def generated_events(count: int, pubkey_count: int) -> list[NostrEventStruct]:
+    rnd = random.Random(42)
+    pubkeys = [hex_id("pubkey", i) for i in range(pubkey_count)]
+    recent_ids: list[str] = []
+    events = []
+    now = int(time.time())
+    for i in range(count):
+        event_id = hex_id("event", i)
+        kind = rnd.choice([1, 1, 1, 1, 7, 7, 7, 6, 3, 4, 0])
+        tags: list[list[str]] = []
+        content = ""
+        if kind == 1:
+            content = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 60)))
+            if recent_ids and rnd.random() < 0.5:
+                tags.append(["e", rnd.choice(recent_ids), "", "reply"])
+                tags.append(["p", rnd.choice(pubkeys)])
+        elif kind in [6, 7]:
+            content = "+" if kind == 7 else ""
+            if recent_ids:
+                tags = [["e", rnd.choice(recent_ids)], ["p", rnd.choice(pubkeys)]]
+        elif kind == 3:
+            tags = [["p", p] for p in rnd.sample(pubkeys, rnd.randint(10, 150))]
+        elif kind == 4:
+            secret = rnd.randbytes(rnd.randint(16, 400))
+            iv = rnd.randbytes(16)
+            content = (
+                base64.b64encode(secret).decode()
+                + "?iv="
+                + base64.b64encode(iv).decode()
+            )
+            tags = [["p", rnd.choice(pubkeys)]]
+        else:
+            content = json.dumps(
+                {"name": f"user{i}", "about": " ".join(rnd.sample(WORDS, 8))}
+            )
+        events.append(
+            NostrEventStruct(
+                id=event_id,
+                pubkey=rnd.choice(pubkeys),
+                created_at=now - count + i,
+                kind=kind,
+                tags=tags,
+                content=content,
+                sig=hex_id("sig1", i) + hex_id("sig2", i),
+            )
+        )
+        recent_ids = [*recent_ids[-199:], event_id]
+    return events
+
+
+def frame_header_size(payload_size: int) -> int:
+    # server frames are not masked
+    if payload_size < 126:
+        return 2
+    if payload_size < 65536:
+        return 4
+    return 10
+
+
+def measure(
+    frames: list[bytes], level: int | None, takeover: bool, window_bits: int
+) -> tuple[int, float]:
+    """Bytes on the wire (payloads and frame headers) and CPU seconds."""
+    total = 0
+    start = time.process_time()
+    compressor = None
+    for frame in frames:
+        if level is None:
+            payload = frame
+        else:
+            if not takeover or compressor is None:
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits)
+            payload = compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            payload = payload[:-4]
+        total += len(payload) + frame_header_size(len(payload))
+    return total, time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--events", type=int, default=20_000)
+    parser.add_argument("--pubkeys", type=int, default=500)
+    args = parser.parse_args()
+
+    events = fixture_events() + generated_events(args.events, args.pubkeys)
+    frames = [e.serialize_response_json("sub0").encode() for e in events]
+    print(f"{len(frames)} EVENT frames, {sum(len(f) for f in frames)} bytes of JSON")
+
+    baseline, _ = measure(frames, None, False, 15)
+    print(
+        f"\n{'level':>5} {'context takeover':>17} {'window bits':>12}"
+        f" {'bytes':>12} {'% of plain':>11} {'us/event':>9}"
+    )
+    print(f"{'-':>5} {'-':>17} {'-':>12} {baseline:>12} {100:>10.1f}% {0:>9.2f}")
+    for level in [1, 6, 9]:
+        for takeover in [False, True]:
+            for window_bits in [15, 10]:
+                size, cpu = measure(frames, level, takeover, window_bits)
+                print(
+                    f"{level:>5} {'yes' if takeover else 'no':>17} {window_bits:>12}"
+                    f" {size:>12} {size * 100 / baseline:>10.1f}%"
+                    f" {cpu * 1e6 / len(frames):>9.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,55 @@
 import json
-
-from lnbits.db import Database
-
-from .models import NostrAccount, NostrEventTags
-from .relay.event import NostrEvent
-from .relay.filter import NostrFilter
+import re
+import time
+from collections.abc import AsyncIterator, Sequence
+
+from lnbits.db import (
+    SQLITE,
+    Connection,
+    Database,
+    dict_to_model,
+    insert_query,
+    model_to_dict,
+)
+from sqlalchemy import text
+
+from .helpers import LRUCache
+from .models import NostrAccount, NostrCompactionStats, NostrEventTags
+from .relay.event import BaseNostrEvent, NostrEvent, NostrEventStruct
+from .relay.filter import NostrFilter, sql_in_list, tag_index_value
+from .relay.recent_events import RecentEvents
 from .relay.relay import NostrRelay, RelayPublicSpec
 
 db = Database("ext_nostrrelay")
 
+# max number of `event_tags` rows written by one INSERT statement
+TAGS_INSERT_BATCH_SIZE = 200
+# max number of events for which the tags are loaded by one SELECT statement
+TAGS_SELECT_BATCH_SIZE = 500
+# max number of events removed by one compaction step
+COMPACTION_BATCH_SIZE = 500
+# number of events fetched by one query when streaming the events: the first
+# page is small (time to first event), the next ones grow up to the max size
+EVENTS_STREAM_FIRST_PAGE_SIZE = 20
+EVENTS_STREAM_PAGE_SIZE = 500
+
+# the newest events of the relays that have been queried, see `stream_events()`
+_recent_events: dict[str, RecentEvents] = {}
+
+# running total of the stored bytes per `(relay_id, publisher)`,
+# loaded from the database on first use and then kept up to date
+_storage_bytes: dict[tuple[str, str], int] = {}
+
+# accounts are read for every EVENT (and every REQ on relays with auth filters),
+# entries are dropped when an account changes (`None` means no account)
+_accounts = LRUCache(maxsize=10_000, ttl=300)
+_NOT_CACHED = object()
+
+# the same counts (followers, reactions) are requested by many clients,
+# a result can be a few seconds old
+COUNT_CACHE_TTL_SECONDS = 10
+_counts = LRUCache(maxsize=10_000, ttl=COUNT_CACHE_TTL_SECONDS)
+
 
 async def create_relay(relay: NostrRelay) -> NostrRelay:
     await db.insert("nostrrelay.relays", relay)
@@ -84,51 +125,252 @@ async def delete_relay(user_id: str, relay_id: str):
     )
 
 
-async def create_event(event: NostrEvent):
-    event_ = await get_event(event.relay_id, event.id)
-    if event_:
-        return None
-    await db.insert("nostrrelay.events", event)
-
-    # todo: optimize with bulk insert
-    for tag in event.tags:
-        name, value, *rest = tag
-        extra = json.dumps(rest) if rest else None
-        _tag = NostrEventTags(
-            relay_id=event.relay_id,
-            event_id=event.id,
-            name=name,
-            value=value,
-            extra=extra,
+async def create_event(event: NostrEvent) -> bool:
+    """
+    Store the event and all its tags in one transaction. The single-letter tags
+    are also added to the `event_tag_index` table, used by the tag filters
+    (the long values by their hash, see `tag_index_value()`).
+    Duplicates are detected by the primary key, `False` is returned for them.
+    """
+    tags = [_event_tag_values(tag) for tag in event.tags]
+    indexed_tags = sorted(
+        {
+            (tag["name"], tag_index_value(tag["value"]))
+            for tag in tags
+            if len(tag["name"]) == 1
+        }
+    )
+    event.size = event.size_bytes
+
+    async with db.connect() as conn:
+        result = await _execute_uncommitted(
+            conn,
+            insert_query("nostrrelay.events", event) + " ON CONFLICT DO NOTHING",
+            model_to_dict(event),
         )
-        await create_event_tags(_tag)
+        if result.rowcount == 0:
+            return False
+
+        for i in range(0, len(tags), TAGS_INSERT_BATCH_SIZE):
+            await _insert_event_tags(
+                conn, event.relay_id, event.id, tags[i : i + TAGS_INSERT_BATCH_SIZE]
+            )
+        for i in range(0, len(indexed_tags), TAGS_INSERT_BATCH_SIZE):
+            await _insert_tag_index(
+                conn,
+                event.relay_id,
+                event.id,
+                indexed_tags[i : i + TAGS_INSERT_BATCH_SIZE],
+            )
+        if db.type == SQLITE and event.content and not event.is_direct_message:
+            await _insert_search_index(conn, event)
+        await conn.conn.commit()
+
+    _update_storage(event.relay_id, event.publisher, event.size)
+    if event.relay_id in _recent_events:
+        _recent_events[event.relay_id].add(event)
+    return True
 
 
 async def get_events(
     relay_id: str, nostr_filter: NostrFilter, include_tags=True
 ) -> list[NostrEvent]:
 
-    inner_joins, where, values = nostr_filter.to_sql_components(relay_id)
+    inner_joins, where, values = nostr_filter.to_sql_components(relay_id, db.type)
     query = f"""
         SELECT * FROM nostrrelay.events
         {" ".join(inner_joins)}
         WHERE { " AND ".join(where)}
-        ORDER BY created_at DESC
+        ORDER BY {nostr_filter.to_sql_order_by(db.type)}
         """
 
     # todo: check & enforce range
     if nostr_filter.limit and nostr_filter.limit > 0:
-        query += f" LIMIT {nostr_filter.limit}"
+        query += " LIMIT :limit"
+        values["limit"] = nostr_filter.limit
 
-    events = await db.fetchall(query, values, NostrEvent)
+    rows = await _fetchall_raw(query, values)
+    events = [dict_to_model(row, NostrEvent) for row in rows]
 
-    for event in events:
-        if include_tags:
-            event.tags = await get_event_tags(relay_id, event.id)
+    if include_tags:
+        await _load_events_tags(relay_id, events)
 
     return events
 
 
+async def stream_events(
+    relay_id: str,
+    nostr_filter: NostrFilter,
+    page_size=EVENTS_STREAM_PAGE_SIZE,
+    first_page_size=EVENTS_STREAM_FIRST_PAGE_SIZE,
+) -> AsyncIterator[BaseNostrEvent]:
+    """
+    Same result as `get_events()`. The newest events are served from memory
+    when possible (see `RecentEvents`), otherwise they are read page by page
+    (keyset pagination on `created_at, id`) and yielded as soon as their page
+    is loaded. The database is not held while the caller consumes a page.
+    The first page is small, so the first events are sent quickly, then the
+    page size doubles up to `page_size`.
+    The rows are not validated by pydantic, the events are plain structs.
+    """
+    recent_events = await _get_recent_events(relay_id)
+    events_in_memory = recent_events.query(nostr_filter) if recent_events else None
+    if events_in_memory is not None:
+        for e in events_in_memory:
+            yield e
+        return
+    if nostr_filter.search_terms():
+        # ordered by relevance, there is no `(created_at, id)` keyset
+        for e in await get_events(relay_id, nostr_filter):
+            yield e
+        return
+
+    inner_joins, where, values = nostr_filter.to_sql_components(relay_id, db.type)
+    limit = nostr_filter.limit if nostr_filter.limit and nostr_filter.limit > 0 else 0
+    count = 0
+    cursor: NostrEventStruct | None = None
+
+    next_page_size = min(first_page_size, page_size)
+    while True:
+        page_limit = min(next_page_size, limit - count) if limit else next_page_size
+        page_where = list(where)
+        page_values = dict(values)
+        if cursor:
+            page_where.append(
+                "(created_at < :cursor_created_at OR (created_at = :cursor_created_at"
+                " AND nostrrelay.events.id < :cursor_id))"
+            )
+            page_values["cursor_created_at"] = cursor.created_at
+            page_values["cursor_id"] = cursor.id
+        page_values["page_limit"] = page_limit
+
+        rows = await _fetchall_raw(
+            f"""
+            SELECT * FROM nostrrelay.events
+            {" ".join(inner_joins)}
+            WHERE { " AND ".join(page_where)}
+            ORDER BY created_at DESC, nostrrelay.events.id DESC
+            LIMIT :page_limit
+            """,
+            page_values,
+        )
+        events = [NostrEventStruct.from_row(row) for row in rows]
+        await _load_events_tags(relay_id, events)
+        for event in events:
+            yield event
+
+        count += len(events)
+        if len(events) < page_limit or (limit and count >= limit):
+            return
+        cursor = events[-1]
+        next_page_size = min(next_page_size * 2, page_size)
+
+
+async def _get_recent_events(relay_id: str) -> RecentEvents | None:
+    """The buffer of the relay, seeded on first use (`None` until then)."""
+    recent_events = _recent_events.get(relay_id)
+    if recent_events and (recent_events.ready or recent_events.is_seeding):
+        return recent_events
+    if not recent_events:
+        recent_events = _recent_events[relay_id] = RecentEvents()
+
+    generation = recent_events.start_seeding()
+    rows: list[dict] = await db.fetchall(
+        """
+        SELECT * FROM nostrrelay.events
+        WHERE relay_id = :relay_id AND deleted = false
+        ORDER BY created_at DESC, id DESC LIMIT :limit
+        """,
+        {"relay_id": relay_id, "limit": recent_events.max_count},
+    )
+    events = [NostrEventStruct.from_row(row) for row in rows]
+    await _load_events_tags(relay_id, events)
+    recent_events.seed(
+        generation, events, complete=len(events) < recent_events.max_count
+    )
+    return recent_events
+
+
+async def count_events(
+    relay_id: str,
+    nostr_filters: list[NostrFilter],
+    exclude_direct_messages: bool = False,
+) -> int:
+    """
+    NIP-45: number of events matching at least one of the filters (`limit` is
+    ignored). Only the event ids are selected, so the count can be answered
+    from the indexes. Results are cached for `COUNT_CACHE_TTL_SECONDS`.
+    """
+    selects = []
+    values: dict = {}
+    for i, nostr_filter in enumerate(nostr_filters):
+        inner_joins, where, filter_values = nostr_filter.to_sql_components(
+            relay_id, db.type
+        )
+        if exclude_direct_messages:
+            where.append("kind <> 4")
+        select = f"""
+            SELECT {"DISTINCT" if inner_joins else ""} nostrrelay.events.id
+            FROM nostrrelay.events {" ".join(inner_joins)}
+            WHERE {" AND ".join(where)}
+            """
+        if len(nostr_filters) > 1:
+            # every filter uses the same parameter names
+            select, filter_values = _prefix_params(select, filter_values, f"f{i}_")
+        selects.append(select)
+        values.update(filter_values)
+    query = f"SELECT COUNT(*) AS count FROM ({' UNION '.join(selects)}) AS matched"
+
+    key = (query, tuple((k, _hashable(v)) for k, v in sorted(values.items())))
+    count = _counts.get(key)
+    if count is None:
+        rows = await _fetchall_raw(query, values)
+        count = rows[0]["count"]
+        _counts.set(key, count)
+    return count
+
+
+def _prefix_params(sql: str, values: dict, prefix: str) -> tuple[str, dict]:
+    def rename(match: re.Match) -> str:
+        return f":{prefix}{match[1]}" if match[1] in values else match[0]
+
+    return (
+        re.sub(r":(\w+)\b", rename, sql),
+        {f"{prefix}{name}": value for name, value in values.items()},
+    )
+
+
+def _hashable(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+async def get_sync_items(
+    relay_id: str,
+    nostr_filter: NostrFilter,
+    max_count: int,
+    exclude_direct_messages: bool = False,
+) -> list[tuple[int, str]]:
+    """
+    NIP-77: the `(created_at, id)` of the events matching the filter (`limit`
+    is ignored), at most `max_count` (`0` for no limit). Only the index columns
+    are read.
+    """
+    inner_joins, where, values = nostr_filter.to_sql_components(relay_id, db.type)
+    if exclude_direct_messages:
+        where.append("kind <> 4")
+    query = f"""
+        SELECT {"DISTINCT" if inner_joins else ""} created_at, nostrrelay.events.id
+        FROM nostrrelay.events {" ".join(inner_joins)}
+        WHERE {" AND ".join(where)}
+        ORDER BY created_at, nostrrelay.events.id
+        """
+    if max_count:
+        query += " LIMIT :max_count"
+        values["max_count"] = max_count
+    rows = await _fetchall_raw(query, values)
+    return [(row["created_at"], row["id"]) for row in rows]
+
+
 async def get_event(relay_id: str, event_id: str) -> NostrEvent | None:
     event = await db.fetchone(
         "SELECT * FROM nostrrelay.events WHERE relay_id = :relay_id AND id = :id",
@@ -141,11 +383,28 @@ async def get_event(relay_id: str, event_id: str) -> NostrEvent | None:
     return event
 
 
+async def event_exists(relay_id: str, event_id: str) -> bool:
+    """Primary key lookup, the event row is not read."""
+    row: dict | None = await db.fetchone(
+        """
+        SELECT 1 AS found FROM nostrrelay.events
+        WHERE relay_id = :relay_id AND id = :id
+        """,
+        {"relay_id": relay_id, "id": event_id},
+    )
+    return row is not None
+
+
 async def get_storage_for_public_key(relay_id: str, publisher_pubkey: str) -> int:
     """
     Returns the storage space in bytes for all the events of a public key.
-    Deleted events are also counted
+    Deleted events are also counted.
+    Only the first call for a public key queries the database.
     """
+    key = (relay_id, publisher_pubkey)
+    if key in _storage_bytes:
+        return _storage_bytes[key]
+
     row: dict = await db.fetchone(
         """
         SELECT SUM(size) as sum FROM nostrrelay.events
@@ -154,45 +413,50 @@ async def get_storage_for_public_key(relay_id: str, publisher_pubkey: str) -> in
         {"relay_id": relay_id, "publisher": publisher_pubkey},
     )
 
-    if not row:
-        return 0
+    stored_bytes = round(row["sum"]) if row else 0
+    return _storage_bytes.setdefault(key, stored_bytes)
 
-    return round(row["sum"])
 
-
-async def get_prunable_events(relay_id: str, pubkey: str) -> list[tuple[str, int]]:
-    """
-    Return the oldest 10 000 events. Only the `id` and the size are returned,
-    so the data size should be small
-    """
-    events = await db.fetchall(
-        """
-        SELECT * FROM nostrrelay.events
-        WHERE relay_id = :relay_id AND pubkey = :pubkey
-        ORDER BY created_at ASC LIMIT 10000
-        """,
-        {"relay_id": relay_id, "pubkey": pubkey},
-        NostrEvent,
-    )
-
-    return [(event.id, event.size_bytes) for event in events]
+def _update_storage(relay_id: str, publisher_pubkey: str, delta_bytes: int):
+    key = (relay_id, publisher_pubkey)
+    if key in _storage_bytes:
+        _storage_bytes[key] = max(0, _storage_bytes[key] + delta_bytes)
 
 
 async def mark_events_deleted(relay_id: str, nostr_filter: NostrFilter):
+    """
+    The events are hidden, they are removed later by `compact_deleted_events()`.
+    """
     if nostr_filter.is_empty():
         return None
-    _, where, values = nostr_filter.to_sql_components(relay_id)
+    _, where, values = nostr_filter.to_sql_components(relay_id, db.type)
+    values["deleted_at"] = int(time.time())
 
-    await db.execute(
-        f"UPDATE nostrrelay.events SET deleted=true WHERE {' AND '.join(where)}",
-        values,
-    )
+    condition = " AND ".join(where)
+
+    async with db.connect() as conn:
+        await _delete_search_index(
+            conn,
+            f"event_id IN (SELECT id FROM nostrrelay.events WHERE {condition})",
+            values,
+        )
+        await _execute_uncommitted(
+            conn,
+            f"""
+            UPDATE nostrrelay.events SET deleted=true, deleted_at=:deleted_at
+            WHERE {condition}
+            """,
+            values,
+        )
+        await conn.conn.commit()
+    if relay_id in _recent_events:
+        _recent_events[relay_id].remove_matching(nostr_filter)
 
 
 async def delete_events(relay_id: str, nostr_filter: NostrFilter):
     if nostr_filter.is_empty():
         return None
-    inner_joins, where, values = nostr_filter.to_sql_components(relay_id)
+    inner_joins, where, values = nostr_filter.to_sql_components(relay_id, db.type)
 
     if inner_joins:
         # Use subquery for DELETE operations with JOINs
@@ -201,41 +465,278 @@ async def delete_events(relay_id: str, nostr_filter: NostrFilter):
             {" ".join(inner_joins)}
             WHERE {" AND ".join(where)}
         """
-        query = f"DELETE FROM nostrrelay.events WHERE id IN ({subquery})"
+        condition = f"relay_id = :relay_id AND id IN ({subquery})"
     else:
         # Simple DELETE without JOINs
-        query = f"DELETE FROM nostrrelay.events WHERE {' AND '.join(where)}"
+        condition = " AND ".join(where)
+
+    async with db.connect() as conn:
+        # selected first: the tag filters use the `event_tag_index` rows
+        deleted = await _conn_fetchall_raw(
+            conn,
+            f"SELECT id, publisher, size FROM nostrrelay.events WHERE {condition}",
+            values,
+        )
+        if deleted:
+            await _delete_relay_events(conn, relay_id, [e["id"] for e in deleted])
+            await conn.conn.commit()
+
+    for e in deleted:
+        _update_storage(relay_id, e["publisher"], -e["size"])
+    if relay_id in _recent_events:
+        _recent_events[relay_id].remove_matching(nostr_filter)
 
-    await db.execute(query, values)
-    # todo: delete tags
 
+async def prune_old_events(relay_id: str, publisher_pubkey: str, space_to_regain: int):
+    """
+    Delete just enough of the oldest events of a publisher (and their tags)
+    to regain `space_to_regain` bytes. The events are selected by the database
+    with a running sum of their size, in one transaction.
+    """
+    values = {
+        "relay_id": relay_id,
+        "publisher": publisher_pubkey,
+        "space_to_regain": space_to_regain,
+    }
+    # the events stored before an event use less than the space to regain
+    prunable = """
+        SELECT id, size FROM (
+            SELECT id, size,
+                SUM(size) OVER (ORDER BY created_at, id) - size AS size_before
+            FROM nostrrelay.events
+            WHERE relay_id = :relay_id AND publisher = :publisher
+        ) AS events_by_age
+        WHERE size_before < :space_to_regain
+    """
+    async with db.connect() as conn:
+        rows: list[dict] = await conn.fetchall(prunable, values)
+        ids = [row["id"] for row in rows]
+        if ids:
+            await _delete_relay_events(conn, relay_id, ids)
+            await conn.conn.commit()
 
-# move to services
-async def prune_old_events(relay_id: str, pubkey: str, space_to_regain: int):
-    prunable_events = await get_prunable_events(relay_id, pubkey)
-    prunable_event_ids = []
-    size = 0
+    size = sum(row["size"] for row in rows)
+    if size:
+        _update_storage(relay_id, publisher_pubkey, -size)
+    if ids and relay_id in _recent_events:
+        _recent_events[relay_id].remove_ids(ids)
 
-    for pe in prunable_events:
-        prunable_event_ids.append(pe[0])
-        size += pe[1]
 
-        if size > space_to_regain:
+async def delete_all_events(relay_id: str):
+    async with db.connect() as conn:
+        await _delete_search_index(conn, None, {"relay_id": relay_id})
+        for table in ["event_tags", "event_tag_index", "events"]:
+            await _execute_uncommitted(
+                conn,
+                f"DELETE FROM nostrrelay.{table} WHERE relay_id = :relay_id",
+                {"relay_id": relay_id},
+            )
+        await conn.conn.commit()
+    for key in [k for k in _storage_bytes if k[0] == relay_id]:
+        del _storage_bytes[key]
+    if relay_id in _recent_events:
+        _recent_events[relay_id].invalidate()
+
+
+async def compact_deleted_events(
+    deleted_before: int, batch_size: int = COMPACTION_BATCH_SIZE
+) -> NostrCompactionStats:
+    """
+    Remove the events marked as deleted before `deleted_before` (unix time),
+    with their tags. The work is done in batches, each batch in its own
+    transaction, so the relays can write in between.
+    """
+    stats = NostrCompactionStats()
+    while True:
+        rows: list[dict] = await db.fetchall(
+            """
+            SELECT relay_id, id, publisher, size FROM nostrrelay.events
+            WHERE deleted_at < :deleted_before LIMIT :batch_size
+            """,
+            {"deleted_before": deleted_before, "batch_size": batch_size},
+        )
+        events_by_relay: dict[str, list[str]] = {}
+        for row in rows:
+            events_by_relay.setdefault(row["relay_id"], []).append(row["id"])
+        tags_count, events_count = await _delete_events_by_ids(events_by_relay)
+
+        stats.tags += tags_count
+        stats.events += events_count
+        for row in rows:
+            stats.bytes += row["size"]
+            _update_storage(row["relay_id"], row["publisher"], -row["size"])
+        if len(rows) < batch_size:
             break
 
-    await delete_events(relay_id, NostrFilter(ids=prunable_event_ids))
+    return stats
+
+
+async def _delete_events_by_ids(ids_by_relay: dict[str, list[str]]) -> tuple[int, int]:
+    """Delete the events and their tags. Returns the deleted tags and events."""
+    tags_count, events_count = 0, 0
+    if not ids_by_relay:
+        return tags_count, events_count
+    async with db.connect() as conn:
+        for relay_id, ids in ids_by_relay.items():
+            relay_tags_count, relay_events_count = await _delete_relay_events(
+                conn, relay_id, ids
+            )
+            tags_count += relay_tags_count
+            events_count += relay_events_count
+        await conn.conn.commit()
+    return tags_count, events_count
+
+
+async def _delete_relay_events(
+    conn: Connection, relay_id: str, ids: list[str]
+) -> tuple[int, int]:
+    """Same as `_delete_events_by_ids()`, the commit is left to the caller."""
+    values = {"relay_id": relay_id}
+    in_list = sql_in_list("event_id", "id", ids, db.type, values)
+    result = await _execute_uncommitted(
+        conn,
+        f"DELETE FROM nostrrelay.event_tags WHERE relay_id = :relay_id AND {in_list}",
+        values,
+    )
+    tags_count = result.rowcount
+    await _execute_uncommitted(
+        conn,
+        "DELETE FROM nostrrelay.event_tag_index "
+        f"WHERE relay_id = :relay_id AND {in_list}",
+        values,
+    )
+    await _delete_search_index(conn, in_list, values)
 
+    values = {"relay_id": relay_id}
+    in_list = sql_in_list("id", "id", ids, db.type, values)
+    result = await _execute_uncommitted(
+        conn,
+        f"DELETE FROM nostrrelay.events WHERE relay_id = :relay_id AND {in_list}",
+        values,
+    )
+    return tags_count, result.rowcount
 
-async def delete_all_events(relay_id: str):
-    await db.execute(
-        "DELETE from nostrrelay.events WHERE relay_id = :id",
-        {"id": relay_id},
+
+def _event_tag_values(tag: list[str]) -> dict:
+    name, value, *rest = tag
+    return {"name": name, "value": value, "extra": json.dumps(rest) if rest else None}
+
+
+async def _insert_event_tags(
+    conn: Connection, relay_id: str, event_id: str, tags: list[dict]
+):
+    """Multi-row insert for the tags of one event."""
+    rows = []
+    values: dict = {"relay_id": relay_id, "event_id": event_id}
+    for i, tag in enumerate(tags):
+        rows.append(f"(:relay_id, :event_id, :name_{i}, :value_{i}, :extra_{i})")
+        values.update({f"{k}_{i}": v for k, v in tag.items()})
+
+    await _execute_uncommitted(
+        conn,
+        f"""
+        INSERT INTO nostrrelay.event_tags (relay_id, event_id, name, value, extra)
+        VALUES {", ".join(rows)}
+        """,
+        values,
     )
-    # todo: delete tags
 
 
-async def create_event_tags(tag: NostrEventTags):
-    await db.insert("nostrrelay.event_tags", tag)
+async def _insert_tag_index(
+    conn: Connection, relay_id: str, event_id: str, tags: list[tuple[str, str]]
+):
+    """Multi-row insert of distinct `(name, value)` tags of one event."""
+    rows = []
+    values: dict = {"relay_id": relay_id, "event_id": event_id}
+    for i, (name, value) in enumerate(tags):
+        rows.append(f"(:relay_id, :name_{i}, :value_{i}, :event_id)")
+        values.update({f"name_{i}": name, f"value_{i}": value})
+
+    await _execute_uncommitted(
+        conn,
+        f"""
+        INSERT INTO nostrrelay.event_tag_index (relay_id, name, value, event_id)
+        VALUES {", ".join(rows)}
+        """,
+        values,
+    )
+
+
+async def _insert_search_index(conn: Connection, event: NostrEvent):
+    """SQLite only, Postgres indexes the `events` table directly."""
+    values = {"relay_id": event.relay_id, "event_id": event.id}
+    await _execute_uncommitted(
+        conn,
+        """
+        INSERT INTO nostrrelay.events_search_ids (relay_id, event_id)
+        VALUES (:relay_id, :event_id)
+        """,
+        values,
+    )
+    await _execute_uncommitted(
+        conn,
+        """
+        INSERT INTO nostrrelay.events_search (rowid, content)
+        SELECT id, :content FROM nostrrelay.events_search_ids
+        WHERE relay_id = :relay_id AND event_id = :event_id
+        """,
+        {**values, "content": event.content},
+    )
+
+
+async def _delete_search_index(
+    conn: Connection, event_id_condition: str | None, values: dict
+):
+    """
+    SQLite only: remove the events of `:relay_id` that match the condition
+    (on the `event_id` column) from the search index, all if `None`.
+    """
+    if db.type != SQLITE:
+        return
+    where = "relay_id = :relay_id"
+    if event_id_condition:
+        where += f" AND {event_id_condition}"
+    await _execute_uncommitted(
+        conn,
+        f"""
+        DELETE FROM nostrrelay.events_search WHERE rowid IN (
+            SELECT id FROM nostrrelay.events_search_ids WHERE {where}
+        )
+        """,
+        values,
+    )
+    await _execute_uncommitted(
+        conn, f"DELETE FROM nostrrelay.events_search_ids WHERE {where}", values
+    )
+
+
+async def _execute_uncommitted(conn: Connection, query: str, values: dict):
+    """
+    Same as `conn.execute()`, but the commit is left to the caller.
+    Used to group several statements in one transaction.
+    The values are bound as they are, like `Connection.insert()` does:
+    `conn.rewrite_values()` strips HTML from strings, which would change the
+    stored content and tags (and break the event id and signature).
+    """
+    return await conn.conn.execute(text(query), values)
+
+
+async def _conn_fetchall_raw(conn: Connection, query: str, values: dict) -> list:
+    """
+    Same as `conn.fetchall()`, with the values bound as they are (see
+    `_execute_uncommitted()`): the filter values are compared to the raw
+    stored tags.
+    """
+    result = await _execute_uncommitted(conn, query, values)
+    rows = result.mappings().all()
+    result.close()
+    return rows
+
+
+async def _fetchall_raw(query: str, values: dict) -> list:
+    """Same as `db.fetchall()`, see `_conn_fetchall_raw()`."""
+    async with db.connect() as conn:
+        return await _conn_fetchall_raw(conn, query, values)
 
 
 async def get_event_tags(relay_id: str, event_id: str) -> list[list[str]]:
@@ -248,18 +749,44 @@ async def get_event_tags(relay_id: str, event_id: str) -> list[list[str]]:
         model=NostrEventTags,
     )
 
-    tags: list[list[str]] = []
-    for tag in _tags:
-        _tag = [tag.name, tag.value]
-        if tag.extra:
-            _tag += json.loads(tag.extra)
-        tags.append(_tag)
+    return [_nostr_tag(tag) for tag in _tags]
+
+
+async def _load_events_tags(
+    relay_id: str, events: Sequence[NostrEvent | NostrEventStruct]
+):
+    """Load the tags for a list of events (one query per batch, not per event)."""
+    for i in range(0, len(events), TAGS_SELECT_BATCH_SIZE):
+        batch = {e.id: e for e in events[i : i + TAGS_SELECT_BATCH_SIZE]}
+        values: dict = {"relay_id": relay_id}
+        in_list = sql_in_list("event_id", "event_id", list(batch), db.type, values)
+
+        _tags = await db.fetchall(
+            f"""
+            SELECT * FROM nostrrelay.event_tags
+            WHERE relay_id = :relay_id AND {in_list}
+            """,
+            values,
+            model=NostrEventTags,
+        )
+
+        tags: dict[str, list[list[str]]] = {event_id: [] for event_id in batch}
+        for tag in _tags:
+            tags[tag.event_id].append(_nostr_tag(tag))
+        for event_id, event in batch.items():
+            event.tags = tags[event_id]
+
 
-    return tags
+def _nostr_tag(tag: NostrEventTags) -> list[str]:
+    _tag = [tag.name, tag.value]
+    if tag.extra:
+        _tag += json.loads(tag.extra)
+    return _tag
 
 
 async def create_account(account: NostrAccount) -> NostrAccount:
     await db.insert("nostrrelay.accounts", account)
+    _accounts.pop((account.relay_id, account.pubkey))
     return account
 
 
@@ -269,6 +796,7 @@ async def update_account(account: NostrAccount) -> NostrAccount:
         account,
         "WHERE relay_id = :relay_id AND pubkey = :pubkey",
     )
+    _accounts.pop((account.relay_id, account.pubkey))
     return account
 
 
@@ -280,20 +808,27 @@ async def delete_account(relay_id: str, pubkey: str):
         """,
         {"id": relay_id, "pubkey": pubkey},
     )
+    _accounts.pop((relay_id, pubkey))
 
 
 async def get_account(
     relay_id: str,
     pubkey: str,
 ) -> NostrAccount | None:
-    return await db.fetchone(
-        """
-        SELECT * FROM nostrrelay.accounts
-        WHERE relay_id = :id AND pubkey = :pubkey
-        """,
-        {"id": relay_id, "pubkey": pubkey},
-        NostrAccount,
-    )
+    account = _accounts.get((relay_id, pubkey), _NOT_CACHED)
+    if account is _NOT_CACHED:
+        account = await db.fetchone(
+            """
+            SELECT * FROM nostrrelay.accounts
+            WHERE relay_id = :id AND pubkey = :pubkey
+            """,
+            {"id": relay_id, "pubkey": pubkey},
+            NostrAccount,
+        )
+        _accounts.set((relay_id, pubkey), account)
+
+    # callers can change the returned account, the cached one must stay as is
+    return account.copy() if account else None
 
 
 async def get_accounts(
@@ -1,8 +1,18 @@
+import json
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Any
 from urllib.parse import urlparse
 
 from bech32 import bech32_decode, convertbits
 from starlette.responses import JSONResponse
 
+try:
+    from orjson import dumps as _orjson_dumps
+except ImportError:  # orjson is optional, the stdlib encoder is used instead
+    _orjson_dumps = None  # type: ignore
+
 
 def normalize_public_key(pubkey: str) -> str:
     if pubkey.startswith("npub1"):
@@ -22,6 +32,21 @@ def normalize_public_key(pubkey: str) -> str:
     return pubkey
 
 
+def json_dumps(data: Any) -> str:
+    """
+    Compact JSON, without escaping non-ASCII characters. This is the NIP-01
+    serialization of the event commitment and it is also used on the wire.
+    Encoded with orjson when it is installed, the output is the same.
+    """
+    if _orjson_dumps is not None:
+        try:
+            return _orjson_dumps(data).decode()
+        except TypeError:
+            # integers over 64 bits, invalid unicode: let the stdlib decide
+            pass
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
 def extract_domain(url: str) -> str:
     return urlparse(url).netloc
 
@@ -35,3 +60,47 @@ def relay_info_response(relay_public_data: dict) -> JSONResponse:
             "Access-Control-Allow-Methods": "GET",
         },
     )
+
+
+class LRUCache:
+    """
+    In-memory cache that keeps at most `maxsize` entries (least recently used
+    are evicted first). If `ttl` (seconds) is set, then older entries expire.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        created_at, value = entry
+        if self.ttl and time.monotonic() - created_at > self.ttl:
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+_MISSING = object()
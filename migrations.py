@@ -1,3 +1,12 @@
+import hashlib
+import json
+import time
+from itertools import groupby
+
+import sqlalchemy
+from lnbits.db import SQLITE
+
+
 async def m001_initial(db):
     """
     Initial nostrrelays tables.
@@ -62,3 +71,303 @@ async def m001_initial(db):
         );
         """
     )
+
+
+async def m002_add_event_indexes(db):
+    """
+    Indexes for the filter queries, the tags lookup and the storage accounting.
+    """
+
+    indexes = {
+        # tag filters (`#e`, `#p`, `#d`)
+        "event_tags_name_value_idx": "event_tags (relay_id, name, value, event_id)",
+        # load the tags of an event and join the tags to the events
+        "event_tags_event_idx": "event_tags (relay_id, event_id)",
+        # `authors` (and `kinds`) filters, newest first
+        "events_pubkey_kind_idx": "events (relay_id, pubkey, kind, created_at)",
+        # `kinds` filters, newest first
+        "events_kind_idx": "events (relay_id, kind, created_at)",
+        # filters without `authors` or `kinds`, newest first
+        "events_created_at_idx": "events (relay_id, created_at)",
+        # storage used by a publisher and pruning of its oldest events
+        "events_publisher_idx": "events (relay_id, publisher, created_at)",
+    }
+    for index_name, table_columns in indexes.items():
+        if db.type == SQLITE:
+            # SQLite expects the schema on the index name, not on the table name
+            await db.execute(
+                f"CREATE INDEX IF NOT EXISTS nostrrelay.{index_name} "
+                f"ON {table_columns}"
+            )
+        else:
+            await db.execute(
+                f"CREATE INDEX IF NOT EXISTS {index_name} "
+                f"ON nostrrelay.{table_columns}"
+            )
+
+
+async def m003_backfill_event_size(db):
+    """
+    The `size` of the events was not stored until now. Compute it (same as
+    `NostrEvent.size_bytes`) for the existing events, it is used for the
+    storage accounting.
+    """
+
+    cursor = {"relay_id": "", "id": ""}
+    while True:
+        events = await db.fetchall(
+            """
+            SELECT * FROM nostrrelay.events
+            WHERE size = 0 AND (relay_id > :relay_id
+                OR (relay_id = :relay_id AND id > :id))
+            ORDER BY relay_id, id LIMIT 500
+            """,
+            cursor,
+        )
+        if not events:
+            break
+
+        # one tags query and one UPDATE per relay of the page
+        for relay_id, group in groupby(events, key=lambda e: e["relay_id"]):
+            relay_events = list(group)
+            values = {"relay_id": relay_id}
+            values.update({f"id_{i}": e["id"] for i, e in enumerate(relay_events)})
+            in_list = ", ".join(f":id_{i}" for i in range(len(relay_events)))
+
+            tags = {}
+            for t in await db.fetchall(
+                f"""
+                SELECT * FROM nostrrelay.event_tags
+                WHERE relay_id = :relay_id AND event_id IN ({in_list})
+                """,
+                values,
+            ):
+                tags.setdefault(t["event_id"], []).append(
+                    [t["name"], t["value"], *json.loads(t["extra"] or "[]")]
+                )
+
+            cases = []
+            for i, event in enumerate(relay_events):
+                nostr_event = {
+                    "id": event["id"],
+                    "pubkey": event["pubkey"],
+                    "created_at": event["created_at"],
+                    "kind": event["kind"],
+                    "tags": tags.get(event["id"], []),
+                    "content": event["content"],
+                    "sig": event["sig"],
+                }
+                size = len(
+                    json.dumps(
+                        nostr_event, separators=(",", ":"), ensure_ascii=False
+                    ).encode()
+                )
+                cases.append(f"WHEN :id_{i} THEN {size}")
+            await db.conn.execute(
+                sqlalchemy.text(
+                    f"""
+                    UPDATE nostrrelay.events SET size = CASE id {" ".join(cases)}
+                    END WHERE relay_id = :relay_id AND id IN ({in_list})
+                    """
+                ),
+                values,
+            )
+
+        cursor = {"relay_id": events[-1]["relay_id"], "id": events[-1]["id"]}
+    await db.conn.commit()
+
+
+async def m004_add_event_deleted_at(db):
+    """
+    Time when an event was marked as deleted. The compaction task removes the
+    deleted events once their retention time has passed.
+    """
+
+    await db.execute(
+        f"ALTER TABLE nostrrelay.events ADD COLUMN deleted_at {db.big_int}"
+    )
+    # the retention of the events deleted before this migration starts now
+    await db.execute(
+        "UPDATE nostrrelay.events SET deleted_at = :now WHERE deleted = true",
+        {"now": int(time.time())},
+    )
+    # partial index, only the deleted events are in it
+    if db.type == SQLITE:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS nostrrelay.events_deleted_at_idx "
+            "ON events (deleted_at) WHERE deleted_at IS NOT NULL"
+        )
+    else:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS events_deleted_at_idx "
+            "ON nostrrelay.events (deleted_at) WHERE deleted_at IS NOT NULL"
+        )
+
+
+async def m005_add_event_search(db):
+    """
+    Full-text search of the event content (NIP-50).
+    SQLite: FTS5 table, its rows are linked to the events by `events_search_ids`.
+    Postgres: GIN index on the `tsvector` of the content.
+    Direct messages (encrypted) and events without content are not indexed.
+    """
+
+    if db.type != SQLITE:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS events_content_search_idx "
+            "ON nostrrelay.events USING GIN (to_tsvector('simple', content))"
+        )
+        return
+
+    await db.execute(
+        """
+        CREATE TABLE nostrrelay.events_search_ids (
+            id INTEGER PRIMARY KEY,
+            relay_id TEXT NOT NULL,
+            event_id TEXT NOT NULL
+        );
+        """
+    )
+    await db.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS nostrrelay.events_search_ids_event_idx "
+        "ON events_search_ids (relay_id, event_id)"
+    )
+    await db.execute(
+        """
+        CREATE VIRTUAL TABLE nostrrelay.events_search
+        USING fts5(content, tokenize = 'unicode61 remove_diacritics 2');
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO nostrrelay.events_search_ids (relay_id, event_id)
+        SELECT relay_id, id FROM nostrrelay.events
+        WHERE deleted = false AND kind <> 4 AND content <> ''
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO nostrrelay.events_search (rowid, content)
+        SELECT search_ids.id, nostrrelay.events.content
+        FROM nostrrelay.events_search_ids search_ids
+        INNER JOIN nostrrelay.events
+        ON nostrrelay.events.relay_id = search_ids.relay_id
+        AND nostrrelay.events.id = search_ids.event_id
+        """
+    )
+
+
+async def m006_add_event_tag_index(db):
+    """
+    Index of the single-letter tags (NIP-01 `#<letter>` filters), one row per
+    distinct `(name, value)` of an event, the long values by their hash.
+    It replaces the `event_tags` index used by the `#e`, `#p` and `#d` filters.
+    """
+
+    await db.execute(
+        f"""
+        CREATE TABLE nostrrelay.event_tag_index (
+            relay_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            event_id TEXT NOT NULL,
+            PRIMARY KEY (relay_id, name, value, event_id)
+        ) {"WITHOUT ROWID" if db.type == SQLITE else ""};
+        """
+    )
+    if db.type == SQLITE:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS nostrrelay.event_tag_index_event_idx "
+            "ON event_tag_index (relay_id, event_id)"
+        )
+    else:
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS event_tag_index_event_idx "
+            "ON nostrrelay.event_tag_index (relay_id, event_id)"
+        )
+    # same limit as `relay.filter.TAG_INDEX_MAX_VALUE_LENGTH`
+    await db.execute(
+        """
+        INSERT INTO nostrrelay.event_tag_index (relay_id, name, value, event_id)
+        SELECT DISTINCT relay_id, name, value, event_id FROM nostrrelay.event_tags
+        WHERE LENGTH(name) = 1 AND LENGTH(value) <= 512
+        """
+    )
+    # the longer values are indexed by their hash (`relay.filter.tag_index_value`)
+    long_tags = await db.fetchall(
+        """
+        SELECT DISTINCT relay_id, name, value, event_id FROM nostrrelay.event_tags
+        WHERE LENGTH(name) = 1 AND LENGTH(value) > 512
+        """
+    )
+    for start in range(0, len(long_tags), 200):
+        rows = []
+        values = {}
+        for i, tag in enumerate(long_tags[start : start + 200]):
+            rows.append(f"(:relay_id_{i}, :name_{i}, :value_{i}, :event_id_{i})")
+            values.update(
+                {
+                    f"relay_id_{i}": tag["relay_id"],
+                    f"name_{i}": tag["name"],
+                    f"value_{i}": "sha256:"
+                    + hashlib.sha256(tag["value"].encode()).hexdigest(),
+                    f"event_id_{i}": tag["event_id"],
+                }
+            )
+        await db.execute(
+            f"""
+            INSERT INTO nostrrelay.event_tag_index (relay_id, name, value, event_id)
+            VALUES {", ".join(rows)}
+            """,
+            values,
+        )
+    await db.execute("DROP INDEX IF EXISTS nostrrelay.event_tags_name_value_idx")
+
+
+async def m007_delete_orphaned_tags(db):
+    """
+    Tags (and tag index rows) left without an event by the delete paths that
+    did not remove the tags. Every delete path removes them now.
+    The tables are read in pages of 500 events, so every DELETE is bounded.
+    """
+
+    for table in ["event_tags", "event_tag_index"]:
+        cursor = {"relay_id": "", "event_id": ""}
+        while True:
+            page = await db.fetchall(
+                f"""
+                SELECT DISTINCT relay_id, event_id FROM nostrrelay.{table}
+                WHERE relay_id > :relay_id
+                    OR (relay_id = :relay_id AND event_id > :event_id)
+                ORDER BY relay_id, event_id LIMIT 500
+                """,
+                cursor,
+            )
+            if not page:
+                break
+
+            values = {
+                "relay_id": cursor["relay_id"],
+                "event_id": cursor["event_id"],
+                "last_relay_id": page[-1]["relay_id"],
+                "last_event_id": page[-1]["event_id"],
+            }
+            await db.execute(
+                f"""
+                DELETE FROM nostrrelay.{table}
+                WHERE (relay_id > :relay_id
+                    OR (relay_id = :relay_id AND event_id > :event_id))
+                AND (relay_id < :last_relay_id
+                    OR (relay_id = :last_relay_id AND event_id <= :last_event_id))
+                AND NOT EXISTS (
+                    SELECT 1 FROM nostrrelay.events
+                    WHERE nostrrelay.events.relay_id = {table}.relay_id
+                    AND nostrrelay.events.id = {table}.event_id
+                )
+                """,
+                values,
+            )
+            cursor = {
+                "relay_id": page[-1]["relay_id"],
+                "event_id": page[-1]["event_id"],
+            }
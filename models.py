@@ -37,6 +37,14 @@ class NostrAccount(BaseModel):
         return NostrAccount(pubkey="", relay_id="")
 
 
+class NostrCompactionStats(BaseModel):
+    """Rows removed by a compaction run and the size of the removed events."""
+
+    events: int = 0
+    tags: int = 0
+    bytes: int = 0
+
+
 class NostrEventTags(BaseModel):
     relay_id: str
     event_id: str
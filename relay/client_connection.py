@@ -1,6 +1,8 @@
+import asyncio
 import json
 import time
-from collections.abc import Awaitable, Callable
+from collections import deque
+from collections.abc import AsyncIterator, Awaitable, Callable
 from typing import Any
 
 from fastapi import WebSocket
@@ -9,17 +11,60 @@ from loguru import logger
 
 from ..crud import (
     NostrAccount,
+    count_events,
     create_event,
     delete_events,
+    event_exists,
     get_account,
     get_event,
     get_events,
+    get_sync_items,
     mark_events_deleted,
+    stream_events,
 )
-from .event import NostrEvent, NostrEventType
+from ..helpers import json_dumps
+from .event import BaseNostrEvent, NostrEventStruct, NostrEventType
 from .event_validator import EventValidator
 from .filter import NostrFilter
+from .negentropy import Negentropy, NegentropyStorage
 from .relay import RelaySpec
+from .send_stats import NostrSendStats
+
+# max time to wait for the last NOTICE to be sent before closing the socket
+STOP_NOTICE_TIMEOUT_SECONDS = 5
+# REQs of one connection that query the database at the same time
+MAX_CONCURRENT_REQUESTS = 8
+# received messages of one connection that are not processed yet, when the
+# limit is reached the next frame is read only after one of them is done
+MAX_PENDING_MESSAGES = 256
+# max number of queued messages written by one pass of the writer task
+WRITE_BATCH_MAX_MESSAGES = 64
+# NIP-01: subscription ids are non-empty strings of at most 64 chars
+MAX_SUBSCRIPTION_ID_LENGTH = 64
+# max size of a NIP-77 message (before the hex encoding)
+NEGENTROPY_FRAME_SIZE_LIMIT = 256 * 1024
+
+
+class _Outbox(asyncio.Queue[tuple[str, int, float, bool]]):
+    """
+    Messages to send (already JSON encoded), their size in bytes, the time
+    they were queued and whether they are a broadcast event (can be dropped).
+    """
+
+    def _init(self, maxsize: int):
+        # same storage as `asyncio.Queue`, typed for `drop_oldest_event()`
+        self._queue: deque[tuple[str, int, float, bool]] = deque()
+
+    def drop_oldest_event(self) -> bool:
+        """
+        Remove the oldest broadcast event. The responses to the client's own
+        messages (OK, EOSE, CLOSED, COUNT, ...) are never dropped.
+        """
+        for i, (_, _, _, is_event) in enumerate(self._queue):
+            if is_event:
+                del self._queue[i]
+                return True
+        return False
 
 
 class NostrClientConnection:
@@ -34,27 +79,55 @@ class NostrClientConnection:
         self.event_validator = EventValidator(self.relay_id)
 
         self.broadcast_event: (
-            Callable[[NostrClientConnection, NostrEvent], Awaitable[None]] | None
+            Callable[[NostrClientConnection, BaseNostrEvent], Awaitable[None]] | None
         ) = None
         self.get_client_config: Callable[[], RelaySpec] | None = None
+        self.add_subscription: (
+            Callable[[NostrClientConnection, NostrFilter], None] | None
+        ) = None
+        self.remove_subscription: Callable[[NostrFilter], None] | None = None
+
+        # outbound messages are queued and written by a dedicated task
+        self._outbox: _Outbox | None = None
+        self._writer_task: asyncio.Task | None = None
+        self._stop_task: asyncio.Task | None = None
+        self._closed = False
+        self.send_stats = NostrSendStats()
+
+        # inbound messages are processed by tasks, see `_dispatch_message`
+        self._tasks: set[asyncio.Task] = set()
+        self._requests: dict[str, asyncio.Task] = {}
+        self._last_event_task: asyncio.Task | None = None
+        self._pending_slots = asyncio.Semaphore(MAX_PENDING_MESSAGES)
+        self._request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        # NIP-77 sync sessions, by subscription id
+        self._negentropy_sessions: dict[str, Negentropy] = {}
 
     async def start(self):
         await self.websocket.accept()
-        while True:
-            json_data = await self.websocket.receive_text()
-            try:
-                data = json.loads(json_data)
-
-                resp = await self._handle_message(data)
-                for r in resp:
-                    await self._send_msg(r)
-            except Exception as e:
-                logger.warning(e)
+        self._writer_task = asyncio.create_task(self._write_messages())
+        try:
+            while True:
+                json_data = await self.websocket.receive_text()
+                try:
+                    data = json.loads(json_data)
+                    await self._dispatch_message(data)
+                except Exception as e:
+                    logger.warning(e)
+        finally:
+            self._cancel_tasks()
+            self._stop_writer()
 
     async def stop(self, reason: str | None):
+        self._closed = True
+        self._cancel_tasks()
+        self._stop_writer()
         message = reason if reason else "Server closed webocket"
         try:
-            await self._send_msg(["NOTICE", message])
+            await asyncio.wait_for(
+                self.websocket.send_text(json_dumps(["NOTICE", message])),
+                STOP_NOTICE_TIMEOUT_SECONDS,
+            )
         except Exception:
             pass
 
@@ -63,23 +136,35 @@ class NostrClientConnection:
         except Exception:
             pass
 
-    def init_callbacks(self, broadcast_event: Callable, get_client_config: Callable):
+    def init_callbacks(
+        self,
+        broadcast_event: Callable,
+        get_client_config: Callable,
+        add_subscription: Callable | None = None,
+        remove_subscription: Callable | None = None,
+    ):
         self.broadcast_event = broadcast_event
         self.get_client_config = get_client_config
         self.event_validator.get_client_config = get_client_config
+        self.add_subscription = add_subscription
+        self.remove_subscription = remove_subscription
 
-    async def notify_event(self, event: NostrEvent) -> bool:
+    def notify_event(self, event: BaseNostrEvent, nostr_filter: NostrFilter) -> bool:
+        """
+        Queue an event that is already known to match `nostr_filter`.
+        The matching itself is done by the relay wide subscription index.
+        It never waits for the network, a slow client cannot delay the others.
+        """
         if self._is_direct_message_for_other(event):
             return False
 
-        for nostr_filter in self.filters:
-            if nostr_filter.matches(event):
-                resp = event.serialize_response(nostr_filter.subscription_id)
-                await self._send_msg(resp)
-                return True
-        return False
+        resp = event.serialize_response_json(nostr_filter.subscription_id or "")
+        # the event JSON is encoded once for all subscribers (`size_bytes`),
+        # only the frame prefix is measured here
+        prefix = resp[: len(resp) - len(event.nostr_json) - 1]
+        return self._enqueue_msg(resp, _utf8_size(prefix) + event.size_bytes + 1)
 
-    def _is_direct_message_for_other(self, event: NostrEvent) -> bool:
+    def _is_direct_message_for_other(self, event: BaseNostrEvent) -> bool:
         """
         Direct messages are not inteded to be boradcast (even if encrypted).
         If the server requires AUTH for kind '4' then direct message will be
@@ -95,10 +180,99 @@ class NostrClientConnection:
             return False
         return True
 
-    async def _broadcast_event(self, e: NostrEvent):
+    async def _broadcast_event(self, e: BaseNostrEvent):
         if self.broadcast_event:
             await self.broadcast_event(self, e)
 
+    async def _dispatch_message(self, data: list):
+        """
+        EVENTs are handled one after the other, in the order they are received.
+        REQs, COUNTs and NEG-OPENs run concurrently (at most
+        `MAX_CONCURRENT_REQUESTS`), each one after the EVENTs received before it.
+        Other messages are handled inline, so a CLOSE can cancel a REQ that is
+        still running.
+        """
+        if not isinstance(data, list) or len(data) < 2:
+            return
+
+        message_type = data[0]
+        if message_type not in [
+            NostrEventType.EVENT,
+            NostrEventType.REQ,
+            NostrEventType.COUNT,
+            NostrEventType.NEG_OPEN,
+        ]:
+            await self._process_message(data)
+            return
+
+        subscription_id = data[1]
+        if message_type != NostrEventType.EVENT and not (
+            isinstance(subscription_id, str)
+            and 0 < len(subscription_id) <= MAX_SUBSCRIPTION_ID_LENGTH
+        ):
+            await self._send_msg(["NOTICE", "invalid: subscription id"])
+            return
+
+        await self._pending_slots.acquire()
+        previous_event = self._last_event_task
+        if message_type == NostrEventType.EVENT:
+            task = self._create_task(self._process_message(data, previous_event))
+            self._last_event_task = task
+            return
+
+        self._cancel_request(subscription_id)
+        task = self._create_task(
+            self._process_message(data, previous_event, self._request_slots)
+        )
+        self._requests[subscription_id] = task
+
+        def done(t: asyncio.Task):
+            if self._requests.get(subscription_id) is t:
+                del self._requests[subscription_id]
+
+        task.add_done_callback(done)
+
+    async def _process_message(
+        self,
+        data: list,
+        wait_for: asyncio.Task | None = None,
+        slots: asyncio.Semaphore | None = None,
+    ):
+        try:
+            if wait_for:
+                await asyncio.wait([wait_for])
+            if slots:
+                async with slots:
+                    resp = await self._handle_message(data)
+            else:
+                resp = await self._handle_message(data)
+            for r in resp:
+                await self._send_msg(r)
+        except Exception as e:
+            logger.warning(e)
+
+    def _create_task(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+
+        def done(t: asyncio.Task):
+            self._tasks.discard(t)
+            self._pending_slots.release()
+
+        task.add_done_callback(done)
+        return task
+
+    def _cancel_request(self, subscription_id: str):
+        task = self._requests.pop(subscription_id, None)
+        if task:
+            task.cancel()
+
+    def _cancel_tasks(self):
+        for task in list(self._tasks):
+            task.cancel()
+        self._requests.clear()
+        self._last_event_task = None
+
     async def _handle_message(self, data: list) -> list:
         if len(data) < 2:
             return []
@@ -106,27 +280,27 @@ class NostrClientConnection:
         message_type = data[0]
 
         if message_type == NostrEventType.EVENT:
-            event_dict = {
-                "relay_id": self.relay_id,
-                "publisher": data[1]["pubkey"],
-                **data[1],
-            }
-
-            event = NostrEvent(**event_dict)
-            await self._handle_event(event)
+            await self._handle_event(NostrEventStruct.parse(data[1]))
             return []
         if message_type == NostrEventType.REQ:
             if len(data) < 3:
                 return []
             subscription_id = data[1]
-            # Handle multiple filters in REQ message
-            responses = []
-            for filter_data in data[2:]:
-                response = await self._handle_request(
-                    subscription_id, NostrFilter.parse_obj(filter_data)
-                )
-                responses.extend(response)
-            return responses
+            nostr_filters = [NostrFilter.parse_obj(f) for f in data[2:]]
+            async for message in self._handle_request(subscription_id, nostr_filters):
+                await self._send_msg(message)
+            return []
+        if message_type == NostrEventType.COUNT:
+            if len(data) < 3:
+                return []
+            nostr_filters = [NostrFilter.parse_obj(f) for f in data[2:]]
+            return [await self._handle_count(data[1], nostr_filters)]
+        if message_type in [
+            NostrEventType.NEG_OPEN,
+            NostrEventType.NEG_MSG,
+            NostrEventType.NEG_CLOSE,
+        ]:
+            return await self._handle_negentropy(data)
         if message_type == NostrEventType.CLOSE:
             self._handle_close(data[1])
         if message_type == NostrEventType.AUTH:
@@ -134,12 +308,12 @@ class NostrClientConnection:
 
         return []
 
-    async def _handle_event(self, e: NostrEvent):
+    async def _handle_event(self, e: NostrEventStruct):
         logger.info(f"nostr event: [{e.kind}, {e.pubkey}, '{e.content}']")
         resp_nip20: list[Any] = ["OK", e.id]
 
         if e.is_auth_response_event:
-            valid, message = self.event_validator.validate_auth_event(
+            valid, message = await self.event_validator.validate_auth_event(
                 e, self._auth_challenge
             )
             if not valid:
@@ -157,6 +331,17 @@ class NostrClientConnection:
             await self._send_msg(resp_nip20)
             return None
 
+        valid, message = await self.event_validator.validate_event(e)
+        if not valid:
+            resp_nip20 += [valid, message]
+            await self._send_msg(resp_nip20)
+            return None
+
+        if not e.is_ephemeral_event and await event_exists(self.relay_id, e.id):
+            resp_nip20 += [True, "duplicate: already have this event"]
+            await self._send_msg(resp_nip20)
+            return None
+
         publisher_pubkey = self.auth_pubkey if self.auth_pubkey else e.pubkey
         valid, message = await self.event_validator.validate_write(e, publisher_pubkey)
         if not valid:
@@ -164,26 +349,14 @@ class NostrClientConnection:
             await self._send_msg(resp_nip20)
             return None
         try:
-            if e.is_replaceable_event:
-                await delete_events(
-                    self.relay_id,
-                    NostrFilter(kinds=[e.kind], authors=[e.pubkey], until=e.created_at),
-                )
-            if e.is_addressable_event:
-                # Extract 'd' tag value for addressable replacement (NIP-01)
-                d_tag_value = next((t[1] for t in e.tags if t[0] == "d"), None)
-
-                if d_tag_value:
-                    deletion_filter = NostrFilter(
-                        kinds=[e.kind],
-                        authors=[e.pubkey],
-                        **{"#d": [d_tag_value]},  # type: ignore
-                        until=e.created_at,
-                    )
-
-                    await delete_events(self.relay_id, deletion_filter)
-            if not e.is_ephemeral_event:
-                await create_event(e)
+            await self._delete_replaced_events(e)
+            if not e.is_ephemeral_event and not await create_event(
+                e.to_model(self.relay_id, e.pubkey)
+            ):
+                # stored meanwhile by another connection
+                resp_nip20 += [True, "duplicate: already have this event"]
+                await self._send_msg(resp_nip20)
+                return None
             await self._broadcast_event(e)
 
             if e.is_delete_event:
@@ -198,16 +371,105 @@ class NostrClientConnection:
 
         await self._send_msg(resp_nip20)
 
+    async def _delete_replaced_events(self, e: NostrEventStruct):
+        if e.is_replaceable_event:
+            await delete_events(
+                self.relay_id,
+                NostrFilter(kinds=[e.kind], authors=[e.pubkey], until=e.created_at),
+            )
+        if e.is_addressable_event:
+            # Extract 'd' tag value for addressable replacement (NIP-01)
+            d_tag_value = next((t[1] for t in e.tags if t[0] == "d"), None)
+
+            if d_tag_value:
+                deletion_filter = NostrFilter(
+                    kinds=[e.kind],
+                    authors=[e.pubkey],
+                    **{"#d": [d_tag_value]},  # type: ignore
+                    until=e.created_at,
+                )
+
+                await delete_events(self.relay_id, deletion_filter)
+
     @property
     def config(self) -> RelaySpec:
         if not self.get_client_config:
             raise Exception("Client not ready!")
         return self.get_client_config()
 
-    async def _send_msg(self, data: list):
-        await self.websocket.send_text(json.dumps(data))
+    @property
+    def outbox(self) -> _Outbox:
+        if not self._outbox:
+            self._outbox = _Outbox(self.config.send_queue_size)
+        return self._outbox
+
+    async def _send_msg(self, data: list | str):
+        """
+        `data` is either a message or an already JSON encoded message.
+        Responses to the client's own messages wait for room in the queue.
+        """
+        text = data if isinstance(data, str) else json_dumps(data)
+        await self.outbox.put((text, _utf8_size(text), time.monotonic(), False))
+
+    def _enqueue_msg(self, text: str, size: int | None = None) -> bool:
+        """Queue a broadcast event, it never waits for room in the queue."""
+        if self._closed:
+            return False
+        if size is None:
+            size = _utf8_size(text)
+        try:
+            self.outbox.put_nowait((text, size, time.monotonic(), True))
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if self.config.disconnect_slow_clients:
+            reason = "Client too slow: the send queue is full."
+            logger.info(f"{reason} Disconnecting client from relay '{self.relay_id}'")
+            self._closed = True
+            self._stop_task = asyncio.create_task(self.stop(reason))
+            return False
 
-    async def _handle_delete_event(self, event: NostrEvent):
+        # drop the oldest event to make room for the new one (or the new one
+        # if the queue holds only responses)
+        self.send_stats.dropped += 1
+        if not self.outbox.drop_oldest_event():
+            return False
+        self.outbox.put_nowait((text, size, time.monotonic(), True))
+        return True
+
+    async def _write_messages(self) -> None:
+        """
+        Every pass writes the messages queued since the previous one (at most
+        `WRITE_BATCH_MAX_MESSAGES`), back to back, without going through the
+        queue wait again. The frames are not merged: NIP-01 requires one
+        message per websocket frame.
+        """
+        while True:
+            batch = [await self.outbox.get()]
+            while not self.outbox.empty() and len(batch) < WRITE_BATCH_MAX_MESSAGES:
+                batch.append(self.outbox.get_nowait())
+
+            sizes: list[int] = []
+            latencies: list[float] = []
+            try:
+                for text, size, queued_at, _ in batch:
+                    latencies.append(time.monotonic() - queued_at)
+                    await self.websocket.send_text(text)
+                    sizes.append(size)
+            except Exception as ex:
+                logger.debug(ex)
+                return
+            finally:
+                if sizes:
+                    self.send_stats.record_batch(sizes, latencies[: len(sizes)])
+
+    def _stop_writer(self):
+        if self._writer_task:
+            self._writer_task.cancel()
+            self._writer_task = None
+
+    async def _handle_delete_event(self, event: NostrEventStruct):
         # NIP 09
         nostr_filter = NostrFilter(authors=[event.pubkey])
         nostr_filter.ids = [t[1] for t in event.tags if t[0] == "e"]
@@ -216,64 +478,183 @@ class NostrClientConnection:
         await mark_events_deleted(self.relay_id, NostrFilter(ids=ids))
 
     async def _handle_request(
-        self, subscription_id: str, nostr_filter: NostrFilter
+        self, subscription_id: str, nostr_filters: list[NostrFilter]
+    ) -> AsyncIterator[list | str]:
+        """
+        Yields the messages for a REQ as soon as they are available: the stored
+        events (already serialized) while they are read page by page from the
+        database, then the EOSE.
+        """
+        rejection = await self._reject_request(nostr_filters)
+        if rejection:
+            yield rejection
+            return
+
+        self._remove_filter(subscription_id)
+        if self._filters_exceeded(len(nostr_filters)):
+            max_filters = self.config.max_client_filters
+            yield ["NOTICE", f"Maximum number of filters ({max_filters}) exceeded."]
+            return
+
+        for nostr_filter in nostr_filters:
+            nostr_filter.subscription_id = subscription_id
+            nostr_filter.enforce_limit(self.config.limit_per_filter)
+            nostr_filter.compile()
+            self._add_filter(nostr_filter)
+
+        # an event matching more than one filter is sent only once
+        sent_ids: set[str] = set()
+        for nostr_filter in nostr_filters:
+            async for event in stream_events(self.relay_id, nostr_filter):
+                if self._is_direct_message_for_other(event):
+                    continue
+                if len(nostr_filters) > 1:
+                    if event.id in sent_ids:
+                        continue
+                    sent_ids.add(event.id)
+                yield event.serialize_response_json(subscription_id)
+        yield ["EOSE", subscription_id]
+
+    async def _handle_count(
+        self, subscription_id: str, nostr_filters: list[NostrFilter]
     ) -> list:
+        """NIP-45: the number of matching events, the events are not read."""
+        rejection = await self._reject_request(nostr_filters)
+        if rejection:
+            return rejection
+
+        count = await count_events(
+            self.relay_id, nostr_filters, self._hides_direct_messages(nostr_filters)
+        )
+        return ["COUNT", subscription_id, {"count": count}]
+
+    async def _handle_negentropy(self, data: list) -> list:
+        message_type, subscription_id = data[0], data[1]
+        if message_type == NostrEventType.NEG_OPEN:
+            if len(data) < 4:
+                return []
+            nostr_filter = NostrFilter.parse_obj(data[2])
+            return await self._handle_negentropy_open(
+                subscription_id, nostr_filter, data[3]
+            )
+        if message_type == NostrEventType.NEG_MSG:
+            if len(data) < 3:
+                return []
+            return [self._handle_negentropy_message(subscription_id, data[2])]
+
+        self._negentropy_sessions.pop(subscription_id, None)
+        self._cancel_request(subscription_id)
+        return []
+
+    async def _handle_negentropy_open(
+        self, subscription_id: str, nostr_filter: NostrFilter, message: str
+    ) -> list:
+        """
+        NIP-77: the session keeps the `(created_at, id)` of the matching events,
+        the next NEG-MSGs are answered from memory.
+        """
+        self._negentropy_sessions.pop(subscription_id, None)
+
+        rejection = await self._reject_request([nostr_filter])
+        if rejection and rejection[0] == "AUTH":
+            reason = "auth-required: authentication is required to sync"
+            return [rejection, ["NEG-ERR", subscription_id, reason]]
+        if rejection:
+            return [["NEG-ERR", subscription_id, f"blocked: {rejection[1]}"]]
+
+        max_sessions = self.config.max_negentropy_sessions
+        if max_sessions != 0 and len(self._negentropy_sessions) >= max_sessions:
+            reason = f"blocked: maximum number of sync sessions ({max_sessions})"
+            return [["NEG-ERR", subscription_id, reason]]
+
+        max_records = self.config.negentropy_max_records
+        items = await get_sync_items(
+            self.relay_id,
+            nostr_filter,
+            max_records + 1 if max_records else 0,
+            self._hides_direct_messages([nostr_filter]),
+        )
+        if max_records and len(items) > max_records:
+            reason = f"blocked: more than {max_records} events, use a narrower filter"
+            return [["NEG-ERR", subscription_id, reason]]
+
+        session = Negentropy(NegentropyStorage(items), NEGENTROPY_FRAME_SIZE_LIMIT)
+        self._negentropy_sessions[subscription_id] = session
+        return [self._handle_negentropy_message(subscription_id, message)]
+
+    def _handle_negentropy_message(self, subscription_id: str, message: str) -> list:
+        session = self._negentropy_sessions.get(subscription_id)
+        if not session:
+            return ["NEG-ERR", subscription_id, "closed: unknown subscription"]
+        try:
+            response = session.reconcile(bytes.fromhex(message))
+        except ValueError as ex:
+            del self._negentropy_sessions[subscription_id]
+            return ["NEG-ERR", subscription_id, f"error: {ex}"]
+        return ["NEG-MSG", subscription_id, response.hex() if response else ""]
+
+    def _hides_direct_messages(self, nostr_filters: list[NostrFilter]) -> bool:
+        """
+        The direct messages for other clients are not sent by REQs, they are
+        not counted (or synced) either.
+        """
+        return self.config.event_requires_auth(4) and not all(
+            self.auth_pubkey and f.p == [self.auth_pubkey] for f in nostr_filters
+        )
+
+    async def _reject_request(self, nostr_filters: list[NostrFilter]) -> list | None:
         if self.config.require_auth_filter:
             if not self.auth_pubkey:
-                return [["AUTH", self._current_auth_challenge()]]
+                return ["AUTH", self._current_auth_challenge()]
             account = await get_account(self.relay_id, self.auth_pubkey)
             if not account:
                 account = NostrAccount.null_account()
 
             if account.blocked:
                 return [
-                    [
-                        "NOTICE",
-                        (
-                            f"Public key '{self.auth_pubkey}' is not allowed "
-                            f"in relay '{self.relay_id}'!"
-                        ),
-                    ]
+                    "NOTICE",
+                    (
+                        f"Public key '{self.auth_pubkey}' is not allowed "
+                        f"in relay '{self.relay_id}'!"
+                    ),
                 ]
 
             if not account.can_join and not self.config.is_free_to_join:
-                return [["NOTICE", f"This is a paid relay: '{self.relay_id}'"]]
+                return ["NOTICE", f"This is a paid relay: '{self.relay_id}'"]
 
-        nostr_filter.subscription_id = subscription_id
-        self._remove_filter(subscription_id)
-        if self._can_add_filter():
-            max_filters = self.config.max_client_filters
-            return [
-                [
-                    "NOTICE",
-                    f"Maximum number of filters ({max_filters}) exceeded.",
-                ]
-            ]
+        try:
+            for nostr_filter in nostr_filters:
+                nostr_filter.validate_list_sizes(self.config.max_filter_list_size)
+        except ValueError as ex:
+            return ["NOTICE", str(ex)]
 
-        nostr_filter.enforce_limit(self.config.limit_per_filter)
+        return None
+
+    def _add_filter(self, nostr_filter: NostrFilter):
         self.filters.append(nostr_filter)
-        events = await get_events(self.relay_id, nostr_filter)
-        events = [e for e in events if not self._is_direct_message_for_other(e)]
-        serialized_events = [
-            event.serialize_response(subscription_id) for event in events
-        ]
-        resp_nip15 = ["EOSE", subscription_id]
-        serialized_events.append(resp_nip15)
-        return serialized_events
+        if self.add_subscription:
+            self.add_subscription(self, nostr_filter)
 
     def _remove_filter(self, subscription_id: str):
-        self.filters = [f for f in self.filters if f.subscription_id != subscription_id]
+        filters = []
+        for f in self.filters:
+            if f.subscription_id != subscription_id:
+                filters.append(f)
+            elif self.remove_subscription:
+                self.remove_subscription(f)
+        self.filters = filters
 
     def _handle_close(self, subscription_id: str):
+        self._cancel_request(subscription_id)
         self._remove_filter(subscription_id)
 
     async def _handle_auth(self):
         await self._send_msg(["AUTH", self._current_auth_challenge()])
 
-    def _can_add_filter(self) -> bool:
+    def _filters_exceeded(self, new_filters_count: int) -> bool:
         return (
             self.config.max_client_filters != 0
-            and len(self.filters) >= self.config.max_client_filters
+            and len(self.filters) + new_filters_count > self.config.max_client_filters
         )
 
     def _auth_challenge_expired(self):
@@ -290,3 +671,8 @@ class NostrClientConnection:
             self._auth_challenge = self.relay_id + ":" + urlsafe_short_hash()
             self._auth_challenge_created_at = round(time.time())
         return self._auth_challenge
+
+
+def _utf8_size(text: str) -> int:
+    # `isascii()` does not scan the string, only non-ASCII text is encoded
+    return len(text) if text.isascii() else len(text.encode())
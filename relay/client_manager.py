@@ -1,13 +1,19 @@
 from ..crud import get_config_for_all_active_relays
 from .client_connection import NostrClientConnection
-from .event import NostrEvent
+from .event import BaseNostrEvent
+from .filter import NostrFilter
 from .relay import RelaySpec
+from .send_stats import NostrSendStats
+from .subscription_index import NostrSubscriptionIndex
 
 
 class NostrClientManager:
     def __init__(self: "NostrClientManager"):
         self._clients: dict = {}
         self._active_relays: dict = {}
+        self._subscriptions: dict[str, NostrSubscriptionIndex] = {}
+        # counters of the clients that are no longer connected
+        self._closed_send_stats: dict[str, NostrSendStats] = {}
         self._is_ready = False
 
     async def add_client(self, c: NostrClientConnection) -> bool:
@@ -24,10 +30,16 @@ class NostrClientManager:
 
     def remove_client(self, c: NostrClientConnection):
         self.clients(c.relay_id).remove(c)
+        self.subscriptions(c.relay_id).remove_client(c)
+        self._closed_send_stats.setdefault(c.relay_id, NostrSendStats()).add(
+            c.send_stats
+        )
 
-    async def broadcast_event(self, source: NostrClientConnection, event: NostrEvent):
-        for client in self.clients(source.relay_id):
-            await client.notify_event(event)
+    async def broadcast_event(
+        self, source: NostrClientConnection, event: BaseNostrEvent
+    ):
+        for client, nostr_filter in self.subscriptions(source.relay_id).matches(event):
+            client.notify_event(event, nostr_filter)
 
     async def init_relays(self):
         self._active_relays = await get_config_for_all_active_relays()
@@ -41,6 +53,7 @@ class NostrClientManager:
         await self._stop_clients_for_relay(relay_id)
         if relay_id in self._active_relays:
             del self._active_relays[relay_id]
+        self._subscriptions.pop(relay_id, None)
 
     def get_relay_config(self, relay_id: str) -> RelaySpec:
         return self._active_relays[relay_id]
@@ -50,6 +63,19 @@ class NostrClientManager:
             self._clients[relay_id] = []
         return self._clients[relay_id]
 
+    def subscriptions(self, relay_id: str) -> NostrSubscriptionIndex:
+        if relay_id not in self._subscriptions:
+            self._subscriptions[relay_id] = NostrSubscriptionIndex()
+        return self._subscriptions[relay_id]
+
+    def send_stats(self, relay_id: str) -> dict:
+        """Outbound message counters of the relay, since the extension started."""
+        stats = NostrSendStats()
+        stats.add(self._closed_send_stats.get(relay_id, NostrSendStats()))
+        for client in self.clients(relay_id):
+            stats.add(client.send_stats)
+        return {"connections": len(self.clients(relay_id)), **stats.dict()}
+
     async def stop(self):
         for relay_id in self._active_relays:
             await self._stop_clients_for_relay(relay_id)
@@ -69,5 +95,16 @@ class NostrClientManager:
         def get_client_config() -> RelaySpec:
             return self.get_relay_config(client.relay_id)
 
+        def add_subscription(c: NostrClientConnection, nostr_filter: NostrFilter):
+            self.subscriptions(c.relay_id).add(c, nostr_filter)
+
+        def remove_subscription(nostr_filter: NostrFilter):
+            self.subscriptions(client.relay_id).remove(nostr_filter)
+
         client.get_client_config = get_client_config
-        client.init_callbacks(self.broadcast_event, get_client_config)
+        client.init_callbacks(
+            self.broadcast_event,
+            get_client_config,
+            add_subscription,
+            remove_subscription,
+        )
@@ -1,9 +1,11 @@
 import hashlib
-import json
 from enum import Enum
+from typing import Any
 
 from coincurve import PublicKeyXOnly
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
+
+from ..helpers import json_dumps
 
 
 class NostrEventType(str, Enum):
@@ -11,41 +13,65 @@ class NostrEventType(str, Enum):
     REQ = "REQ"
     CLOSE = "CLOSE"
     AUTH = "AUTH"
+    COUNT = "COUNT"
+    NEG_OPEN = "NEG-OPEN"
+    NEG_MSG = "NEG-MSG"
+    NEG_CLOSE = "NEG-CLOSE"
+
+
+class BaseNostrEvent:
+    """
+    The NIP-01 event fields and the values derived from them, shared by the
+    pydantic `NostrEvent` (storage, API) and the slotted `NostrEventStruct`
+    (websocket and broadcast paths).
+    """
 
+    __slots__ = ()
 
-class NostrEvent(BaseModel):
     id: str
-    relay_id: str
-    publisher: str
     pubkey: str
     created_at: int
     kind: int
-    tags: list[list[str]] = Field(default=[], no_database=True)
-    content: str = ""
+    tags: list[list[str]]
+    content: str
     sig: str
 
+    # values derived from the fields above, computed once per event
+    _cache: dict
+
     def nostr_dict(self) -> dict:
-        _nostr_dict = dict(self)
-        _nostr_dict.pop("relay_id")
-        _nostr_dict.pop("publisher")
-        return _nostr_dict
+        return {
+            "id": self.id,
+            "pubkey": self.pubkey,
+            "created_at": self.created_at,
+            "kind": self.kind,
+            "tags": self.tags,
+            "content": self.content,
+            "sig": self.sig,
+        }
 
     def serialize(self) -> list:
         return [0, self.pubkey, self.created_at, self.kind, self.tags, self.content]
 
     def serialize_json(self) -> str:
-        e = self.serialize()
-        return json.dumps(e, separators=(",", ":"), ensure_ascii=False)
+        """The NIP-01 commitment, the `id` is its hash."""
+        if "serialize_json" not in self._cache:
+            self._cache["serialize_json"] = json_dumps(self.serialize())
+        return self._cache["serialize_json"]
 
     @property
     def event_id(self) -> str:
-        data = self.serialize_json()
-        return hashlib.sha256(data.encode()).hexdigest()
+        if "event_id" not in self._cache:
+            data = self.serialize_json().encode()
+            self._cache["event_id"] = hashlib.sha256(data).hexdigest()
+        return self._cache["event_id"]
 
     @property
     def size_bytes(self) -> int:
-        s = json.dumps(self.nostr_dict(), separators=(",", ":"), ensure_ascii=False)
-        return len(s.encode())
+        """Size of the event as sent to the clients (`nostr_json`)."""
+        if "size_bytes" not in self._cache:
+            self._cache["size_bytes"] = len(self.nostr_json.encode())
+        return self._cache["size_bytes"]
 
     @property
     def is_replaceable_event(self) -> bool:
@@ -98,11 +124,170 @@ class NostrEvent(BaseModel):
     def serialize_response(self, subscription_id):
         return [NostrEventType.EVENT, subscription_id, self.nostr_dict()]
 
+    @property
+    def nostr_json(self) -> str:
+        """
+        JSON encoded `nostr_dict()`. It is the same for every subscriber,
+        so it is encoded only once and then spliced into the `EVENT` frames.
+        """
+        if "nostr_json" not in self._cache:
+            self._cache["nostr_json"] = json_dumps(self.nostr_dict())
+        return self._cache["nostr_json"]
+
+    def serialize_response_json(self, subscription_id: str) -> str:
+        """Same output as `json_dumps(self.serialize_response(subscription_id))`"""
+        return (
+            f'["{NostrEventType.EVENT.value}",'
+            f"{json_dumps(subscription_id)},{self.nostr_json}]"
+        )
+
     def tag_values(self, tag_name: str) -> list[str]:
         return [t[1] for t in self.tags if t[0] == tag_name]
 
+    @property
+    def tag_index(self) -> dict[str, set[str]]:
+        """Tag name to tag values, built on first use."""
+        if "tag_index" not in self._cache:
+            tag_index: dict[str, set[str]] = {}
+            for t in self.tags:
+                if len(t) > 1:
+                    tag_index.setdefault(t[0], set()).add(t[1])
+            self._cache["tag_index"] = tag_index
+        return self._cache["tag_index"]
+
     def has_tag_value(self, tag_name: str, tag_value: str) -> bool:
-        return tag_value in self.tag_values(tag_name)
+        return tag_value in self.tag_index.get(tag_name, ())
 
     def is_direct_message_for_pubkey(self, pubkey: str) -> bool:
         return self.is_direct_message and self.has_tag_value("p", pubkey)
+
+
+# `NostrEvent` fields that the cached values do not depend on
+_NOT_CACHED_FIELDS = frozenset({"relay_id", "publisher", "size"})
+
+
+class NostrEvent(BaseModel, BaseNostrEvent):
+    id: str
+    relay_id: str
+    publisher: str
+    pubkey: str
+    created_at: int
+    kind: int
+    tags: list[list[str]] = Field(default=[], no_database=True)
+    content: str = ""
+    sig: str
+    size: int = 0  # set when the event is stored, see `size_bytes`
+
+    _cache: dict = PrivateAttr(default_factory=dict)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self.__fields__ and name not in _NOT_CACHED_FIELDS:
+            self._cache.clear()
+
+    def copy(self, **kwargs) -> "NostrEvent":
+        event = super().copy(**kwargs)
+        # the private attributes are shallow copied, do not share the cache
+        event._cache = {}
+        return event
+
+
+class NostrEventStruct(BaseNostrEvent):
+    """
+    Plain event without pydantic validation or a per instance `__dict__`.
+    The derived values are cached, so the fields must not be changed once
+    they are in use. Converted to a `NostrEvent` only when it is stored.
+    """
+
+    __slots__ = (
+        "_cache",
+        "content",
+        "created_at",
+        "id",
+        "kind",
+        "pubkey",
+        "sig",
+        "tags",
+    )
+
+    def __init__(
+        self,
+        id: str,  # noqa: A002
+        pubkey: str,
+        created_at: int,
+        kind: int,
+        tags: list[list[str]],
+        content: str,
+        sig: str,
+    ):
+        self.id = id
+        self.pubkey = pubkey
+        self.created_at = created_at
+        self.kind = kind
+        self.tags = tags
+        self.content = content
+        self.sig = sig
+        self._cache = {}
+
+    @classmethod
+    def parse(cls, data: Any) -> "NostrEventStruct":
+        """
+        Event sent by a client. The types are checked, but not coerced:
+        a coerced value would not match the signed serialization anyway.
+        """
+        if not isinstance(data, dict):
+            raise ValueError("Event must be a JSON object")
+        try:
+            event = cls(
+                id=data["id"],
+                pubkey=data["pubkey"],
+                created_at=data["created_at"],
+                kind=data["kind"],
+                tags=data.get("tags", []),
+                content=data.get("content", ""),
+                sig=data["sig"],
+            )
+        except KeyError as exc:
+            raise ValueError(f"Event field missing: {exc}") from exc
+
+        for name in ["id", "pubkey", "content", "sig"]:
+            if not isinstance(getattr(event, name), str):
+                raise ValueError(f"Event field '{name}' must be a string")
+        for name in ["created_at", "kind"]:
+            if type(getattr(event, name)) is not int:
+                raise ValueError(f"Event field '{name}' must be an integer")
+        if not isinstance(event.tags, list) or not all(
+            isinstance(t, list) and all(isinstance(v, str) for v in t)
+            for t in event.tags
+        ):
+            raise ValueError("Event field 'tags' must be a list of string lists")
+        return event
+
+    @classmethod
+    def from_row(cls, row: dict) -> "NostrEventStruct":
+        """Stored event, without its tags (they are loaded separately)."""
+        return cls(
+            id=row["id"],
+            pubkey=row["pubkey"],
+            created_at=row["created_at"],
+            kind=row["kind"],
+            tags=[],
+            content=row["content"],
+            sig=row["sig"],
+        )
+
+    def to_model(self, relay_id: str, publisher: str) -> NostrEvent:
+        event = NostrEvent.construct(
+            id=self.id,
+            relay_id=relay_id,
+            publisher=publisher,
+            pubkey=self.pubkey,
+            created_at=self.created_at,
+            kind=self.kind,
+            tags=self.tags,
+            content=self.content,
+            sig=self.sig,
+            size=0,
+        )
+        event._cache = dict(self._cache)
+        return event
@@ -4,8 +4,9 @@ from collections.abc import Callable
 from ..crud import get_account, get_storage_for_public_key, prune_old_events
 from ..helpers import extract_domain
 from ..models import NostrAccount
-from .event import NostrEvent
+from .event import BaseNostrEvent
 from .relay import RelaySpec
+from .signature_verifier import signature_verifier
 
 
 class EventValidator:
@@ -17,13 +18,29 @@ class EventValidator:
 
         self.get_client_config: Callable[[], RelaySpec] | None = None
 
+    async def validate_event(self, e: BaseNostrEvent) -> tuple[bool, str]:
+        """
+        Rate limit, `id` and `sig`, `created_at` range. Done for every event,
+        also for the duplicates (the verified signatures are cached).
+        """
+        if self._exceeded_max_events_per_hour():
+            return False, "Exceeded max events per hour limit'!"
+
+        try:
+            await signature_verifier.verify(e)
+        except ValueError:
+            return False, "invalid: wrong event `id` or `sig`"
+
+        in_range, message = self._created_at_in_range(e.created_at)
+        if not in_range:
+            return False, message
+
+        return True, ""
+
     async def validate_write(
-        self, e: NostrEvent, publisher_pubkey: str
+        self, e: BaseNostrEvent, publisher_pubkey: str
     ) -> tuple[bool, str]:
-        valid, message = self._validate_event(e)
-        if not valid:
-            return (valid, message)
-
+        """Checks for an event that is not stored yet, after `validate_event()`."""
         if e.is_ephemeral_event:
             return True, ""
 
@@ -33,10 +50,10 @@ class EventValidator:
 
         return True, ""
 
-    def validate_auth_event(
-        self, e: NostrEvent, auth_challenge: str | None
+    async def validate_auth_event(
+        self, e: BaseNostrEvent, auth_challenge: str | None
     ) -> tuple[bool, str]:
-        valid, message = self._validate_event(e)
+        valid, message = await self.validate_event(e)
         if not valid:
             return (valid, message)
 
@@ -59,21 +76,6 @@ class EventValidator:
             raise Exception("EventValidator not ready!")
         return self.get_client_config()
 
-    def _validate_event(self, e: NostrEvent) -> tuple[bool, str]:
-        if self._exceeded_max_events_per_hour():
-            return False, "Exceeded max events per hour limit'!"
-
-        try:
-            e.check_signature()
-        except ValueError:
-            return False, "invalid: wrong event `id` or `sig`"
-
-        in_range, message = self._created_at_in_range(e.created_at)
-        if not in_range:
-            return False, message
-
-        return True, ""
-
     async def _validate_storage(
         self, pubkey: str, event_size_bytes: int
     ) -> tuple[bool, str]:
@@ -107,7 +109,8 @@ class EventValidator:
         if event_size_bytes > total_available_storage:
             return False, "Message is too large. Not enough storage available for it."
 
-        await prune_old_events(self.relay_id, pubkey, event_size_bytes)
+        space_to_regain = stored_bytes + event_size_bytes - total_available_storage
+        await prune_old_events(self.relay_id, pubkey, space_to_regain)
 
         return True, ""
 
@@ -1,6 +1,40 @@
-from pydantic import BaseModel, Field
+import hashlib
+import json
+import re
+import string
+import unicodedata
 
-from .event import NostrEvent
+from lnbits.db import SQLITE
+from pydantic import BaseModel, Field, PrivateAttr, root_validator
+
+from .event import BaseNostrEvent
+
+# SQLite: longer lists are bound as one JSON array parameter, so a statement
+# stays below the bound parameters limit (32766) whatever the list sizes
+SQLITE_MAX_LIST_PLACEHOLDERS = 32
+# NIP-50: only the newest matches of a search are ranked by relevance, so a
+# very common word does not rank (and sort) all the events of the relay
+SEARCH_MAX_CANDIDATES = 1000
+# longer tag values are indexed by their hash in `event_tag_index` (btree key size)
+TAG_INDEX_MAX_VALUE_LENGTH = 512
+
+
+class CompiledFilter:
+    """Filter conditions as frozensets, built once by `NostrFilter.compile()`."""
+
+    __slots__ = ("authors", "ids", "kinds", "search", "since", "tags", "until")
+
+    def __init__(self, nostr_filter: "NostrFilter"):
+        self.ids = frozenset(nostr_filter.ids) if nostr_filter.ids else None
+        self.authors = frozenset(nostr_filter.authors) if nostr_filter.authors else None
+        self.kinds = frozenset(nostr_filter.kinds) if nostr_filter.kinds else None
+        self.since = nostr_filter.since
+        self.until = nostr_filter.until
+        self.tags = tuple(
+            (name, frozenset(values)) for name, values in nostr_filter.tag_filters()
+        )
+        terms = nostr_filter.search_terms()
+        self.search = frozenset(terms) if terms else None
 
 
 class NostrFilter(BaseModel):
@@ -14,43 +48,63 @@ class NostrFilter(BaseModel):
     since: int | None = None
     until: int | None = None
     limit: int | None = None
+    search: str | None = None
+    # the other single-letter tag filters (NIP-01 `#<letter>`), by tag name
+    tags: dict[str, list[str]] = {}
+
+    _compiled: CompiledFilter | None = PrivateAttr(default=None)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self.__fields__:
+            self._compiled = None
 
-    def matches(self, e: NostrEvent) -> bool:
+    @root_validator(pre=True)
+    def _collect_tag_filters(cls, values: dict) -> dict:
+        tags = {}
+        for key, tag_values in values.items():
+            if is_tag_filter_key(key) and key[1] not in ("e", "p", "d"):
+                tags[key[1]] = tag_values
+        if tags:
+            values = {**values, "tags": {**values.get("tags", {}), **tags}}
+        return values
+
+    def compile(self) -> CompiledFilter:
+        """
+        Prepare the filter for `matches()`. It is done once, when the filter is
+        accepted. Call it again if the lists are changed in place afterwards.
+        """
+        self._compiled = CompiledFilter(self)
+        return self._compiled
+
+    def matches(self, e: BaseNostrEvent) -> bool:
         # todo: starts with
-        if len(self.ids) != 0 and e.id not in self.ids:
+        f = self._compiled or self.compile()
+        if f.ids is not None and e.id not in f.ids:
             return False
-        if len(self.authors) != 0 and e.pubkey not in self.authors:
+        if f.authors is not None and e.pubkey not in f.authors:
             return False
-        if len(self.kinds) != 0 and e.kind not in self.kinds:
+        if f.kinds is not None and e.kind not in f.kinds:
             return False
 
-        if self.since and e.created_at < self.since:
+        if f.since and e.created_at < f.since:
             return False
-        if self.until and self.until > 0 and e.created_at > self.until:
+        if f.until and f.until > 0 and e.created_at > f.until:
             return False
 
         # Check tag filters - only fail if filter is specified and no match found
-        if not self.tag_in_list(e.tags, "e"):
-            return False
-        if not self.tag_in_list(e.tags, "p"):
-            return False
-        if not self.tag_in_list(e.tags, "d"):
-            return False
-
-        return True
-
-    def tag_in_list(self, event_tags, tag_name) -> bool:
-        filter_tags = dict(self).get(tag_name, [])
-        if len(filter_tags) == 0:
-            return True
-
-        event_tag_values = [t[1] for t in event_tags if t[0] == tag_name]
+        if f.tags:
+            tag_index = e.tag_index
+            for tag_name, tag_values in f.tags:
+                event_tag_values = tag_index.get(tag_name)
+                if not event_tag_values or tag_values.isdisjoint(event_tag_values):
+                    return False
 
-        common_tags = [
-            event_tag for event_tag in event_tag_values if event_tag in filter_tags
-        ]
-        if len(common_tags) == 0:
+        if f.search and (
+            e.is_direct_message or not f.search.issubset(search_words(e.content))
+        ):
             return False
+
         return True
 
     def is_empty(self):
@@ -58,59 +112,92 @@ class NostrFilter(BaseModel):
             len(self.ids) == 0
             and len(self.authors) == 0
             and len(self.kinds) == 0
-            and len(self.e) == 0
-            and len(self.p) == 0
+            and not self.tag_filters()
             and (not self.since)
             and (not self.until)
+            and not self.search_terms()
         )
 
+    def tag_filters(self) -> list[tuple[str, list[str]]]:
+        """The non-empty tag filters, as `(tag name, values)`."""
+        tag_filters = [("e", self.e), ("p", self.p), ("d", self.d)]
+        tag_filters.extend(sorted(self.tags.items()))
+        return [(name, values) for name, values in tag_filters if values]
+
+    def search_terms(self) -> list[str]:
+        """
+        NIP-50: the words of `search`, an event must contain all of them.
+        The extensions (`key:value`) are not supported and are ignored.
+        """
+        if not self.search:
+            return []
+        tokens = [t for t in self.search.split() if ":" not in t]
+        return search_words(" ".join(tokens))
+
     def enforce_limit(self, limit: int):
         if not self.limit or self.limit > limit:
             self.limit = limit
 
-    def to_sql_components(self, relay_id: str) -> tuple[list[str], list[str], dict]:
+    def validate_list_sizes(self, max_size: int):
+        """Raises `ValueError` if a filter list has more than `max_size` values"""
+        if max_size == 0:
+            return
+        lists: dict[str, list] = {
+            "ids": self.ids,
+            "authors": self.authors,
+            "kinds": self.kinds,
+        }
+        for tag_name, tag_values in self.tag_filters():
+            lists[f"#{tag_name}"] = tag_values
+        for name, values in lists.items():
+            if len(values) > max_size:
+                raise ValueError(
+                    f"Filter '{name}' has too many values "
+                    f"({len(values)}, maximum {max_size})."
+                )
+
+    def to_sql_components(
+        self, relay_id: str, db_type: str | None = SQLITE
+    ) -> tuple[list[str], list[str], dict]:
+        """
+        All filter values are bound parameters. The SQL text depends only on
+        the shape of the filter, so prepared statements can be reused by the
+        database across REQs (see `sql_in_list()`).
+        """
         inner_joins: list[str] = []
         where = ["deleted=false", "nostrrelay.events.relay_id = :relay_id"]
         values: dict = {"relay_id": relay_id}
 
-        if len(self.e):
-            e_s = ",".join([f"'{e}'" for e in self.e])
-            inner_joins.append(
-                "INNER JOIN nostrrelay.event_tags e_tags "
-                "ON nostrrelay.events.id = e_tags.event_id"
+        for tag_name, tag_values in self.tag_filters():
+            # SQLite parameter names are not case sensitive
+            alias = f"tag_{tag_name}" if tag_name.islower() else f"tag_{tag_name}_upper"
+            values[f"{alias}_name"] = tag_name
+            in_list = sql_in_list(
+                "value",
+                f"{alias}_value",
+                [tag_index_value(v) for v in tag_values],
+                db_type,
+                values,
             )
-            where.append(f" (e_tags.value in ({e_s}) AND e_tags.name = 'e')")
-
-        if len(self.p):
-            p_s = ",".join([f"'{p}'" for p in self.p])
-            inner_joins.append(
-                "INNER JOIN nostrrelay.event_tags p_tags "
-                "ON nostrrelay.events.id = p_tags.event_id"
-            )
-            where.append(f" p_tags.value in ({p_s}) AND p_tags.name = 'p'")
-
-        if len(self.d):
-            d_s = ",".join([f"'{d}'" for d in self.d])
-            d_join = (
-                "INNER JOIN nostrrelay.event_tags d_tags "
-                "ON nostrrelay.events.id = d_tags.event_id"
+            # a semi-join: the events are not multiplied by the matching tags
+            where.append(
+                "nostrrelay.events.id IN ("
+                "SELECT event_id FROM nostrrelay.event_tag_index "
+                f"WHERE relay_id = :relay_id AND name = :{alias}_name AND {in_list})"
             )
-            d_where = f" d_tags.value in ({d_s}) AND d_tags.name = 'd'"
-
-            inner_joins.append(d_join)
-            where.append(d_where)
 
         if len(self.ids) != 0:
-            ids = ",".join([f"'{_id}'" for _id in self.ids])
-            where.append(f"id IN ({ids})")
+            where.append(
+                sql_in_list("nostrrelay.events.id", "ids", self.ids, db_type, values)
+            )
 
         if len(self.authors) != 0:
-            authors = ",".join([f"'{author}'" for author in self.authors])
-            where.append(f"pubkey IN ({authors})")
+            where.append(
+                sql_in_list("pubkey", "authors", self.authors, db_type, values)
+            )
 
         if len(self.kinds) != 0:
-            kinds = ",".join([f"'{kind}'" for kind in self.kinds])
-            where.append(f"kind IN ({kinds})")
+            where.append(sql_in_list("kind", "kinds", self.kinds, db_type, values))
 
         if self.since:
             where.append("created_at >= :since")
@@ -120,4 +207,115 @@ class NostrFilter(BaseModel):
             where.append("created_at < :until")
             values["until"] = self.until
 
+        terms = self.search_terms()
+        if terms and db_type == SQLITE:
+            # quoted, so the words are not parsed as FTS5 operators
+            values["search"] = " ".join(f'"{t}"' for t in terms)
+            values["search_candidates"] = SEARCH_MAX_CANDIDATES
+            # the FTS5 rowids follow the insertion order: the newest matches
+            # are read first and the scan stops at the limit, `rank` (bm25)
+            # is computed only for them
+            inner_joins.append(
+                """
+                INNER JOIN (
+                    SELECT search_ids.event_id, nostrrelay.events_search.rank
+                    FROM nostrrelay.events_search INNER JOIN
+                    nostrrelay.events_search_ids search_ids
+                    ON search_ids.id = nostrrelay.events_search.rowid
+                    WHERE events_search MATCH :search
+                    AND search_ids.relay_id = :relay_id
+                    ORDER BY nostrrelay.events_search.rowid DESC
+                    LIMIT :search_candidates
+                ) search ON search.event_id = nostrrelay.events.id
+                """
+            )
+        elif terms:
+            # the `simple` configuration keeps the diacritics of the content,
+            # so the words of the query keep them too
+            search = self.search or ""
+            values["search"] = " ".join(t for t in search.split() if ":" not in t)
+            values["search_candidates"] = SEARCH_MAX_CANDIDATES
+            # same as the SQLite index: direct messages are not searchable
+            where.append(
+                """
+                nostrrelay.events.id IN (
+                    SELECT id FROM nostrrelay.events
+                    WHERE relay_id = :relay_id AND deleted = false AND kind <> 4
+                    AND to_tsvector('simple', content)
+                    @@ plainto_tsquery('simple', :search)
+                    ORDER BY created_at DESC LIMIT :search_candidates
+                )
+                """
+            )
+
         return inner_joins, where, values
+
+    def to_sql_order_by(self, db_type: str | None = SQLITE) -> str:
+        """
+        Newest events first, search results by relevance (best first) among
+        the newest `SEARCH_MAX_CANDIDATES` matches.
+        """
+        order_by = "created_at DESC, nostrrelay.events.id DESC"
+        if not self.search_terms():
+            return order_by
+        if db_type == SQLITE:
+            # `rank` is the bm25 score, lower is better
+            return f"search.rank, {order_by}"
+        rank = (
+            "ts_rank(to_tsvector('simple', content), "
+            "plainto_tsquery('simple', :search))"
+        )
+        return f"{rank} DESC, {order_by}"
+
+
+def tag_index_value(value: str) -> str:
+    """Value of a tag in the `event_tag_index` table, and of a tag filter."""
+    if len(value) <= TAG_INDEX_MAX_VALUE_LENGTH:
+        return value
+    return "sha256:" + hashlib.sha256(value.encode()).hexdigest()
+
+
+def sql_in_list(
+    column: str, param_name: str, items: list, db_type: str | None, values: dict
+) -> str:
+    """
+    Condition for `column` being one of `items`. The items are added to `values`.
+    Postgres binds the whole list as one array parameter. SQLite gets one
+    placeholder per item, the count is rounded up to the next power of two
+    (padded with the last item), so only a few statement variants exist.
+    Above `SQLITE_MAX_LIST_PLACEHOLDERS` items, the list is bound as one JSON
+    array, read by `json_each()`.
+    """
+    if db_type != SQLITE:
+        values[param_name] = list(items)
+        return f"{column} = ANY(:{param_name})"
+
+    if len(items) > SQLITE_MAX_LIST_PLACEHOLDERS:
+        values[param_name] = json.dumps(list(items))
+        return f"{column} IN (SELECT value FROM json_each(:{param_name}))"
+
+    bucket_size = 1
+    while bucket_size < len(items):
+        bucket_size *= 2
+    padded_items = list(items) + [items[-1]] * (bucket_size - len(items))
+
+    placeholders = []
+    for i, item in enumerate(padded_items):
+        values[f"{param_name}_{i}"] = item
+        placeholders.append(f":{param_name}_{i}")
+    return f"{column} IN ({', '.join(placeholders)})"
+
+
+def is_tag_filter_key(key: str) -> bool:
+    """NIP-01: `#` and a single letter, for example `#t`."""
+    return len(key) == 2 and key[0] == "#" and key[1] in string.ascii_letters
+
+
+def search_words(text: str) -> list[str]:
+    """
+    Lowercase words without diacritics, the same way the SQLite FTS5 index
+    (`unicode61` tokenizer) splits the content.
+    """
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in normalized if not unicodedata.combining(c))
+    return re.findall(r"\w+", text)
@@ -0,0 +1,294 @@
+import hashlib
+from bisect import bisect_left
+
+# NIP-77: negentropy protocol version 1
+PROTOCOL_VERSION = 0x61
+ID_SIZE = 32
+FINGERPRINT_SIZE = 16
+# a range with fewer items is sent as an id list, otherwise it is split
+BUCKETS = 16
+# `created_at` of the upper bound of the last range
+MAX_TIMESTAMP = 2**64 - 1
+
+MODE_SKIP = 0
+MODE_FINGERPRINT = 1
+MODE_ID_LIST = 2
+
+
+class NegentropyStorage:
+    """
+    The `(created_at, id)` items of the events matching a filter, sorted.
+    The fingerprint of any range is computed from prefix sums of the ids.
+    """
+
+    __slots__ = ("_id_sums", "ids", "keys")
+
+    def __init__(self, items: list[tuple[int, str]]):
+        items = sorted(items)
+        self.keys = [(created_at, bytes.fromhex(id_)) for created_at, id_ in items]
+        self.ids = [key[1] for key in self.keys]
+        self._id_sums = [0]
+        for id_ in self.ids:
+            self._id_sums.append(self._id_sums[-1] + int.from_bytes(id_, "little"))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def find_lower_bound(self, begin: int, end: int, bound: tuple[int, bytes]) -> int:
+        """Index of the first item in `[begin, end)` that is not below `bound`."""
+        return bisect_left(self.keys, bound, begin, end)
+
+    def fingerprint(self, begin: int, end: int) -> bytes:
+        id_sum = (self._id_sums[end] - self._id_sums[begin]) % 2**256
+        data = id_sum.to_bytes(ID_SIZE, "little") + encode_varint(end - begin)
+        return hashlib.sha256(data).digest()[:FINGERPRINT_SIZE]
+
+
+class Negentropy:
+    """
+    Range based set reconciliation (negentropy v1, see NIP-77). The relay is
+    the responder: every `reconcile()` answers a client message. The initiator
+    side (`initiate()`, then `reconcile()` until it returns `None`) is used by
+    clients and mirroring relays.
+    """
+
+    def __init__(
+        self,
+        storage: NegentropyStorage,
+        frame_size_limit: int = 0,
+        is_initiator: bool = False,
+    ):
+        if frame_size_limit and frame_size_limit < 4096:
+            raise ValueError("Frame size limit too small.")
+        self.storage = storage
+        self.frame_size_limit = frame_size_limit
+        self.is_initiator = is_initiator
+        self.have_ids: list[str] = []
+        self.need_ids: list[str] = []
+        self._last_timestamp_in = 0
+        self._last_timestamp_out = 0
+
+    def initiate(self) -> bytes:
+        self._last_timestamp_out = 0
+        output = bytearray([PROTOCOL_VERSION])
+        self._split_range(0, len(self.storage), (MAX_TIMESTAMP, b""), output)
+        return bytes(output)
+
+    def reconcile(self, query: bytes) -> bytes | None:
+        """
+        The next message. The initiator collects the differences in `have_ids`
+        and `need_ids`, it gets `None` when the reconciliation is complete.
+        Raises `ValueError` for malformed messages.
+        """
+        self._last_timestamp_in = self._last_timestamp_out = 0
+        reader = _Reader(query)
+        output = bytearray([PROTOCOL_VERSION])
+
+        if not self._read_version(reader):
+            # the other side can retry with our version
+            return bytes(output)
+
+        storage_size = len(self.storage)
+        prev_bound: tuple[int, bytes] = (0, b"")
+        prev_index = 0
+        skip = False
+
+        while not reader.done():
+            out = bytearray()
+            curr_bound = self._decode_bound(reader)
+            mode = reader.varint()
+            lower = prev_index
+            upper = self.storage.find_lower_bound(prev_index, storage_size, curr_bound)
+
+            if mode == MODE_SKIP:
+                skip = True
+            elif mode == MODE_FINGERPRINT:
+                their_fingerprint = reader.bytes(FINGERPRINT_SIZE)
+                if their_fingerprint == self.storage.fingerprint(lower, upper):
+                    skip = True
+                else:
+                    skip = self._write_skip(skip, prev_bound, out)
+                    self._split_range(lower, upper, curr_bound, out)
+            elif mode == MODE_ID_LIST:
+                their_ids = {reader.bytes(ID_SIZE) for _ in range(reader.varint())}
+                if self.is_initiator:
+                    skip = True
+                    self._compare_ids(lower, upper, their_ids)
+                else:
+                    skip = self._write_skip(skip, prev_bound, out)
+                    upper = self._write_ids(lower, upper, curr_bound, out, len(output))
+                    output.extend(out)
+                    out = bytearray()
+            else:
+                raise ValueError(f"Unexpected mode: {mode}.")
+
+            if self._exceeded(len(output) + len(out)):
+                # the remaining ranges are left for the next round trip
+                output.extend(self._encode_bound((MAX_TIMESTAMP, b"")))
+                output.extend(encode_varint(MODE_FINGERPRINT))
+                output.extend(self.storage.fingerprint(upper, storage_size))
+                break
+            output.extend(out)
+
+            prev_index = upper
+            prev_bound = curr_bound
+
+        if self.is_initiator and len(output) == 1:
+            return None
+        return bytes(output)
+
+    def _read_version(self, reader: "_Reader") -> bool:
+        version = reader.byte()
+        if version < 0x60 or version > 0x6F:
+            raise ValueError("Invalid negentropy protocol version byte.")
+        if version != PROTOCOL_VERSION and self.is_initiator:
+            raise ValueError(f"Unsupported protocol version: {version - 0x60}.")
+        return version == PROTOCOL_VERSION
+
+    def _write_skip(
+        self, skip: bool, prev_bound: tuple[int, bytes], out: bytearray
+    ) -> bool:
+        """Ranges skipped so far are sent as one, before a range with content."""
+        if skip:
+            out.extend(self._encode_bound(prev_bound))
+            out.extend(encode_varint(MODE_SKIP))
+        return False
+
+    def _compare_ids(self, lower: int, upper: int, their_ids: set[bytes]):
+        for id_ in self.storage.ids[lower:upper]:
+            if id_ in their_ids:
+                their_ids.discard(id_)
+            else:
+                self.have_ids.append(id_.hex())
+        self.need_ids.extend(id_.hex() for id_ in their_ids)
+
+    def _write_ids(
+        self,
+        lower: int,
+        upper: int,
+        upper_bound: tuple[int, bytes],
+        out: bytearray,
+        output_size: int,
+    ) -> int:
+        """
+        All our ids of the range. Returns the new upper index of the range
+        if the ids do not fit in the frame.
+        """
+        ids = bytearray()
+        for index in range(lower, upper):
+            if self._exceeded(output_size + len(ids)):
+                upper_bound = self.storage.keys[index]
+                upper = index
+                break
+            ids.extend(self.storage.ids[index])
+        out.extend(self._encode_bound(upper_bound))
+        out.extend(encode_varint(MODE_ID_LIST))
+        out.extend(encode_varint(len(ids) // ID_SIZE))
+        out.extend(ids)
+        return upper
+
+    def _split_range(
+        self, lower: int, upper: int, upper_bound: tuple[int, bytes], out: bytearray
+    ):
+        count = upper - lower
+        if count < BUCKETS * 2:
+            out.extend(self._encode_bound(upper_bound))
+            out.extend(encode_varint(MODE_ID_LIST))
+            out.extend(encode_varint(count))
+            for id_ in self.storage.ids[lower:upper]:
+                out.extend(id_)
+            return
+
+        items_per_bucket, buckets_with_extra = divmod(count, BUCKETS)
+        curr = lower
+        for i in range(BUCKETS):
+            bucket_size = items_per_bucket + (1 if i < buckets_with_extra else 0)
+            fingerprint = self.storage.fingerprint(curr, curr + bucket_size)
+            curr += bucket_size
+            if curr == upper:
+                next_bound = upper_bound
+            else:
+                next_bound = _minimal_bound(
+                    self.storage.keys[curr - 1], self.storage.keys[curr]
+                )
+            out.extend(self._encode_bound(next_bound))
+            out.extend(encode_varint(MODE_FINGERPRINT))
+            out.extend(fingerprint)
+
+    def _exceeded(self, size: int) -> bool:
+        # room for the last range (bound and fingerprint)
+        return self.frame_size_limit != 0 and size > self.frame_size_limit - 200
+
+    def _encode_bound(self, bound: tuple[int, bytes]) -> bytes:
+        timestamp, prefix = bound
+        if timestamp == MAX_TIMESTAMP:
+            self._last_timestamp_out = MAX_TIMESTAMP
+            encoded = encode_varint(0)
+        else:
+            encoded = encode_varint(timestamp - self._last_timestamp_out + 1)
+            self._last_timestamp_out = timestamp
+        return encoded + encode_varint(len(prefix)) + prefix
+
+    def _decode_bound(self, reader: "_Reader") -> tuple[int, bytes]:
+        timestamp = reader.varint()
+        if timestamp == 0 or self._last_timestamp_in == MAX_TIMESTAMP:
+            self._last_timestamp_in = MAX_TIMESTAMP
+        else:
+            self._last_timestamp_in += timestamp - 1
+        length = reader.varint()
+        if length > ID_SIZE:
+            raise ValueError("Bound key too long.")
+        return self._last_timestamp_in, reader.bytes(length)
+
+
+def _minimal_bound(
+    prev: tuple[int, bytes], curr: tuple[int, bytes]
+) -> tuple[int, bytes]:
+    """The shortest bound that separates two consecutive items."""
+    if curr[0] != prev[0]:
+        return curr[0], b""
+    shared = 0
+    while shared < ID_SIZE and curr[1][shared] == prev[1][shared]:
+        shared += 1
+    return curr[0], curr[1][: shared + 1]
+
+
+def encode_varint(n: int) -> bytes:
+    """Base 128, most significant group first."""
+    if n == 0:
+        return b"\x00"
+    groups = []
+    while n:
+        groups.append(n & 0x7F)
+        n >>= 7
+    groups.reverse()
+    return bytes([g | 0x80 for g in groups[:-1]] + [groups[-1]])
+
+
+class _Reader:
+    __slots__ = ("_data", "_pos")
+
+    def __init__(self, data: bytes):
+        self._data = data
+        self._pos = 0
+
+    def done(self) -> bool:
+        return self._pos >= len(self._data)
+
+    def byte(self) -> int:
+        return self.bytes(1)[0]
+
+    def bytes(self, n: int) -> bytes:
+        if self._pos + n > len(self._data):
+            raise ValueError("Message too short.")
+        value = self._data[self._pos : self._pos + n]
+        self._pos += n
+        return value
+
+    def varint(self) -> int:
+        n = 0
+        while True:
+            byte = self.byte()
+            n = (n << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                return n
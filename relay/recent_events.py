@@ -0,0 +1,195 @@
+from bisect import insort
+from collections import Counter
+from collections.abc import Collection, Sequence
+
+from .event import BaseNostrEvent
+from .filter import NostrFilter
+
+# bounds of the buffer of one relay
+RECENT_EVENTS_MAX_COUNT = 5000
+RECENT_EVENTS_MAX_BYTES = 5 * 1024 * 1024
+
+
+class RecentEvents:
+    """
+    The newest stored events of a relay, ordered by `(created_at, id)`.
+    Every stored event with `created_at >= watermark` is in the buffer, so the
+    REQs for that time window are answered without the database.
+    The buffer is seeded from the database on first use (`start_seeding()`,
+    then `seed()`); the events stored meanwhile are kept aside and merged.
+    """
+
+    __slots__ = (
+        "_events",
+        "_generation",
+        "_keys",
+        "_kinds",
+        "_pending",
+        "bytes",
+        "max_bytes",
+        "max_count",
+        "ready",
+        "watermark",
+    )
+
+    def __init__(
+        self,
+        max_count: int = RECENT_EVENTS_MAX_COUNT,
+        max_bytes: int = RECENT_EVENTS_MAX_BYTES,
+    ):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.ready = False
+        self.watermark = 0
+        self.bytes = 0
+        self._keys: list[tuple[int, str]] = []
+        self._events: dict[str, BaseNostrEvent] = {}
+        # number of events per kind, see `_can_answer()`
+        self._kinds: Counter[int] = Counter()
+        self._pending: list[BaseNostrEvent] | None = None
+        self._generation = 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @property
+    def is_seeding(self) -> bool:
+        return self._pending is not None
+
+    def start_seeding(self) -> int:
+        """Returns the generation that must be passed to `seed()`."""
+        self._pending = []
+        return self._generation
+
+    def seed(self, generation: int, events: Sequence[BaseNostrEvent], complete: bool):
+        """
+        `events` are the newest stored events (at most `max_count`), `complete`
+        if these are all the events of the relay.
+        Ignored if the buffer was invalidated after `start_seeding()`.
+        """
+        if generation != self._generation or self._pending is None:
+            return
+        pending, self._pending = self._pending, None
+        self.ready = True
+        if not complete and events:
+            # other events with the same `created_at` might not be loaded
+            self.watermark = min(e.created_at for e in events) + 1
+        for event in [*events, *pending]:
+            self.add(event)
+
+    def add(self, event: BaseNostrEvent):
+        """Called for every stored event."""
+        if self._pending is not None:
+            self._pending.append(event)
+            return
+        if not self.ready or event.created_at < self.watermark:
+            return
+        if event.id in self._events:
+            return
+        insort(self._keys, (event.created_at, event.id))
+        self._events[event.id] = event
+        self._kinds[event.kind] += 1
+        self.bytes += event.size_bytes
+        self._evict()
+
+    def remove_matching(self, nostr_filter: NostrFilter):
+        """Called when the events matching `nostr_filter` are deleted."""
+        if self._pending is not None:
+            # the events being loaded might include deleted ones
+            self.invalidate()
+            return
+        self._remove([e for e in self._events.values() if _matches(nostr_filter, e)])
+
+    def remove_ids(self, ids: Collection[str]):
+        """Called when the events with these ids are deleted."""
+        if self._pending is not None:
+            self.invalidate()
+            return
+        self._remove([self._events[i] for i in ids if i in self._events])
+
+    def invalidate(self):
+        """Drop all events, the buffer is seeded again on next use."""
+        self._generation += 1
+        self._pending = None
+        self.ready = False
+        self.watermark = 0
+        self.bytes = 0
+        self._keys = []
+        self._events = {}
+        self._kinds = Counter()
+
+    def query(self, nostr_filter: NostrFilter) -> list[BaseNostrEvent] | None:
+        """
+        The events matching the filter, newest first (same as the database).
+        `None` if older events, that are not in the buffer, could also match.
+        """
+        limit = (
+            nostr_filter.limit if nostr_filter.limit and nostr_filter.limit > 0 else 0
+        )
+        if not self._can_answer(nostr_filter, limit):
+            return None
+        events = []
+        for _, event_id in reversed(self._keys):
+            event = self._events[event_id]
+            if _matches(nostr_filter, event):
+                events.append(event)
+                if limit and len(events) == limit:
+                    break
+        return events
+
+    def _can_answer(self, nostr_filter: NostrFilter, limit: int) -> bool:
+        """
+        Checked before the events are scanned, so the filters answered by the
+        database do not pay for a scan of the buffer.
+        """
+        if not self.ready or nostr_filter.search_terms():
+            # search results are ordered by relevance
+            return False
+        if self.watermark == 0:
+            return True
+        if nostr_filter.since and nostr_filter.since >= self.watermark:
+            return True
+        # all the buffered events of the filter kinds match: the limit is
+        # reached in the buffer if there are enough of them
+        if (
+            not limit
+            or nostr_filter.ids
+            or nostr_filter.authors
+            or nostr_filter.tag_filters()
+            or nostr_filter.until
+        ):
+            return False
+        if not nostr_filter.kinds:
+            return len(self._keys) >= limit
+        return sum(self._kinds[kind] for kind in set(nostr_filter.kinds)) >= limit
+
+    def _remove(self, events: list[BaseNostrEvent]):
+        if not events:
+            return
+        for event in events:
+            del self._events[event.id]
+            self._kinds[event.kind] -= 1
+            self.bytes -= event.size_bytes
+        self._keys = [k for k in self._keys if k[1] in self._events]
+
+    def _evict(self):
+        while len(self._keys) > self.max_count or self.bytes > self.max_bytes:
+            created_at, event_id = self._keys.pop(0)
+            self._drop(event_id)
+            self.watermark = max(self.watermark, created_at + 1)
+        # the remaining events with the same `created_at` are incomplete now
+        while self._keys and self._keys[0][0] < self.watermark:
+            _, event_id = self._keys.pop(0)
+            self._drop(event_id)
+
+    def _drop(self, event_id: str):
+        event = self._events.pop(event_id)
+        self._kinds[event.kind] -= 1
+        self.bytes -= event.size_bytes
+
+
+def _matches(nostr_filter: NostrFilter, event: BaseNostrEvent) -> bool:
+    # `until` is exclusive for the database queries
+    if nostr_filter.until and event.created_at >= nostr_filter.until:
+        return False
+    return nostr_filter.matches(event)
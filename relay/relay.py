@@ -9,6 +9,7 @@ class Spec(BaseModel):
 class FilterSpec(Spec):
     max_client_filters: int = Field(default=0, alias="maxClientFilters")
     limit_per_filter: int = Field(default=1000, alias="limitPerFilter")
+    max_filter_list_size: int = Field(default=5000, alias="maxFilterListSize")
 
 
 class EventSpec(Spec):
@@ -80,6 +81,18 @@ class PaymentSpec(Spec):
         return not self.is_paid_relay or self.cost_to_join == 0
 
 
+class ConnectionSpec(Spec):
+    send_queue_size: int = Field(default=1000, alias="sendQueueSize")
+    slow_client_action: str = Field(default="drop", alias="slowClientAction")
+    # NIP-77 sync
+    max_negentropy_sessions: int = Field(default=4, alias="maxNegentropySessions")
+    negentropy_max_records: int = Field(default=100_000, alias="negentropyMaxRecords")
+
+    @property
+    def disconnect_slow_clients(self) -> bool:
+        return self.slow_client_action == "disconnect"
+
+
 class WalletSpec(Spec):
     wallet: str = Field(default="")
 
@@ -92,7 +105,7 @@ class RelayPublicSpec(FilterSpec, EventSpec, StorageSpec, PaymentSpec):
         return self.free_storage_value == 0 and not self.is_paid_relay
 
 
-class RelaySpec(RelayPublicSpec, WalletSpec, AuthSpec):
+class RelaySpec(RelayPublicSpec, WalletSpec, AuthSpec, ConnectionSpec):
     pass
 
 
@@ -116,7 +129,7 @@ class NostrRelay(BaseModel):
     ) -> dict:
         return {
             "contact": "https://t.me/lnbits",
-            "supported_nips": [1, 2, 4, 9, 11, 15, 16, 20, 22, 28, 42],
+            "supported_nips": [1, 2, 4, 9, 11, 15, 16, 20, 22, 28, 42, 45, 50, 77],
             "software": "LNbits",
             "version": "",
         }
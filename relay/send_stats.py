@@ -0,0 +1,55 @@
+class NostrSendStats:
+    """
+    Counters of the outbound messages. Every write pass of a connection
+    sends the messages queued since the previous pass (a batch, bounded).
+    The latency is the time a message waited in the send queue.
+    """
+
+    __slots__ = (
+        "batches",
+        "bytes",
+        "dropped",
+        "latency_max",
+        "latency_total",
+        "messages",
+    )
+
+    def __init__(self) -> None:
+        self.messages = 0
+        self.bytes = 0
+        self.batches = 0
+        self.dropped = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def record_batch(self, sizes: list[int], latencies: list[float]):
+        self.batches += 1
+        self.messages += len(sizes)
+        self.bytes += sum(sizes)
+        self.latency_total += sum(latencies)
+        self.latency_max = max(self.latency_max, *latencies)
+
+    def add(self, other: "NostrSendStats"):
+        self.messages += other.messages
+        self.bytes += other.bytes
+        self.batches += other.batches
+        self.dropped += other.dropped
+        self.latency_total += other.latency_total
+        self.latency_max = max(self.latency_max, other.latency_max)
+
+    def dict(self) -> dict:
+        return {
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "messages_per_batch": (
+                round(self.messages / self.batches, 2) if self.batches else 0
+            ),
+            "avg_latency_ms": (
+                round(self.latency_total * 1000 / self.messages, 3)
+                if self.messages
+                else 0
+            ),
+            "max_latency_ms": round(self.latency_max * 1000, 3),
+        }
@@ -0,0 +1,102 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from ..helpers import LRUCache
+from .event import BaseNostrEvent
+
+
+class SignatureVerifier:
+    """
+    Checks the `id` and `sig` of the events in worker threads, so the hashing
+    and the Schnorr verification (coincurve releases the GIL) do not block the
+    event loop. Checks requested in the same loop iteration are sent to the
+    thread pool as one batch.
+    Recently verified `(id, sig)` pairs are remembered, re-published events only
+    need their `id` recomputed (which binds the pair to the event content).
+    """
+
+    def __init__(
+        self,
+        max_workers: int | None = None,
+        max_batch_size: int = 64,
+        verified_cache_size: int = 10_000,
+    ):
+        self.max_batch_size = max_batch_size
+        self._verified = LRUCache(maxsize=verified_cache_size)
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending: list[tuple[BaseNostrEvent, asyncio.Future]] = []
+        self._flush_scheduled = False
+
+    async def verify(self, e: BaseNostrEvent):
+        """Raises `ValueError` if the event `id` or `sig` is not valid."""
+        if (e.id, e.sig) in self._verified and e.id == e.event_id:
+            return
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((e, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush)
+
+        error = await future
+        if error:
+            raise ValueError(error)
+        self._verified.set((e.id, e.sig), True)
+
+    def shutdown(self):
+        """Stop the worker threads. They are started again if needed."""
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="nostrrelay-verify"
+            )
+        return self._executor
+
+    def _flush(self):
+        self._flush_scheduled = False
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        loop = asyncio.get_running_loop()
+        events = [e for e, _ in batch]
+        futures = [f for _, f in batch]
+        result = loop.run_in_executor(self.executor, _check_signatures, events)
+
+        def resolve(done: asyncio.Future):
+            for i, future in enumerate(futures):
+                if future.done():
+                    continue
+                if done.cancelled():
+                    future.cancel()
+                elif done.exception():
+                    future.set_exception(done.exception())  # type: ignore
+                else:
+                    future.set_result(done.result()[i])
+
+        result.add_done_callback(resolve)
+
+
+def _check_signatures(events: list[BaseNostrEvent]) -> list[str | None]:
+    errors: list[str | None] = []
+    for e in events:
+        try:
+            e.check_signature()
+            errors.append(None)
+        except ValueError as ex:
+            errors.append(str(ex))
+    return errors
+
+
+signature_verifier = SignatureVerifier()
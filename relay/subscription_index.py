@@ -0,0 +1,127 @@
+import string
+from itertools import count
+from typing import TYPE_CHECKING, Any
+
+from .event import BaseNostrEvent
+from .filter import NostrFilter
+
+if TYPE_CHECKING:
+    from .client_connection import NostrClientConnection
+
+# tag filters (NIP-01 `#<letter>`) that can be used as index keys
+INDEXED_TAGS = frozenset(string.ascii_letters)
+
+# key under which filters without any indexable condition are stored
+MATCH_ALL_KEY = ("*", None)
+
+
+class _Subscription:
+    __slots__ = ("client", "keys", "nostr_filter", "seq")
+
+    def __init__(
+        self,
+        client: "NostrClientConnection",
+        nostr_filter: NostrFilter,
+        keys: list[tuple[str, Any]],
+        seq: int,
+    ):
+        self.client = client
+        self.nostr_filter = nostr_filter
+        self.keys = keys
+        self.seq = seq
+
+
+class NostrSubscriptionIndex:
+    """
+    Relay wide inverted index of the active client filters.
+    Every filter is stored under the values of its most selective condition
+    (`ids`, `authors`, tag values or `kinds`). A published event is looked up
+    by its own id, pubkey, tag values and kind, so only the filters that could
+    possibly match it are evaluated.
+    """
+
+    def __init__(self) -> None:
+        self._index: dict[tuple[str, Any], dict[int, _Subscription]] = {}
+        self._subscriptions: dict[int, _Subscription] = {}
+        # the filters of every client, so a disconnect does not scan them all
+        self._client_filters: dict[int, set[int]] = {}
+        self._seq = count()
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def add(self, client: "NostrClientConnection", nostr_filter: NostrFilter):
+        self.remove(nostr_filter)
+        keys = self._index_keys(nostr_filter)
+        sub = _Subscription(client, nostr_filter, keys, next(self._seq))
+        self._subscriptions[id(nostr_filter)] = sub
+        self._client_filters.setdefault(id(client), set()).add(id(nostr_filter))
+        for key in keys:
+            self._index.setdefault(key, {})[id(nostr_filter)] = sub
+
+    def remove(self, nostr_filter: NostrFilter):
+        sub = self._subscriptions.pop(id(nostr_filter), None)
+        if not sub:
+            return
+        client_filters = self._client_filters.get(id(sub.client))
+        if client_filters is not None:
+            client_filters.discard(id(nostr_filter))
+            if not client_filters:
+                del self._client_filters[id(sub.client)]
+        for key in sub.keys:
+            bucket = self._index.get(key)
+            if bucket is None:
+                continue
+            bucket.pop(id(nostr_filter), None)
+            if not bucket:
+                del self._index[key]
+
+    def remove_client(self, client: "NostrClientConnection"):
+        for filter_key in list(self._client_filters.get(id(client), ())):
+            self.remove(self._subscriptions[filter_key].nostr_filter)
+
+    def matches(
+        self, event: BaseNostrEvent
+    ) -> list[tuple["NostrClientConnection", NostrFilter]]:
+        """
+        Returns the clients interested in this event, together with the first
+        (oldest) of their filters that matches it.
+        """
+        candidates: dict[int, _Subscription] = {}
+        for key in self._event_keys(event):
+            bucket = self._index.get(key)
+            if bucket:
+                candidates.update(bucket)
+
+        matched: dict[int, _Subscription] = {}
+        for sub in sorted(candidates.values(), key=lambda s: s.seq):
+            client_key = id(sub.client)
+            if client_key in matched:
+                continue
+            if sub.nostr_filter.matches(event):
+                matched[client_key] = sub
+
+        return [(sub.client, sub.nostr_filter) for sub in matched.values()]
+
+    def _index_keys(self, nostr_filter: NostrFilter) -> list[tuple[str, Any]]:
+        if len(nostr_filter.ids) != 0:
+            return [("ids", v) for v in nostr_filter.ids]
+        if len(nostr_filter.authors) != 0:
+            return [("authors", v) for v in nostr_filter.authors]
+        for tag_name, values in nostr_filter.tag_filters():
+            return [(f"#{tag_name}", v) for v in values]
+        if len(nostr_filter.kinds) != 0:
+            return [("kinds", v) for v in nostr_filter.kinds]
+        return [MATCH_ALL_KEY]
+
+    def _event_keys(self, event: BaseNostrEvent) -> list[tuple[str, Any]]:
+        keys: list[tuple[str, Any]] = [
+            ("ids", event.id),
+            ("authors", event.pubkey),
+            ("kinds", event.kind),
+            MATCH_ALL_KEY,
+        ]
+        for tag in event.tags:
+            if len(tag) > 1 and tag[0] in INDEXED_TAGS:
+                keys.append((f"#{tag[0]}", tag[1]))
+        return keys
@@ -95,6 +95,12 @@ window.app.component('relay-details', {
         {value: 'prune', label: 'Prune Old Events'}
       ]
     },
+    slowClientActions() {
+      return [
+        {value: 'drop', label: 'Drop Oldest Events'},
+        {value: 'disconnect', label: 'Disconnect Client'}
+      ]
+    },
     wssLink() {
       this.relay.meta.domain =
         this.relay.meta.domain || window.location.hostname
@@ -1,12 +1,18 @@
 import asyncio
 import json
+import time
 
 from lnbits.core.models import Payment
 from lnbits.core.services import websocket_updater
 from lnbits.tasks import register_invoice_listener
 from loguru import logger
 
-from .crud import create_account, get_account, update_account
+from .crud import (
+    compact_deleted_events,
+    create_account,
+    get_account,
+    update_account,
+)
 from .models import NostrAccount
 
 
@@ -19,6 +25,24 @@ async def wait_for_paid_invoices():
         await on_invoice_paid(payment)
 
 
+# deleted events are kept for a while (for example for a later recovery)
+DELETED_EVENTS_RETENTION_SECONDS = 7 * 24 * 60 * 60
+COMPACTION_INTERVAL_SECONDS = 60 * 60
+
+
+async def compact_events():
+    """Remove the deleted events older than the retention time."""
+    while True:
+        await asyncio.sleep(COMPACTION_INTERVAL_SECONDS)
+        deleted_before = int(time.time()) - DELETED_EVENTS_RETENTION_SECONDS
+        stats = await compact_deleted_events(deleted_before)
+        if stats.events or stats.tags:
+            logger.info(
+                f"Nostrrelay compaction removed {stats.events} events "
+                f"({stats.bytes} bytes) and {stats.tags} tags."
+            )
+
+
 async def on_invoice_paid(payment: Payment):
     if payment.extra.get("tag") != "nostrrely":
         return
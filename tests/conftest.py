@@ -1,5 +1,6 @@
 import asyncio
 import inspect
+from collections.abc import Awaitable, Callable
 
 import pytest
 import pytest_asyncio
@@ -8,6 +9,7 @@ from loguru import logger
 from pydantic import BaseModel
 
 from .. import migrations
+from ..crud import create_event
 from ..relay.event import NostrEvent
 from .helpers import get_fixtures
 
@@ -18,6 +20,9 @@ class EventFixture(BaseModel):
     data: NostrEvent
 
 
+StoreEvents = Callable[..., Awaitable[list[NostrEvent]]]
+
+
 @pytest.fixture(scope="session")
 def event_loop():
     loop = asyncio.get_event_loop()
@@ -32,11 +37,15 @@ async def migrate_db():
     await db.execute("DROP TABLE IF EXISTS nostrrelay.relays;")
     await db.execute("DROP TABLE IF EXISTS nostrrelay.event_tags;")
     await db.execute("DROP TABLE IF EXISTS nostrrelay.accounts;")
+    await db.execute("DROP TABLE IF EXISTS nostrrelay.events_search_ids;")
+    await db.execute("DROP TABLE IF EXISTS nostrrelay.events_search;")
+    await db.execute("DROP TABLE IF EXISTS nostrrelay.event_tag_index;")
 
     # check if exists else skip migrations
-    for key, migrate in inspect.getmembers(migrations, inspect.isfunction):
-        logger.info(f"Running migration '{key}'.")
-        await migrate(db)
+    async with db.connect() as conn:
+        for key, migrate in inspect.getmembers(migrations, inspect.isfunction):
+            logger.info(f"Running migration '{key}'.")
+            await migrate(conn)
 
     yield db
 
@@ -47,6 +56,28 @@ def valid_events(migrate_db) -> list[EventFixture]:
     return [EventFixture.parse_obj(e) for e in data["valid"]]
 
 
+@pytest.fixture(scope="session")
+def stored_events(valid_events: list[EventFixture]) -> StoreEvents:
+    async def store(
+        relay_id: str, contents: list[str] | None = None
+    ) -> list[NostrEvent]:
+        """
+        Store copies of the valid events in the relay `relay_id`. With
+        `contents`, only the first `len(contents)` events, with that content.
+        """
+        events = [f.data.copy(update={"relay_id": relay_id}) for f in valid_events]
+        if contents is not None:
+            events = [
+                e.copy(update={"content": content})
+                for e, content in zip(events, contents, strict=False)
+            ]
+        for e in events:
+            await create_event(e)
+        return events
+
+    return store
+
+
 @pytest.fixture(scope="session")
 def invalid_events(migrate_db) -> list[EventFixture]:
     data = get_fixtures("events")
@@ -0,0 +1,27 @@
+import pytest
+
+from ..crud import create_account, delete_account, get_account, update_account
+from ..models import NostrAccount
+
+RELAY_ID = "r_accounts"
+PUBKEY = "a24496bca5dd73300f4e5d5d346c73132b7354c597fcbb6509891747b4689211"
+
+
+@pytest.mark.asyncio
+async def test_account_cache_is_invalidated_on_change():
+    assert await get_account(RELAY_ID, PUBKEY) is None
+
+    await create_account(NostrAccount(relay_id=RELAY_ID, pubkey=PUBKEY, sats=21))
+    account = await get_account(RELAY_ID, PUBKEY)
+    assert account and account.sats == 21, "Created account must be visible"
+
+    account.paid_to_join = True
+    cached_account = await get_account(RELAY_ID, PUBKEY)
+    assert cached_account and not cached_account.paid_to_join, "Cache was changed"
+
+    await update_account(account)
+    account = await get_account(RELAY_ID, PUBKEY)
+    assert account and account.paid_to_join, "Updated account must be visible"
+
+    await delete_account(RELAY_ID, PUBKEY)
+    assert await get_account(RELAY_ID, PUBKEY) is None
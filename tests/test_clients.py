@@ -1,17 +1,24 @@
 import asyncio
-from json import dumps, loads
+from json import loads
 
 import pytest
 from fastapi import WebSocket
 from loguru import logger
 
+from ..helpers import json_dumps
 from ..relay.client_connection import (
+    MAX_CONCURRENT_REQUESTS,
+    MAX_PENDING_MESSAGES,
+    WRITE_BATCH_MAX_MESSAGES,
     NostrClientConnection,
 )
 from ..relay.client_manager import (
     NostrClientManager,
 )
+from ..relay.filter import NostrFilter
+from ..relay.negentropy import Negentropy, NegentropyStorage
 from ..relay.relay import RelaySpec
+from .conftest import EventFixture, StoreEvents
 from .helpers import get_fixtures
 
 fixtures = get_fixtures("clients")
@@ -37,8 +44,8 @@ class MockWebSocket(WebSocket):
     async def send_text(self, data: str):
         self.sent_messages.append(data)
 
-    async def wire_mock_data(self, data: dict):
-        await self.fake_wire.put(dumps(data))
+    async def wire_mock_data(self, data: dict | list):
+        await self.fake_wire.put(json_dumps(data))
 
     async def close(self, code: int = 1000, reason: str | None = None) -> None:
         logger.info(f"{code}: {reason}")
@@ -103,13 +110,16 @@ async def alice_wires_meta_and_post01(ws_alice: MockWebSocket):
     assert (
         len(ws_alice.sent_messages) == 4
     ), "Alice: Expected 4 confirmations to be sent"
-    assert ws_alice.sent_messages[0] == dumps(
+    assert ws_alice.sent_messages[0] == json_dumps(
         alice["meta_response"]
     ), "Alice: Wrong confirmation for meta"
-    assert ws_alice.sent_messages[1] == dumps(
+    assert ws_alice.sent_messages[1] == json_dumps(
         alice["post01_response_ok"]
     ), "Alice: Wrong confirmation for post01"
-    assert ws_alice.sent_messages[3] == dumps(
+    assert ws_alice.sent_messages[2] == json_dumps(
+        ["OK", alice["post01"][1]["id"], True, "duplicate: already have this event"]
+    ), "Alice: Expected duplicate confirmation for post01"
+    assert ws_alice.sent_messages[3] == json_dumps(
         alice["meta_update_response"]
     ), "Alice: Expected confirmation for meta update"
 
@@ -126,19 +136,19 @@ async def bob_wires_meta_and_folows_alice(ws_bob: MockWebSocket):
     await asyncio.sleep(0.5)
 
     assert len(ws_bob.sent_messages) == 5, "Bob: Expected 5 confirmations to be sent"
-    assert ws_bob.sent_messages[0] == dumps(
+    assert ws_bob.sent_messages[0] == json_dumps(
         bob["meta_response"]
     ), "Bob: Wrong confirmation for meta"
-    assert ws_bob.sent_messages[1] == dumps(
+    assert ws_bob.sent_messages[1] == json_dumps(
         ["EVENT", "profile", alice["meta_update"][1]]
     ), "Bob: Wrong response for Alice's meta (updated version)"
-    assert ws_bob.sent_messages[2] == dumps(
+    assert ws_bob.sent_messages[2] == json_dumps(
         ["EOSE", "profile"]
     ), "Bob: Wrong End Of Streaming Event for profile"
-    assert ws_bob.sent_messages[3] == dumps(
+    assert ws_bob.sent_messages[3] == json_dumps(
         ["EVENT", "sub0", alice["post01"][1]]
     ), "Bob: Wrong posts for Alice"
-    assert ws_bob.sent_messages[4] == dumps(
+    assert ws_bob.sent_messages[4] == json_dumps(
         ["EOSE", "sub0"]
     ), "Bob: Wrong End Of Streaming Event for sub0"
 
@@ -156,20 +166,20 @@ async def bob_wires_contact_list(ws_alice: MockWebSocket, ws_bob: MockWebSocket)
     assert (
         len(ws_bob.sent_messages) == 2
     ), "Bob: Expected 1 confirmation for create contact list"
-    assert ws_bob.sent_messages[0] == dumps(
+    assert ws_bob.sent_messages[0] == json_dumps(
         bob["contact_list_create_response"]
     ), "Bob: Wrong confirmation for contact list create"
-    assert ws_bob.sent_messages[1] == dumps(
+    assert ws_bob.sent_messages[1] == json_dumps(
         bob["contact_list_update_response"]
     ), "Bob: Wrong confirmation for contact list update"
 
     assert (
         len(ws_alice.sent_messages) == 2
     ), "Alice: Expected 3 messages for Bob's contact list"
-    assert ws_alice.sent_messages[0] == dumps(
+    assert ws_alice.sent_messages[0] == json_dumps(
         ["EVENT", "contact", bob["contact_list_update"][1]]
     ), "Alice: Expected to receive the updated contact list (two items)"
-    assert ws_alice.sent_messages[1] == dumps(
+    assert ws_alice.sent_messages[1] == json_dumps(
         ["EOSE", "contact"]
     ), "Alice: Wrong End Of Streaming Event for contact list"
 
@@ -183,10 +193,10 @@ async def alice_wires_post02_____bob_is_notified(
     await ws_alice.wire_mock_data(alice["post02"])
     await asyncio.sleep(0.1)
 
-    assert ws_alice.sent_messages[0] == dumps(
+    assert ws_alice.sent_messages[0] == json_dumps(
         alice["post02_response_ok"]
     ), "Alice: Wrong confirmation for post02"
-    assert ws_bob.sent_messages[0] == dumps(
+    assert ws_bob.sent_messages[0] == json_dumps(
         ["EVENT", "sub0", alice["post02"][1]]
     ), "Bob: Wrong notification for post02"
 
@@ -206,7 +216,7 @@ async def bob_likes_post01_____alice_subscribes_and_receives_notifications(
         len(ws_alice.sent_messages) == 2
     ), "Alice: Expected 2 confirmations to be sent"
 
-    assert ws_alice.sent_messages[0] == dumps(
+    assert ws_alice.sent_messages[0] == json_dumps(
         [
             "EVENT",
             "notifications:0b29ecc73ba400e5b4bd1e4cb0d8f524e9958345",
@@ -214,7 +224,7 @@ async def bob_likes_post01_____alice_subscribes_and_receives_notifications(
         ]
     ), "Alice: must receive 'like' notification"
 
-    assert ws_alice.sent_messages[1] == dumps(
+    assert ws_alice.sent_messages[1] == json_dumps(
         ["EOSE", "notifications:0b29ecc73ba400e5b4bd1e4cb0d8f524e9958345"]
     ), "Alice: receive stored notifications done"
 
@@ -232,23 +242,23 @@ async def bob_likes_and_comments_____alice_receives_notifications(
     assert (
         len(ws_bob.sent_messages) == 2
     ), "Bob: Expected 2 confirmations to be sent (for like & comment)"
-    assert ws_bob.sent_messages[0] == dumps(
+    assert ws_bob.sent_messages[0] == json_dumps(
         bob["like_post02_response"]
     ), "Bob: Wrong confirmation for like on post02"
-    assert ws_bob.sent_messages[1] == dumps(
+    assert ws_bob.sent_messages[1] == json_dumps(
         bob["comment_on_alice_post01_response"]
     ), "Bob: Wrong confirmation for comment on post01"
     assert (
         len(ws_alice.sent_messages) == 2
     ), "Alice: Expected 2 notifications to be sent (for like & comment)"
-    assert ws_alice.sent_messages[0] == dumps(
+    assert ws_alice.sent_messages[0] == json_dumps(
         [
             "EVENT",
             "notifications:0b29ecc73ba400e5b4bd1e4cb0d8f524e9958345",
             bob["like_post02"][1],
         ]
     ), "Alice: Wrong notification for like on post02"
-    assert ws_alice.sent_messages[1] == dumps(
+    assert ws_alice.sent_messages[1] == json_dumps(
         [
             "EVENT",
             "notifications:0b29ecc73ba400e5b4bd1e4cb0d8f524e9958345",
@@ -267,13 +277,13 @@ async def bob_writes_to_alice(ws_alice: MockWebSocket, ws_bob: MockWebSocket):
     assert (
         len(ws_bob.sent_messages) == 1
     ), "Bob: Expected confirmation for direct message"
-    assert ws_bob.sent_messages[0] == dumps(
+    assert ws_bob.sent_messages[0] == json_dumps(
         bob["direct_message01_response"]
     ), "Bob: Wrong confirmation for direct message"
     assert (
         len(ws_alice.sent_messages) == 1
     ), "Alice: Expected confirmation for direct message"
-    assert ws_alice.sent_messages[0] == dumps(
+    assert ws_alice.sent_messages[0] == json_dumps(
         [
             "EVENT",
             "notifications:0b29ecc73ba400e5b4bd1e4cb0d8f524e9958345",
@@ -292,7 +302,7 @@ async def alice_writes_to_bob(ws_alice: MockWebSocket, ws_bob: MockWebSocket):
     assert (
         len(ws_alice.sent_messages) == 1
     ), "Alice: Expected confirmation for direct message"
-    assert ws_alice.sent_messages[0] == dumps(
+    assert ws_alice.sent_messages[0] == json_dumps(
         alice["direct_message01_response"]
     ), "Alice: Wrong confirmation for direct message"
     assert len(ws_bob.sent_messages) == 0, "Bob: no subscription, no message"
@@ -304,14 +314,14 @@ async def alice_writes_to_bob(ws_alice: MockWebSocket, ws_bob: MockWebSocket):
         len(ws_bob.sent_messages) == 2
     ), "Bob: Receive message and EOSE after subscribe"
 
-    assert ws_bob.sent_messages[0] == dumps(
+    assert ws_bob.sent_messages[0] == json_dumps(
         [
             "EVENT",
             "notifications:d685447c43c7c18dbbea61923cf0b63e1ab46bed",
             alice["direct_message01"][1],
         ]
     ), "Bob: Finaly receives direct message from Alice"
-    assert ws_bob.sent_messages[1] == dumps(
+    assert ws_bob.sent_messages[1] == json_dumps(
         ["EOSE", "notifications:d685447c43c7c18dbbea61923cf0b63e1ab46bed"]
     ), "Bob: Received all stored events"
 
@@ -337,12 +347,12 @@ async def alice_deletes_post01__bob_is_notified(
     assert (
         len(ws_alice.sent_messages) == 1
     ), "Alice: Expected confirmation for delete post01"
-    assert ws_alice.sent_messages[0] == dumps(
+    assert ws_alice.sent_messages[0] == json_dumps(
         alice["delete_post01_response"]
     ), "Alice: Wrong confirmation for delete post01"
 
     assert len(ws_bob.sent_messages) == 2, "Bob: Expects 2 messages for delete post01"
-    assert ws_bob.sent_messages[0] == dumps(
+    assert ws_bob.sent_messages[0] == json_dumps(
         ["EOSE", "notifications:delete"]
     ), "Bob: Expect no delete notification on subscribe"
     assert loads(ws_bob.sent_messages[1]) == [
@@ -357,3 +367,306 @@ async def alice_deletes_post01__bob_is_notified(
     assert (
         len(ws_bob.sent_messages) == 2
     ), "Bob: Expected one posts from Alice plus and EOSE"
+
+
+@pytest.mark.asyncio
+async def test_slow_client_send_queue_overflow():
+    client_manager = NostrClientManager()
+    await client_manager.enable_relay(RELAY_ID, RelaySpec(send_queue_size=2))
+
+    ws = MockWebSocket()
+    client = NostrClientConnection(relay_id=RELAY_ID, websocket=ws)
+    await client_manager.add_client(client)
+
+    # the writer task is not running, so the queue is never drained
+    for i in range(3):
+        assert client._enqueue_msg(f"msg{i}"), "Drop oldest: message is accepted"
+    assert [client.outbox.get_nowait()[0] for _ in range(2)] == ["msg1", "msg2"]
+    assert client.send_stats.dropped == 1
+
+    # the responses to the client's own messages are never dropped
+    ok = ["OK", "event_id", True, ""]
+    await client._send_msg(ok)
+    for i in range(3):
+        assert client._enqueue_msg(f"msg{i}")
+    assert [client.outbox.get_nowait()[0] for _ in range(2)] == [
+        json_dumps(ok),
+        "msg2",
+    ]
+    await client._send_msg(ok)
+    await client._send_msg(ok)
+    assert not client._enqueue_msg("msg3"), "Only responses in the queue"
+    assert [client.outbox.get_nowait()[0] for _ in range(2)] == [json_dumps(ok)] * 2
+    assert client.send_stats.dropped == 4
+
+    await client_manager.enable_relay(
+        RELAY_ID, RelaySpec(send_queue_size=1, slow_client_action="disconnect")
+    )
+    client = NostrClientConnection(relay_id=RELAY_ID, websocket=ws)
+    await client_manager.add_client(client)
+
+    assert client._enqueue_msg("msg0")
+    assert not client._enqueue_msg("msg1"), "Disconnect: message is rejected"
+    await asyncio.sleep(0.1)
+    assert ws.sent_messages[-1] == json_dumps(
+        ["NOTICE", "Client too slow: the send queue is full."]
+    )
+    assert not client._enqueue_msg("msg2"), "Disconnected client gets no messages"
+
+
+@pytest.mark.asyncio
+async def test_writer_batches(valid_events: list[EventFixture]):
+    client_manager = NostrClientManager()
+    await client_manager.enable_relay(RELAY_ID, RelaySpec(send_queue_size=500))
+    ws = MockWebSocket()
+    client = NostrClientConnection(relay_id=RELAY_ID, websocket=ws)
+    await client_manager.add_client(client)
+
+    event = valid_events[1].data.copy(update={"content": "café ⚡"})
+    nostr_filter = NostrFilter(subscription_id="sub ⚡")
+    for _ in range(WRITE_BATCH_MAX_MESSAGES * 2 + 1):
+        assert client.notify_event(event, nostr_filter)
+    task = asyncio.create_task(client.start())
+    await asyncio.sleep(0.3)
+
+    stats = client.send_stats
+    assert stats.messages == len(ws.sent_messages) == WRITE_BATCH_MAX_MESSAGES * 2 + 1
+    assert stats.bytes == sum(len(m.encode()) for m in ws.sent_messages)
+    assert stats.batches == 3, "The batches are bounded"
+
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_message_pipeline(monkeypatch: pytest.MonkeyPatch):
+    client_manager = NostrClientManager()
+    await client_manager.enable_relay(RELAY_ID, RelaySpec())
+    ws = MockWebSocket()
+    client = NostrClientConnection(relay_id=RELAY_ID, websocket=ws)
+    await client_manager.add_client(client)
+
+    log: list[tuple[str, str]] = []
+    handle_other_message = client._handle_message
+
+    async def handle_message(data: list) -> list:
+        message_type, name = data[0], data[1]
+        if message_type not in ["EVENT", "REQ"]:
+            return await handle_other_message(data)
+        log.append(("start", name))
+        if message_type == "EVENT":
+            # the first events take longer, the OKs must still be in order
+            await asyncio.sleep(0.03 - int(name[1:]) * 0.01)
+            log.append(("end", name))
+            return [["OK", name]]
+        await asyncio.sleep(10 if name == "slow" else 0.05)
+        log.append(("end", name))
+        return [["EOSE", name]]
+
+    monkeypatch.setattr(client, "_handle_message", handle_message)
+    task = asyncio.create_task(client.start())
+
+    for i in range(3):
+        await ws.wire_mock_data(["EVENT", f"e{i}"])
+    await ws.wire_mock_data(["REQ", "slow"])
+    for i in range(MAX_CONCURRENT_REQUESTS + 2):
+        await ws.wire_mock_data(["REQ", f"sub{i}"])
+    await asyncio.sleep(0.5)
+    await ws.wire_mock_data(["CLOSE", "slow"])
+    await asyncio.sleep(0.3)
+
+    sent = [loads(m) for m in ws.sent_messages]
+    assert [m for m in sent if m[0] == "OK"] == [
+        ["OK", "e0"],
+        ["OK", "e1"],
+        ["OK", "e2"],
+    ]
+    assert sorted(m[1] for m in sent if m[0] == "EOSE") == sorted(
+        f"sub{i}" for i in range(MAX_CONCURRENT_REQUESTS + 2)
+    ), "All REQs are answered, except the closed one"
+    assert log.index(("start", "slow")) > log.index(
+        ("end", "e2")
+    ), "REQs wait for the EVENTs received before them"
+    # one slot is taken by the slow REQ
+    assert log.index(("start", f"sub{MAX_CONCURRENT_REQUESTS - 2}")) < log.index(
+        ("end", "sub0")
+    ), "REQs run concurrently"
+    assert log.index(("start", f"sub{MAX_CONCURRENT_REQUESTS - 1}")) > log.index(
+        ("end", "sub0")
+    ), "Concurrent REQs are limited"
+    assert "slow" not in client._requests, "CLOSE cancels the running REQ"
+
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_invalid_subscription_ids(monkeypatch: pytest.MonkeyPatch):
+    client_manager = NostrClientManager()
+    await client_manager.enable_relay(RELAY_ID, RelaySpec())
+    ws = MockWebSocket()
+    client = NostrClientConnection(relay_id=RELAY_ID, websocket=ws)
+    await client_manager.add_client(client)
+
+    async def handle_message(data: list) -> list:
+        return [["EOSE", data[1]]]
+
+    monkeypatch.setattr(client, "_handle_message", handle_message)
+    task = asyncio.create_task(client.start())
+
+    invalid_ids: list = [["sub"], {"id": 1}, 7, "", "x" * 65]
+    for i in range(MAX_PENDING_MESSAGES + 1):
+        await ws.wire_mock_data(["REQ", invalid_ids[i % len(invalid_ids)], {}])
+    await ws.wire_mock_data(["COUNT", "x" * 64, {}])
+    await asyncio.sleep(0.3)
+
+    sent = [loads(m) for m in ws.sent_messages]
+    assert sent[-1] == ["EOSE", "x" * 64], "No message slot is leaked"
+    assert sent[:-1] == [["NOTICE", "invalid: subscription id"]] * (
+        MAX_PENDING_MESSAGES + 1
+    )
+
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_duplicate_events_are_rate_limited(valid_events: list[EventFixture]):
+    relay_id = "r_duplicates"
+    client_manager = NostrClientManager()
+    await client_manager.enable_relay(relay_id, RelaySpec(max_events_per_hour=1))
+    ws = MockWebSocket()
+    client = NostrClientConnection(relay_id=relay_id, websocket=ws)
+    await client_manager.add_client(client)
+    task = asyncio.create_task(client.start())
+
+    event = valid_events[1].data
+    for _ in range(3):
+        await ws.wire_mock_data(["EVENT", event.nostr_dict()])
+        await asyncio.sleep(0.2)
+
+    assert [loads(m)[2:] for m in ws.sent_messages] == [
+        [True, ""],
+        [True, "duplicate: already have this event"],
+        [False, "Exceeded max events per hour limit'!"],
+    ], "Duplicates count for the rate limit"
+
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_request_with_multiple_filters(stored_events: StoreEvents):
+    relay_id = "r_multi_filter"
+    events = await stored_events(relay_id)
+
+    client_manager = NostrClientManager()
+    await client_manager.enable_relay(relay_id, RelaySpec())
+    ws = MockWebSocket()
+    client = NostrClientConnection(relay_id=relay_id, websocket=ws)
+    await client_manager.add_client(client)
+    task = asyncio.create_task(client.start())
+
+    author = events[0].pubkey
+    filters = [{"authors": [author]}, {"kinds": [1]}]
+    await ws.wire_mock_data(["REQ", "sub0", *filters])
+    await asyncio.sleep(0.5)
+
+    expected = {e.id for e in events if e.pubkey == author or e.kind == 1}
+    sent = [loads(m) for m in ws.sent_messages]
+    assert sent[-1] == ["EOSE", "sub0"], "One EOSE, after the stored events"
+    sent_ids = [m[2]["id"] for m in sent[:-1]]
+    assert len(sent_ids) == len(set(sent_ids)), "Events are sent only once"
+    assert set(sent_ids) == expected
+    assert len(client.filters) == 2, "All the filters of the REQ are kept"
+
+    stats = client_manager.send_stats(relay_id)
+    assert stats["connections"] == 1
+    assert stats["messages"] == len(ws.sent_messages)
+    assert stats["bytes"] == sum(len(m.encode()) for m in ws.sent_messages)
+    assert 0 < stats["batches"] < stats["messages"], "Queued messages are batched"
+
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_count(stored_events: StoreEvents):
+    relay_id = "r_count"
+    events = await stored_events(relay_id)
+
+    client_manager = NostrClientManager()
+    await client_manager.enable_relay(relay_id, RelaySpec())
+    ws = MockWebSocket()
+    client = NostrClientConnection(relay_id=relay_id, websocket=ws)
+    await client_manager.add_client(client)
+    task = asyncio.create_task(client.start())
+
+    author = events[0].pubkey
+    tagged = next(e for e in events if e.tag_values("e"))
+    referenced = tagged.tag_values("e")
+    for message in [
+        ["COUNT", "q0", {"authors": [author]}],
+        ["COUNT", "q1", {"authors": [author]}, {"kinds": [1]}],
+        ["COUNT", "q2", {"#e": referenced}],
+    ]:
+        await ws.wire_mock_data(message)
+        await asyncio.sleep(0.2)
+    await asyncio.sleep(0.3)
+
+    expected_tagged = {
+        e.id for e in events if set(e.tag_values("e")).intersection(referenced)
+    }
+    assert {loads(m)[1]: loads(m)[2] for m in ws.sent_messages} == {
+        "q0": {"count": len([e for e in events if e.pubkey == author])},
+        "q1": {"count": len([e for e in events if e.pubkey == author or e.kind == 1])},
+        "q2": {"count": len(expected_tagged)},
+    }
+    assert client.filters == [], "A COUNT is not a subscription"
+
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_negentropy_sync(stored_events: StoreEvents):
+    relay_id = "r_negentropy"
+    events = await stored_events(relay_id)
+
+    client_manager = NostrClientManager()
+    await client_manager.enable_relay(relay_id, RelaySpec(max_negentropy_sessions=1))
+    ws = MockWebSocket()
+    client = NostrClientConnection(relay_id=relay_id, websocket=ws)
+    await client_manager.add_client(client)
+    task = asyncio.create_task(client.start())
+
+    async def exchange(message: list) -> list:
+        sent = len(ws.sent_messages)
+        await ws.wire_mock_data(message)
+        for _ in range(50):
+            await asyncio.sleep(0.05)
+            if len(ws.sent_messages) > sent:
+                break
+        return loads(ws.sent_messages[-1])
+
+    # the client has the first two events and one the relay does not have
+    own_id = "ab" * 32
+    local_items = [(e.created_at, e.id) for e in events[:2]] + [(1, own_id)]
+    local = Negentropy(NegentropyStorage(local_items), is_initiator=True)
+    first_message = local.initiate()
+    response = await exchange(["NEG-OPEN", "neg0", {}, first_message.hex()])
+    message: bytes | None = first_message
+    while message is not None:
+        assert response[:2] == ["NEG-MSG", "neg0"]
+        message = local.reconcile(bytes.fromhex(response[2]))
+        if message is not None:
+            response = await exchange(["NEG-MSG", "neg0", message.hex()])
+
+    assert local.have_ids == [own_id]
+    assert sorted(local.need_ids) == sorted(e.id for e in events[2:])
+
+    response = await exchange(["NEG-OPEN", "neg1", {}, local.initiate().hex()])
+    assert response[:2] == ["NEG-ERR", "neg1"], "One session per connection"
+    assert response[2].startswith("blocked:")
+
+    await ws.wire_mock_data(["NEG-CLOSE", "neg0"])
+    response = await exchange(["NEG-MSG", "neg0", local.initiate().hex()])
+    assert response == ["NEG-ERR", "neg0", "closed: unknown subscription"]
+    response = await exchange(["NEG-OPEN", "neg1", {}, "61ff"])
+    assert response[:2] == ["NEG-ERR", "neg1"], "Invalid message"
+
+    task.cancel()
@@ -1,16 +1,33 @@
+import asyncio
 import json
 
 import pytest
+from coincurve import PrivateKey
 from loguru import logger
 
+from .. import migrations
 from ..crud import (
+    compact_deleted_events,
+    count_events,
     create_event,
+    db,
+    delete_events,
     get_event,
+    get_event_tags,
     get_events,
+    get_storage_for_public_key,
+    get_sync_items,
+    mark_events_deleted,
+    prune_old_events,
+    stream_events,
 )
-from ..relay.event import NostrEvent
-from ..relay.filter import NostrFilter
-from .conftest import EventFixture
+from ..helpers import json_dumps
+from ..relay import filter as filter_module
+from ..relay.event import NostrEvent, NostrEventStruct
+from ..relay.filter import NostrFilter, tag_index_value
+from ..relay.relay import FilterSpec
+from ..relay.signature_verifier import SignatureVerifier
+from .conftest import EventFixture, StoreEvents
 
 RELAY_ID = "r1"
 
@@ -30,6 +47,80 @@ def test_invalid_event_id_and_signature(invalid_events: list[EventFixture]):
             f.data.check_signature()
 
 
+def test_serialize_response_json(valid_events: list[EventFixture]):
+    for f in valid_events:
+        expected = json_dumps(f.data.serialize_response("sub:0"))
+        assert (
+            f.data.serialize_response_json("sub:0") == expected
+        ), f"Pre-serialized response differs for fixture '{f.name}'"
+
+
+def test_json_dumps_matches_nip01_serialization(valid_events: list[EventFixture]):
+    samples: list = [f.data.serialize() for f in valid_events]
+    samples += [
+        'quote " backslash \\ slash / newline \n tab \t',
+        "control \x00 \x01 \x1f \x7f \b \f \r",
+        "unicode é ü 中文 🚀 \u2028 \u2029",
+        [2**63 - 1, -(2**63), 2**64, 0],
+    ]
+    for sample in samples:
+        expected = json.dumps(sample, separators=(",", ":"), ensure_ascii=False)
+        assert json_dumps(sample) == expected
+
+
+def test_event_struct(valid_events: list[EventFixture]):
+    for f in valid_events:
+        struct = NostrEventStruct.parse(json.loads(f.data.nostr_json))
+        assert struct.nostr_json == f.data.nostr_json
+        assert struct.event_id == f.data.event_id
+        model = struct.to_model(f.data.relay_id, f.data.publisher)
+        assert model.dict() == f.data.dict(), f"Model differs for '{f.name}'"
+
+    data = valid_events[0].data.nostr_dict()
+    for name, value in [("created_at", "1"), ("kind", True), ("tags", [[1]])]:
+        with pytest.raises(ValueError, match=name):
+            NostrEventStruct.parse({**data, name: value})
+    with pytest.raises(ValueError, match="sig"):
+        NostrEventStruct.parse({k: v for k, v in data.items() if k != "sig"})
+
+
+def test_event_derived_values_are_memoized(valid_events: list[EventFixture]):
+    event = valid_events[0].data.copy()
+    assert event.event_id == event.id
+    assert event.size_bytes == len(json_dumps(event.nostr_dict()).encode())
+
+    nostr_json = event.nostr_json
+    event.size = event.size_bytes
+    assert event.nostr_json is nostr_json, "Not dropped by the stored size"
+
+    event.content += "!"
+    assert event.event_id != event.id, "Cached id must be dropped on update"
+    assert event.size_bytes == len(json_dumps(event.nostr_dict()).encode())
+
+    copied = event.copy(update={"content": ""})
+    assert copied.event_id != event.event_id, "Copies must not share the cache"
+
+
+@pytest.mark.asyncio
+async def test_signature_verifier(
+    valid_events: list[EventFixture], invalid_events: list[EventFixture]
+):
+    verifier = SignatureVerifier(max_batch_size=4)
+    await asyncio.gather(*[verifier.verify(f.data) for f in valid_events])
+
+    for f in invalid_events:
+        with pytest.raises(ValueError, match=f.exception):
+            await verifier.verify(f.data)
+
+    # verified pairs are cached, but only for the exact same content
+    event = valid_events[0].data
+    await verifier.verify(event)
+    tampered = event.copy(update={"content": event.content + "!"})
+    with pytest.raises(ValueError, match="Invalid event id"):
+        await verifier.verify(tampered)
+    verifier.shutdown()
+
+
 @pytest.mark.asyncio
 async def test_valid_event_crud(valid_events: list[EventFixture]):
     author = "a24496bca5dd73300f4e5d5d346c73132b7354c597fcbb6509891747b4689211"
@@ -41,12 +132,17 @@ async def test_valid_event_crud(valid_events: list[EventFixture]):
     for e in all_events:
         await create_event(e)
 
+    for e in all_events:
+        assert not await create_event(e), f"Duplicate event stored (id='{e.id}')"
+
     for f in valid_events:
         await get_by_id(f.data, f.name)
         await filter_by_id(all_events, f.data, f.name)
 
     await filter_by_author(all_events, author)
 
+    await stream_by_author(author)
+
     await filter_by_tag_p(all_events, author)
 
     await filter_by_tag_e(all_events, event_id)
@@ -89,6 +185,31 @@ async def filter_by_author(all_events: list[NostrEvent], author):
     assert len(filtered_events) == 5, "Failed to filter by authors"
 
 
+async def stream_by_author(author):
+    nostr_filter = NostrFilter(authors=[author])
+    events = await get_events(RELAY_ID, nostr_filter)
+    streamed = [e async for e in stream_events(RELAY_ID, nostr_filter, page_size=2)]
+    assert [e.nostr_dict() for e in streamed] == [
+        e.nostr_dict() for e in events
+    ], "Streamed events differ from queried events"
+
+    streamed = [
+        e
+        async for e in stream_events(
+            RELAY_ID, nostr_filter, page_size=4, first_page_size=1
+        )
+    ]
+    assert [e.id for e in streamed] == [
+        e.id for e in events
+    ], "Streamed events differ when the page size grows"
+
+    nostr_filter.limit = 3
+    streamed = [e async for e in stream_events(RELAY_ID, nostr_filter, page_size=2)]
+    assert [e.id for e in streamed] == [
+        e.id for e in events[:3]
+    ], "Streamed events do not respect the limit"
+
+
 async def filter_by_tag_p(all_events: list[NostrEvent], author):
     # todo: check why constructor does not work for fields with aliases (#e, #p)
     nostr_filter = NostrFilter()
@@ -151,3 +272,337 @@ async def filter_by_tag_e_p_and_author(
     assert (
         filtered_events[0].id == reply_event_id
     ), "Failed to filter the right event by 'author' and tags 'e' & 'p'"
+
+
+@pytest.mark.asyncio
+async def test_storage_accounting(stored_events: StoreEvents):
+    relay_id = "r_storage"
+    assert await get_storage_for_public_key(relay_id, "publisher") == 0
+    events = await stored_events(relay_id)
+    publisher = events[0].publisher
+    publisher_events = [e for e in events if e.publisher == publisher]
+
+    expected = sum(e.size_bytes for e in publisher_events)
+    assert await get_storage_for_public_key(relay_id, publisher) == expected
+    stored_event = await get_event(relay_id, events[0].id)
+    assert stored_event and stored_event.size == events[0].size_bytes
+
+    await delete_events(relay_id, NostrFilter(ids=[e.id for e in publisher_events]))
+    assert await get_storage_for_public_key(relay_id, publisher) == 0
+
+
+@pytest.mark.asyncio
+async def test_prune_old_events(stored_events: StoreEvents):
+    relay_id = "r_prune"
+    events = await stored_events(relay_id)
+
+    publisher = events[0].publisher
+    by_age = sorted(
+        (e for e in events if e.publisher == publisher),
+        key=lambda e: (e.created_at, e.id),
+    )
+    stored = await get_storage_for_public_key(relay_id, publisher)
+
+    # just enough: the oldest event is not enough, the second one is needed
+    await prune_old_events(relay_id, publisher, by_age[0].size + 1)
+
+    pruned, kept = by_age[:2], by_age[2:]
+    for e in pruned:
+        assert not await get_event(relay_id, e.id), "Oldest events are pruned"
+        assert await get_event_tags(relay_id, e.id) == [], "Tags are pruned"
+    for e in kept:
+        assert await get_event(relay_id, e.id), "Newer events are kept"
+    assert await get_storage_for_public_key(relay_id, publisher) == stored - sum(
+        e.size for e in pruned
+    )
+
+
+@pytest.mark.asyncio
+async def test_compact_deleted_events(stored_events: StoreEvents):
+    relay_id = "r_compact"
+    # the events deleted by the previous tests
+    await compact_deleted_events(2**40)
+    events = await stored_events(relay_id)
+    tagged = [e for e in events if e.tags]
+    assert tagged, "Fixture events with tags are needed"
+
+    deleted, kept = tagged[0], tagged[1:]
+    stored = await get_storage_for_public_key(relay_id, deleted.publisher)
+    await mark_events_deleted(relay_id, NostrFilter(ids=[deleted.id]))
+
+    stats = await compact_deleted_events(0)
+    assert stats.events == 0, "Deleted events are kept until the retention time"
+    assert await get_event_tags(relay_id, deleted.id) != []
+
+    stats = await compact_deleted_events(2**40, batch_size=1)
+    assert stats.events == 1
+    assert stats.bytes == deleted.size
+    assert stats.tags == len(deleted.tags)
+    assert await get_event_tags(relay_id, deleted.id) == []
+    assert await get_storage_for_public_key(relay_id, deleted.publisher) == (
+        stored - deleted.size
+    )
+    for e in kept:
+        assert await get_event_tags(relay_id, e.id) != [], "Other tags are kept"
+
+    await delete_events(relay_id, NostrFilter(ids=[kept[0].id]))
+    assert await get_event_tags(relay_id, kept[0].id) == [], "Tags deleted"
+
+
+@pytest.mark.asyncio
+async def test_delete_orphaned_tags(stored_events: StoreEvents):
+    relay_id = "r_orphans"
+    events = await stored_events(relay_id)
+    orphan, kept = [e for e in events if e.tags][:2]
+    # an event removed without its tags, before all delete paths removed them
+    await db.execute(
+        "DELETE FROM nostrrelay.events WHERE relay_id = :relay_id AND id = :id",
+        {"relay_id": relay_id, "id": orphan.id},
+    )
+
+    async with db.connect() as conn:
+        await migrations.m007_delete_orphaned_tags(conn)
+    assert await get_event_tags(relay_id, orphan.id) == [], "Orphan tags removed"
+    assert await get_event_tags(relay_id, kept.id) != [], "Other tags are kept"
+    row: dict | None = await db.fetchone(
+        "SELECT COUNT(*) AS count FROM nostrrelay.event_tag_index "
+        "WHERE relay_id = :relay_id AND event_id = :event_id",
+        {"relay_id": relay_id, "event_id": orphan.id},
+    )
+    assert row and row["count"] == 0, "Orphan tag index rows removed"
+
+
+@pytest.mark.asyncio
+async def test_search_events(
+    stored_events: StoreEvents, monkeypatch: pytest.MonkeyPatch
+):
+    relay_id = "r_search"
+    contents = [
+        "Bitcoin fixes this",
+        "bitcoin, bitcoin and more BITCOIN",
+        "lightning is bitcoin",
+        "Café lightning",
+        "nothing to see here",
+    ]
+    events = await stored_events(relay_id, contents)
+
+    def search(query: str, limit: int | None = None) -> NostrFilter:
+        return NostrFilter(search=query, limit=limit)
+
+    found = await get_events(relay_id, search("bitcoin"))
+    assert {e.content for e in found} == set(contents[:3])
+    assert found[0].content == contents[1], "Most relevant first"
+    assert len(await get_events(relay_id, search("bitcoin", limit=2))) == 2
+    assert [e.id async for e in stream_events(relay_id, search("bitcoin"))] == [
+        e.id for e in found
+    ]
+    assert await count_events(relay_id, [search("bitcoin")]) == 3
+
+    found = await get_events(relay_id, search("LIGHTNING cafe"))
+    assert [e.content for e in found] == [contents[3]], "All words, any case"
+    # FTS5 syntax is not interpreted and NIP-50 extensions are ignored
+    found = await get_events(relay_id, search('"lightning*" ( include:spam'))
+    assert {e.content for e in found} == {contents[2], contents[3]}
+    for e in events:
+        assert search("lightning").matches(e) == (e.content in contents[2:4])
+
+    # only the newest matches are ranked
+    monkeypatch.setattr(filter_module, "SEARCH_MAX_CANDIDATES", 2)
+    found = await get_events(relay_id, search("bitcoin"))
+    assert [e.content for e in found] == [contents[1], contents[2]]
+    monkeypatch.undo()
+
+    await mark_events_deleted(relay_id, NostrFilter(ids=[events[0].id]))
+    await delete_events(relay_id, NostrFilter(ids=[events[1].id]))
+    found = await get_events(relay_id, search("bitcoin"))
+    assert [e.content for e in found] == [contents[2]], "Deleted events not found"
+
+
+@pytest.mark.asyncio
+async def test_generic_tag_filter_events(valid_events: list[EventFixture]):
+    relay_id = "r_tag_index"
+    tags = [
+        [["t", "nostr"], ["t", "nostr"], ["k", "1"]],
+        [["t", "nostr"], ["t", "bitcoin"], ["a", "30023:pk:post"]],
+        [["t", "bitcoin"], ["tag", "nostr"], ["t", "x" * 600]],
+    ]
+    events = []
+    for f, event_tags in zip(valid_events, tags, strict=False):
+        event = f.data.copy(deep=True, update={"relay_id": relay_id})
+        event.tags = event_tags
+        events.append(event)
+        await create_event(event)
+
+    def ids(nostr_filter: NostrFilter) -> set[str]:
+        return {e.id for e in events if nostr_filter.matches(e)}
+
+    for tag_filters, expected in [
+        ({"#t": ["nostr"]}, events[:2]),
+        ({"#t": ["nostr", "bitcoin"]}, events),
+        ({"#t": ["bitcoin"], "#a": ["30023:pk:post"]}, events[1:2]),
+        ({"#k": ["1"], "#t": ["bitcoin"]}, []),
+        ({"#t": ["x" * 600]}, events[2:3]),
+    ]:
+        nostr_filter = NostrFilter.parse_obj(tag_filters)
+        found = await get_events(relay_id, nostr_filter)
+        assert len(found) == len(expected), "An event is returned once"
+        assert {e.id for e in found} == ids(nostr_filter) == {e.id for e in expected}
+        assert await count_events(relay_id, [nostr_filter]) == len(expected)
+
+    rows: list[dict] = await db.fetchall(
+        "SELECT name, value FROM nostrrelay.event_tag_index "
+        "WHERE relay_id = :relay_id AND event_id = :event_id",
+        {"relay_id": relay_id, "event_id": events[2].id},
+    )
+    assert sorted((r["name"], r["value"]) for r in rows) == [
+        ("t", "bitcoin"),
+        ("t", tag_index_value("x" * 600)),
+    ], "Long values indexed by their hash"
+
+    # the migration indexes the stored tags the same way
+    query = (
+        "SELECT * FROM nostrrelay.event_tag_index "
+        "ORDER BY relay_id, name, value, event_id"
+    )
+    indexed: list[dict] = await db.fetchall(query)
+    await db.execute("DROP TABLE nostrrelay.event_tag_index")
+    async with db.connect() as conn:
+        await migrations.m006_add_event_tag_index(conn)
+    assert await db.fetchall(query) == indexed
+
+    await delete_events(relay_id, NostrFilter(ids=[events[0].id]))
+    assert await get_events(relay_id, NostrFilter.parse_obj({"#k": ["1"]})) == []
+    row: dict | None = await db.fetchone(
+        "SELECT COUNT(*) AS count FROM nostrrelay.event_tag_index "
+        "WHERE relay_id = :relay_id AND event_id = :event_id",
+        {"relay_id": relay_id, "event_id": events[0].id},
+    )
+    assert row and row["count"] == 0, "Index rows deleted with the event"
+
+
+@pytest.mark.asyncio
+async def test_delete_addressable_event_with_long_d_tag(
+    valid_events: list[EventFixture],
+):
+    relay_id = "r_long_d"
+    event = valid_events[0].data.copy(
+        deep=True, update={"relay_id": relay_id, "kind": 30023}
+    )
+    event.tags = [["d", "d" * 1000]]
+    await create_event(event)
+
+    # the filter of an addressable replacement (NIP-01)
+    replaced = NostrFilter.parse_obj(
+        {
+            "kinds": [30023],
+            "authors": [event.pubkey],
+            "#d": ["d" * 1000],
+            "until": event.created_at + 1,
+        }
+    )
+    assert replaced.matches(event)
+    assert [e.id for e in await get_events(relay_id, replaced)] == [event.id]
+    await delete_events(relay_id, replaced)
+    assert await get_event(relay_id, event.id) is None
+
+
+@pytest.mark.asyncio
+async def test_html_content_round_trip():
+    relay_id = "r_html"
+    private_key = PrivateKey()
+    pubkey = private_key.public_key_xonly.format().hex()
+    event = NostrEvent(
+        id="",
+        relay_id=relay_id,
+        publisher=pubkey,
+        pubkey=pubkey,
+        created_at=1700000000,
+        kind=1,
+        tags=[["t", "<b>html</b>"], ["r", "https://example.com/?a=1&amp;b=2"]],
+        content="hi <b>bold</b> &amp; more",
+        sig="",
+    )
+    event.id = event.event_id
+    event.sig = private_key.sign_schnorr(bytes.fromhex(event.id)).hex()
+    await create_event(event)
+
+    stored = await get_event(relay_id, event.id)
+    assert stored, "Event should be stored"
+    assert stored.content == event.content, "Content stored as it is"
+    assert stored.tags == event.tags, "Tag values stored as they are"
+    stored.check_signature()
+
+
+@pytest.mark.asyncio
+async def test_html_tag_filters(valid_events: list[EventFixture]):
+    relay_id = "r_html_tags"
+    event = valid_events[0].data.copy(
+        deep=True, update={"relay_id": relay_id, "kind": 30023}
+    )
+    event.tags = [["d", "a<b>c"], ["t", "x&amp;y"]]
+    await create_event(event)
+
+    padding = [f"{i}" for i in range(40)]
+    for tag_filters in [
+        {"#d": ["a<b>c"]},
+        {"#t": ["x&amp;y"]},
+        {"#t": [*padding, "x&amp;y"]},  # one JSON parameter (SQLite)
+    ]:
+        nostr_filter = NostrFilter.parse_obj(tag_filters)
+        assert nostr_filter.matches(event)
+        assert [e.id for e in await get_events(relay_id, nostr_filter)] == [event.id]
+        assert await count_events(relay_id, [nostr_filter]) == 1
+        assert await get_sync_items(relay_id, nostr_filter, 0) == [
+            (event.created_at, event.id)
+        ]
+    assert await get_events(relay_id, NostrFilter.parse_obj({"#d": ["ac"]})) == []
+
+    # the filter of an addressable replacement (NIP-01)
+    replaced = NostrFilter.parse_obj(
+        {
+            "kinds": [30023],
+            "authors": [event.pubkey],
+            "#d": ["a<b>c"],
+            "until": event.created_at + 1,
+        }
+    )
+    await delete_events(relay_id, replaced)
+    assert await get_event(relay_id, event.id) is None
+
+
+@pytest.mark.asyncio
+async def test_filter_lists_at_max_size(valid_events: list[EventFixture]):
+    relay_id = "r_max_lists"
+    event = valid_events[2].data.copy(update={"relay_id": relay_id})
+    await create_event(event)
+
+    max_size = FilterSpec().max_filter_list_size
+    padding = [f"{i:064x}" for i in range(max_size - 1)]
+    nostr_filter = NostrFilter.parse_obj(
+        {
+            "ids": [event.id, *padding],
+            "authors": [*padding, event.pubkey],
+            "kinds": list(range(max_size)),
+            "#e": [*padding, event.tag_values("e")[0]],
+            "#p": [*padding, event.tag_values("p")[0]],
+        }
+    )
+    nostr_filter.validate_list_sizes(max_size)
+    assert [e.id for e in await get_events(relay_id, nostr_filter)] == [event.id]
+    filters = [nostr_filter.copy(deep=True) for _ in range(10)]
+    assert await count_events(relay_id, filters) == 1
+
+
+@pytest.mark.asyncio
+async def test_backfill_event_size(stored_events: StoreEvents):
+    events = await stored_events("r_size_1") + await stored_events("r_size_2")
+
+    await db.execute(
+        "UPDATE nostrrelay.events SET size = 0 "
+        "WHERE relay_id IN ('r_size_1', 'r_size_2')"
+    )
+    async with db.connect() as conn:
+        await migrations.m003_backfill_event_size(conn)
+    for e in events:
+        stored = await get_event(e.relay_id, e.id)
+        assert stored and stored.size == e.size_bytes, f"Size of '{e.id}'"
@@ -0,0 +1,110 @@
+import json
+
+import pytest
+from lnbits.db import POSTGRES, SQLITE
+
+from ..relay.filter import SEARCH_MAX_CANDIDATES, NostrFilter, search_words
+from .conftest import EventFixture
+
+RELAY_ID = "r1"
+AUTHOR = "a24496bca5dd73300f4e5d5d346c73132b7354c597fcbb6509891747b4689211"
+
+
+def _sql(nostr_filter: NostrFilter, db_type: str) -> tuple[str, dict]:
+    inner_joins, where, values = nostr_filter.to_sql_components(RELAY_ID, db_type)
+    return " ".join(inner_joins) + " WHERE " + " AND ".join(where), values
+
+
+def test_sql_values_are_bound_parameters():
+    injection = "x') OR 1=1 --"
+    nostr_filter = NostrFilter.parse_obj(
+        {"ids": [injection], "authors": [AUTHOR], "kinds": [1], "#p": [injection]}
+    )
+    for db_type in [SQLITE, POSTGRES]:
+        sql, values = _sql(nostr_filter, db_type)
+        assert injection not in sql and AUTHOR not in sql
+        assert injection in values.values() or [injection] in values.values()
+
+
+def test_sqlite_placeholder_buckets():
+    sql_3, values = _sql(NostrFilter(authors=["a", "b", "c"]), SQLITE)
+    sql_4, _ = _sql(NostrFilter(authors=["a", "b", "c", "d"]), SQLITE)
+    sql_5, _ = _sql(NostrFilter(authors=["a", "b", "c", "d", "e"]), SQLITE)
+
+    assert sql_3 == sql_4, "Lists in the same bucket must produce the same SQL"
+    assert sql_4 != sql_5
+    assert values["authors_3"] == "c", "Bucket is padded with the last value"
+
+    sql_large, values = _sql(NostrFilter(authors=[str(i) for i in range(5000)]), SQLITE)
+    assert "json_each(:authors)" in sql_large and len(values) == 2
+    assert json.loads(values["authors"])[-1] == "4999"
+
+
+def test_postgres_array_binding():
+    sql_1, values = _sql(NostrFilter(kinds=[1]), POSTGRES)
+    sql_2, _ = _sql(NostrFilter(kinds=[1, 7, 30023]), POSTGRES)
+    assert sql_1 == sql_2
+    assert "kind = ANY(:kinds)" in sql_1
+    assert values["kinds"] == [1]
+
+
+def test_list_size_cap():
+    nostr_filter = NostrFilter(authors=[AUTHOR] * 3)
+    nostr_filter.validate_list_sizes(3)
+    nostr_filter.validate_list_sizes(0)
+    with pytest.raises(ValueError, match="'authors' has too many values"):
+        nostr_filter.validate_list_sizes(2)
+
+
+def test_compiled_filter_is_refreshed_on_assignment(valid_events: list[EventFixture]):
+    events = [f.data for f in valid_events]
+    nostr_filter = NostrFilter(kinds=[3])
+    nostr_filter.compile()
+    assert len([e for e in events if nostr_filter.matches(e)]) == 2
+
+    nostr_filter.kinds = [7]
+    assert len([e for e in events if nostr_filter.matches(e)]) == 1
+
+    nostr_filter.p.append(AUTHOR)
+    nostr_filter.compile()
+    assert len([e for e in events if nostr_filter.matches(e)]) == 1
+    nostr_filter.p = ["unknown"]
+    assert len([e for e in events if nostr_filter.matches(e)]) == 0
+
+
+def test_generic_tag_filters(valid_events: list[EventFixture]):
+    nostr_filter = NostrFilter.parse_obj(
+        {"#t": ["nostr"], "#T": ["upper"], "#p": [AUTHOR], "#tag": ["x"]}
+    )
+    assert nostr_filter.tag_filters() == [
+        ("p", [AUTHOR]),
+        ("T", ["upper"]),
+        ("t", ["nostr"]),
+    ], "Only single-letter tags"
+    assert not nostr_filter.is_empty()
+    with pytest.raises(ValueError, match="'#t' has too many values"):
+        NostrFilter.parse_obj({"#t": ["a", "b"]}).validate_list_sizes(1)
+
+    for db_type in [SQLITE, POSTGRES]:
+        sql, values = _sql(nostr_filter, db_type)
+        assert "JOIN" not in sql, "Tags are semi-joins"
+        assert sql.count("event_tag_index") == 3
+        assert values["tag_t_name"] == "t" and values["tag_T_upper_name"] == "T"
+
+    event = valid_events[0].data.copy(deep=True)
+    event.tags = [["t", "nostr"], ["T", "upper"], ["p", AUTHOR]]
+    assert nostr_filter.matches(event)
+    assert not NostrFilter.parse_obj({"#t": ["upper"]}).matches(event)
+    assert not NostrFilter.parse_obj({"#a": ["nostr"]}).matches(event)
+
+
+def test_postgres_search(valid_events: list[EventFixture]):
+    sql, values = _sql(NostrFilter(search="Café lightning include:spam"), POSTGRES)
+    assert "plainto_tsquery('simple', :search)" in sql
+    assert values["search"] == "Café lightning", "Diacritics kept, like the content"
+    assert "kind <> 4" in sql, "Direct messages are not searchable"
+    assert values["search_candidates"] == SEARCH_MAX_CANDIDATES
+
+    direct_message = next(f.data for f in valid_events if f.data.is_direct_message)
+    words = " ".join(search_words(direct_message.content)[:1])
+    assert words and not NostrFilter(search=words).matches(direct_message)
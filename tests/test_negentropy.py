@@ -0,0 +1,84 @@
+import hashlib
+import random
+
+import pytest
+
+from ..relay.negentropy import Negentropy, NegentropyStorage, encode_varint
+
+
+def _items(prefix: str, count: int, rnd: random.Random) -> list[tuple[int, str]]:
+    return [
+        (
+            1_700_000_000 + rnd.randint(0, 50),
+            hashlib.sha256(f"{prefix}:{i}".encode()).hexdigest(),
+        )
+        for i in range(count)
+    ]
+
+
+def _sync(
+    client_items: list, relay_items: list, frame_size_limit: int = 0
+) -> tuple[Negentropy, int]:
+    client = Negentropy(NegentropyStorage(client_items), frame_size_limit, True)
+    relay = Negentropy(NegentropyStorage(relay_items), frame_size_limit)
+    message: bytes | None = client.initiate()
+    round_trips = 0
+    while message is not None:
+        round_trips += 1
+        response = relay.reconcile(message)
+        assert response is not None, "The relay always answers"
+        message = client.reconcile(response)
+    return client, round_trips
+
+
+def test_varint():
+    assert encode_varint(0) == b"\x00"
+    assert encode_varint(127) == b"\x7f"
+    assert encode_varint(128) == b"\x81\x00"
+    assert encode_varint(16_383) == b"\xff\x7f"
+
+
+def test_fingerprint():
+    assert NegentropyStorage([]).fingerprint(0, 0) == (
+        hashlib.sha256(bytes(32) + b"\x00").digest()[:16]
+    )
+    storage = NegentropyStorage([(1, "01" + "00" * 31), (2, "ff" + "00" * 31)])
+    id_sum = (1 + 255).to_bytes(32, "little")
+    assert storage.fingerprint(0, 2) == (hashlib.sha256(id_sum + b"\x02").digest()[:16])
+
+
+@pytest.mark.parametrize("frame_size_limit", [0, 4096])
+@pytest.mark.parametrize("shared_count", [0, 10, 3000])
+def test_reconcile(shared_count: int, frame_size_limit: int):
+    rnd = random.Random(shared_count)
+    shared = _items("shared", shared_count, rnd)
+    client_only = _items("client", 20, rnd)
+    relay_only = _items("relay", 200, rnd)
+
+    client, round_trips = _sync(
+        shared + client_only, shared + relay_only, frame_size_limit
+    )
+    assert sorted(client.have_ids) == sorted(i for _, i in client_only)
+    assert sorted(client.need_ids) == sorted(i for _, i in relay_only)
+    if frame_size_limit:
+        assert round_trips > 1, "Large differences need more round trips"
+
+
+def test_reconcile_same_items():
+    items = _items("shared", 1000, random.Random(1))
+    client, round_trips = _sync(items, list(reversed(items)))
+    assert client.have_ids == client.need_ids == []
+    assert round_trips == 1, "Equal fingerprints, nothing else to send"
+
+
+def test_invalid_messages():
+    relay = Negentropy(NegentropyStorage([]))
+    assert relay.reconcile(bytes([0x62])) == bytes([0x61]), "Version negotiation"
+    with pytest.raises(ValueError, match="version"):
+        relay.reconcile(bytes([0x01]))
+    with pytest.raises(ValueError, match="too short"):
+        relay.reconcile(bytes([0x61, 0x00, 0x00, 0x01]))
+    with pytest.raises(ValueError, match="mode"):
+        relay.reconcile(bytes([0x61, 0x00, 0x00, 0x07]))
+    with pytest.raises(ValueError, match="Frame size"):
+        Negentropy(NegentropyStorage([]), frame_size_limit=100)
@@ -0,0 +1,155 @@
+import pytest
+
+from ..crud import (
+    _recent_events,
+    create_event,
+    delete_events,
+    get_events,
+    prune_old_events,
+    stream_events,
+)
+from ..relay import recent_events as recent_events_module
+from ..relay.event import NostrEvent
+from ..relay.filter import NostrFilter
+from ..relay.recent_events import RecentEvents
+from .conftest import EventFixture, StoreEvents
+
+
+def _by_age(events: list[NostrEvent]) -> list[NostrEvent]:
+    return sorted(events, key=lambda e: (e.created_at, e.id))
+
+
+def test_query_complete_buffer(valid_events: list[EventFixture]):
+    events = [f.data for f in valid_events]
+    recent_events = RecentEvents()
+    assert recent_events.query(NostrFilter()) is None, "Not seeded yet"
+
+    generation = recent_events.start_seeding()
+    recent_events.add(events[0])  # stored while seeding
+    recent_events.seed(generation, events[1:], complete=True)
+
+    newest_first = [e.id for e in reversed(_by_age(events))]
+    assert len(recent_events) == len(events)
+    result = recent_events.query(NostrFilter())
+    assert result is not None
+    assert [e.id for e in result] == newest_first
+
+    nostr_filter = NostrFilter(kinds=[1], limit=2)
+    expected = [e for e in reversed(_by_age(events)) if e.kind == 1][:2]
+    result = recent_events.query(nostr_filter)
+    assert result is not None
+    assert [e.id for e in result] == [e.id for e in expected]
+
+
+def test_query_after_eviction(
+    valid_events: list[EventFixture], monkeypatch: pytest.MonkeyPatch
+):
+    events = _by_age([f.data for f in valid_events])
+    recent_events = RecentEvents(max_count=3)
+    recent_events.seed(recent_events.start_seeding(), [], complete=True)
+    for e in events:
+        recent_events.add(e)
+
+    kept = events[-3:]
+    assert len(recent_events) <= 3
+    assert recent_events.watermark > events[0].created_at
+    assert recent_events.bytes == sum(
+        e.size_bytes for e in kept if e.created_at >= recent_events.watermark
+    )
+
+    assert recent_events.query(NostrFilter()) is None, "Older events can match"
+    result = recent_events.query(NostrFilter(since=recent_events.watermark))
+    assert result is not None, "The window is in the buffer"
+    assert {e.id for e in result} == {
+        e.id for e in events if e.created_at >= recent_events.watermark
+    }
+    if result:
+        result = recent_events.query(NostrFilter(limit=1))
+        assert result is not None, "The limit is reached in the buffer"
+        assert [e.id for e in result] == [kept[-1].id]
+
+    # the filters that the buffer cannot answer are not scanned
+    def no_scan(*_):
+        raise AssertionError("The buffer is scanned")
+
+    monkeypatch.setattr(recent_events_module, "_matches", no_scan)
+    for nostr_filter in [
+        NostrFilter(authors=[kept[-1].pubkey], limit=1),
+        NostrFilter(kinds=[kept[-1].kind], limit=len(kept) + 1),
+        NostrFilter(limit=len(kept) + 1),
+    ]:
+        assert recent_events.query(nostr_filter) is None
+    monkeypatch.undo()
+
+    recent_events.add(events[0])
+    assert events[0].id not in {
+        e.id for e in recent_events.query(NostrFilter(limit=5)) or []
+    }
+
+
+def test_remove_and_invalidate(valid_events: list[EventFixture]):
+    events = [f.data for f in valid_events]
+    recent_events = RecentEvents()
+    recent_events.seed(recent_events.start_seeding(), events, complete=True)
+
+    removed = events[0]
+    recent_events.remove_matching(NostrFilter(ids=[removed.id]))
+    result = recent_events.query(NostrFilter()) or []
+    assert removed.id not in {e.id for e in result}
+    assert len(result) == len(events) - 1
+
+    # `until` is exclusive, like for the database
+    newest = _by_age(events)[-1]
+    recent_events.remove_matching(NostrFilter(until=newest.created_at))
+    result = recent_events.query(NostrFilter()) or []
+    assert {e.created_at for e in result} == {newest.created_at}
+
+    generation = recent_events.start_seeding()
+    recent_events.remove_matching(NostrFilter(ids=[newest.id]))
+    recent_events.seed(generation, events, complete=True)
+    assert recent_events.query(NostrFilter()) is None, "Stale seed is ignored"
+
+    recent_events.invalidate()
+    assert len(recent_events) == 0
+    assert recent_events.query(NostrFilter()) is None
+
+
+@pytest.mark.asyncio
+async def test_stream_events_from_memory(valid_events: list[EventFixture]):
+    relay_id = "r_recent_events"
+    events = [f.data.copy(update={"relay_id": relay_id}) for f in valid_events]
+    for e in events[1:]:
+        await create_event(e)
+
+    nostr_filter = NostrFilter(authors=[events[0].pubkey])
+    # seeds the buffer
+    assert [e.id async for e in stream_events(relay_id, nostr_filter)] == [
+        e.id for e in await get_events(relay_id, nostr_filter)
+    ]
+    assert _recent_events[relay_id].query(NostrFilter()) is not None
+
+    await create_event(events[0])
+    replaced = NostrFilter(authors=[events[0].pubkey], until=events[0].created_at)
+    await delete_events(relay_id, replaced)
+    for nostr_filter in [NostrFilter(), NostrFilter(kinds=[1], limit=2), replaced]:
+        assert [e.id async for e in stream_events(relay_id, nostr_filter)] == [
+            e.id for e in await get_events(relay_id, nostr_filter)
+        ], "The buffer is consistent with the database"
+
+
+@pytest.mark.asyncio
+async def test_prune_keeps_the_buffer(stored_events: StoreEvents):
+    relay_id = "r_recent_prune"
+    events = await stored_events(relay_id)
+    # seeds the buffer
+    assert [e.id async for e in stream_events(relay_id, NostrFilter())]
+    recent_events = _recent_events[relay_id]
+
+    oldest = _by_age(events)[0]
+    await prune_old_events(relay_id, oldest.publisher, 1)
+    assert recent_events.ready, "The buffer is not reloaded after a prune"
+    result = recent_events.query(NostrFilter())
+    assert result is not None and oldest.id not in {e.id for e in result}
+    assert [e.id for e in result] == [
+        e.id for e in await get_events(relay_id, NostrFilter())
+    ], "The buffer is consistent with the database"
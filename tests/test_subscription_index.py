@@ -0,0 +1,68 @@
+from ..relay.client_connection import NostrClientConnection
+from ..relay.filter import NostrFilter
+from ..relay.subscription_index import NostrSubscriptionIndex
+from .conftest import EventFixture
+from .test_clients import MockWebSocket
+
+RELAY_ID = "r1"
+AUTHOR = "a24496bca5dd73300f4e5d5d346c73132b7354c597fcbb6509891747b4689211"
+
+
+def _filter(subscription_id: str, **kwargs) -> NostrFilter:
+    nostr_filter = NostrFilter.parse_obj(kwargs)
+    nostr_filter.subscription_id = subscription_id
+    return nostr_filter
+
+
+def test_index_returns_same_matches_as_full_scan(valid_events: list[EventFixture]):
+    clients = [
+        NostrClientConnection(relay_id=RELAY_ID, websocket=MockWebSocket())
+        for _ in range(3)
+    ]
+    filters = [
+        [_filter("all"), _filter("posts", kinds=[1])],
+        [_filter("author", authors=[AUTHOR]), _filter("mentions", **{"#p": [AUTHOR]})],
+        [_filter("contacts", kinds=[3], **{"#p": [AUTHOR]})],
+    ]
+
+    index = NostrSubscriptionIndex()
+    for client, client_filters in zip(clients, filters, strict=True):
+        for nostr_filter in client_filters:
+            index.add(client, nostr_filter)
+
+    for f in valid_events:
+        expected = []
+        for client, client_filters in zip(clients, filters, strict=True):
+            first = next((nf for nf in client_filters if nf.matches(f.data)), None)
+            if first:
+                expected.append((client, first.subscription_id))
+
+        matched = [(c, nf.subscription_id) for c, nf in index.matches(f.data)]
+        assert sorted(matched, key=lambda m: id(m[0])) == sorted(
+            expected, key=lambda m: id(m[0])
+        ), f"Index mismatch for fixture '{f.name}'"
+
+
+def test_index_remove(valid_events: list[EventFixture]):
+    client = NostrClientConnection(relay_id=RELAY_ID, websocket=MockWebSocket())
+    nostr_filter = _filter("author", authors=[AUTHOR])
+    event = next(f.data for f in valid_events if f.data.pubkey == AUTHOR)
+
+    index = NostrSubscriptionIndex()
+    index.add(client, nostr_filter)
+    assert len(index.matches(event)) == 1
+
+    index.remove(nostr_filter)
+    assert len(index) == 0
+    assert index.matches(event) == []
+
+    other = NostrClientConnection(relay_id=RELAY_ID, websocket=MockWebSocket())
+    other_filter = _filter("other", authors=[AUTHOR])
+    index.add(client, nostr_filter)
+    index.add(client, _filter("all"))
+    index.add(other, other_filter)
+    index.remove_client(client)
+    assert index.matches(event) == [(other, other_filter)]
+    index.remove_client(other)
+    assert len(index) == 0
+    assert index.matches(event) == []
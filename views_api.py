@@ -147,6 +147,19 @@ async def api_get_relay(
     return relay
 
 
+@nostrrelay_api_router.get("/api/v1/relay/{relay_id}/stats")
+async def api_get_relay_stats(
+    relay_id: str, wallet: WalletTypeInfo = Depends(require_invoice_key)
+) -> dict:
+    relay = await get_relay(wallet.wallet.user, relay_id)
+    if not relay:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail="Cannot find relay",
+        )
+    return client_manager.send_stats(relay_id)
+
+
 @nostrrelay_api_router.put("/api/v1/account", dependencies=[Depends(require_admin_key)])
 async def api_create_or_update_account(
     data: NostrPartialAccount,